@@ -16,10 +16,21 @@ import uuid
 import serial
 import serial.tools.list_ports
 import subprocess
+import tempfile
 import threading
 import platform
 import pytz
+import sys
+import csv
+import heapq
+import bisect
+import re
+import multiprocessing
+from queue import Empty
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from decimal import Decimal, ROUND_HALF_UP
 
 # Constants
 DATA_DIR = "data"
@@ -42,6 +53,69 @@ PURCHASE_ORDERS_FILE = os.path.join(DATA_DIR, "purchase_orders.json")
 # Add these constants at the top with other constants
 BRANDS_FILE = os.path.join(DATA_DIR, "brands.json")
 OUTDOOR_ORDERS_FILE = os.path.join(DATA_DIR, "outdoor_orders.json")
+# Report cache limits
+REPORT_CACHE_MAX_BYTES = 128 * 1024 * 1024
+REPORT_CACHE_MAX_ENTRIES = 64
+# Background jobs
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")
+JOBS_FILE = os.path.join(DATA_DIR, "jobs.json")
+JOB_WORKERS = 2
+JOB_HISTORY_LIMIT = 50
+# Historical rebuilds
+SALES_CUBE_FILE = os.path.join(DATA_DIR, "sales_cube.json")
+PARALLEL_WORKERS = os.cpu_count() or 1
+# Promotion and price scheduling
+PRICE_SCHEDULE_FILE = os.path.join(DATA_DIR, "price_schedule.json")
+PRICE_HISTORY_FILE = os.path.join(DATA_DIR, "price_history.json")
+SCHEDULER_POLL_SECONDS = 60
+# Append-only stock movement ledger (one JSON object per line)
+STOCK_LEDGER_FILE = os.path.join(DATA_DIR, "stock_ledger.jsonl")
+# Items below their reorder point and the feed of threshold crossings
+LOW_STOCK_FILE = os.path.join(DATA_DIR, "low_stock.json")
+LOW_STOCK_ALERT_LIMIT = 500
+# Running inventory valuation (weighted average and FIFO layers) and daily COGS
+VALUATION_FILE = os.path.join(DATA_DIR, "valuation.json")
+VALUATION_METHODS = ["Weighted Average", "FIFO"]
+COGS_MOVEMENT_TYPES = ('Sale', 'Outdoor Delivery', 'Return', 'Outdoor Return')
+# Checkout idempotency keys kept for deduplicating retried sales
+CHECKOUT_KEYS_FILE = os.path.join(DATA_DIR, "checkout_keys.json")
+CHECKOUT_KEY_LIMIT = 10000
+# Per-barcode sales counters
+SALES_COUNTERS_FILE = os.path.join(DATA_DIR, "sales_counters.json")
+SALES_COUNTER_WINDOWS = (7, 30, 90)
+SALES_COUNTER_HOURLY_DAYS = 28
+SALES_COUNTERS_VERSION = 2  # 2: returns are netted against the day of the original sale
+QUICK_KEYS_COUNT = 8
+QUICK_KEYS_PER_ROW = 4
+# Money is stored and summed as integer minor units (cents)
+MONEY_SCALE = 100
+# Streaming exports
+EXPORT_CHUNK_ROWS = 5000
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+}
+# Bulk product import
+PRODUCT_IMPORT_CHUNK_ROWS = 50000
+PRODUCT_IMPORT_COLUMNS = ["barcode", "name", "description", "price", "cost", "category", "subcategory",
+                          "brand", "supplier", "initial_stock", "reorder_point", "active"]
+STOCK_QUANTITY_LIMIT = 10 ** 9  # largest stock quantity or reorder point accepted from a file
+# Demand-driven reordering
+REORDER_HISTORY_DAYS = 56
+REORDER_SHORT_WINDOW = 7
+REORDER_LONG_WINDOW = 28
+REORDER_REVIEW_DAYS = 7
+REORDER_SERVICE_Z = 1.65  # ~95% cycle service level
+DEFAULT_LEAD_TIME_DAYS = 7
+OPEN_PO_STATUSES = ('draft', 'pending', 'partially_received')
+# Stockout forecasting, refit once a day from the transaction history
+FORECAST_FILE = os.path.join(DATA_DIR, "stock_forecast.json")
+FORECAST_HISTORY_DAYS = 180
+FORECAST_SES_ALPHA = 0.2
+FORECAST_CROSTON_ALPHA = 0.1
+FORECAST_CROSTON_ADI = 1.32  # average demand interval above which demand is intermittent
+# Loyalty bulk import
+LOYALTY_POINTS_LIMIT = 10 ** 12
 # Authentication functions
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -71,6 +145,7 @@ def is_cashier():
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(BACKUP_DIR, exist_ok=True)
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
+os.makedirs(JOBS_DIR, exist_ok=True)
 
 # Data loading and saving functions
 def load_data(file):
@@ -83,6 +158,9 @@ def load_data(file):
 def save_data(data, file):
     with open(file, 'w') as f:
         json.dump(data, f, indent=4)
+    bump_data_version(file)
+    if file == INVENTORY_FILE:
+        get_low_stock_tracker().sync(data)
 
 # Initialize empty data files if they don't exist
 def initialize_empty_data():
@@ -372,7 +450,7 @@ def generate_short_id():
     return str(uuid.uuid4())[:8]
 
 def format_currency(amount):
-    settings = load_data(SETTINGS_FILE)
+    settings = get_settings()
     symbol = settings.get('currency_symbol', '$')
     decimals = settings.get('decimal_places', 2)
     return f"{symbol}{amount:.{decimals}f}"
@@ -382,6 +460,498 @@ def get_current_datetime():
     tz = pytz.timezone(settings.get('timezone', 'UTC'))
     return datetime.datetime.now(tz)
 
+# Money
+# Amounts are converted to integer cents once, at the edge, and all arithmetic is
+# done on ints. Stored records keep their float fields for display and older
+# readers, with an exact "<field>_cents" twin alongside.
+MONEY_FIELDS = {
+    TRANSACTIONS_FILE: (['subtotal', 'tax', 'discount', 'total', 'amount_tendered', 'change'], ['price']),
+    RETURNS_FILE: (['total_refund', 'tax_refund'], ['price', 'subtotal']),
+    PURCHASE_ORDERS_FILE: (['total_cost'], ['cost']),
+    OUTDOOR_ORDERS_FILE: (['total'], ['price'])
+}
+
+def to_cents(amount):
+    if amount is None or amount == "":
+        return 0
+    return int((Decimal(str(amount)) * MONEY_SCALE).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def from_cents(cents):
+    return cents / MONEY_SCALE
+
+def apply_rate(cents, rate):
+    return int((Decimal(cents) * Decimal(str(rate))).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def cents_of(record, field):
+    cents = record.get(f"{field}_cents")
+    return cents if cents is not None else to_cents(record.get(field, 0))
+
+def cents_array(values):
+    return np.rint(np.asarray(values, dtype=np.float64) * MONEY_SCALE).astype(np.int64)
+
+def format_cents(cents):
+    return format_currency(from_cents(cents))
+
+def with_cents(record, fields):
+    for field in fields:
+        if field in record and f"{field}_cents" not in record:
+            record[f"{field}_cents"] = to_cents(record[field])
+    return record
+
+def _record_items(record):
+    items = record.get('items') or {}
+    return items.values() if isinstance(items, dict) else items
+
+@st.cache_resource
+def migrate_money_fields():
+    # Runs once per process; only fills in missing *_cents fields so it is safe to repeat
+    migrated = {}
+    for file, (fields, item_fields) in MONEY_FIELDS.items():
+        records = load_data(file)
+        changed = 0
+        for record in records.values():
+            if not isinstance(record, dict):
+                continue
+            before = len(record)
+            with_cents(record, fields)
+            item_changed = False
+            for item in _record_items(record):
+                if isinstance(item, dict):
+                    size = len(item)
+                    with_cents(item, item_fields)
+                    item_changed = item_changed or len(item) != size
+            if len(record) != before or item_changed:
+                changed += 1
+        if changed:
+            save_data(records, file)
+        migrated[file] = changed
+    return migrated
+
+# Data store versioning
+# Every save_data() bumps a per-file counter. The file mtime is folded in so that
+# writes that bypass save_data (e.g. restoring a backup) still change the version.
+@st.cache_resource
+def get_data_versions():
+    return {'counters': {}, 'lock': threading.Lock()}
+
+def bump_data_version(file):
+    versions = get_data_versions()
+    with versions['lock']:
+        versions['counters'][file] = versions['counters'].get(file, 0) + 1
+    get_report_cache().invalidate(file)
+
+def get_data_version(file):
+    counter = get_data_versions()['counters'].get(file, 0)
+    try:
+        mtime = os.stat(file).st_mtime_ns
+    except OSError:
+        mtime = 0
+    return (counter, mtime)
+
+@st.cache_resource
+def get_settings_cache():
+    return {'version': None, 'settings': {}}
+
+def get_settings():
+    # Shared read-only copy; code that changes settings must load_data() its own
+    cache = get_settings_cache()
+    version = get_data_version(SETTINGS_FILE)
+    if cache['version'] != version:
+        cache['settings'] = load_data(SETTINGS_FILE)
+        cache['version'] = version
+    return cache['settings']
+
+# Report result cache
+def estimate_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+class ReportCache:
+    def __init__(self, max_bytes=REPORT_CACHE_MAX_BYTES, max_entries=REPORT_CACHE_MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (value, size, deps)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, deps):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return  # Too large to be worth caching
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size, frozenset(deps))
+            self.total_bytes += size
+            # Evict least recently used entries until within budget
+            while self.entries and (self.total_bytes > self.max_bytes or len(self.entries) > self.max_entries):
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def invalidate(self, file):
+        with self.lock:
+            stale_keys = [k for k, (_, _, deps) in self.entries.items() if file in deps]
+            for key in stale_keys:
+                self.total_bytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+@st.cache_resource
+def get_report_cache():
+    return ReportCache()
+
+_CACHE_MISS = object()
+
+def report_cache_key(report_type, params, deps):
+    return (report_type, params, tuple((file, get_data_version(file)) for file in deps))
+
+def peek_cached_report(report_type, params, deps):
+    return get_report_cache().get(report_cache_key(report_type, params, deps), _CACHE_MISS)
+
+def cached_report(report_type, params, deps, compute):
+    cache = get_report_cache()
+    key = report_cache_key(report_type, params, deps)
+    result = cache.get(key, _CACHE_MISS)
+    if result is _CACHE_MISS:
+        result = compute()
+        cache.put(key, result, deps)
+    return result
+
+# Background jobs
+# Heavy reports and exports run on a worker thread so the script thread never blocks.
+# Job functions must not call st.* - they report through job.update() and write
+# their output under JOBS_DIR, returning the file path for download.
+class JobCancelled(Exception):
+    pass
+
+class BackgroundJob:
+    def __init__(self, job_id, name, owner, file_name=None, mime="text/csv"):
+        self.job_id = job_id
+        self.name = name
+        self.owner = owner
+        self.file_name = file_name
+        self.mime = mime
+        self.status = 'queued'  # queued, running, completed, failed, cancelled
+        self.progress = 0.0
+        self.message = ""
+        self.result_path = None
+        self.error = None
+        self.created_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.params = None
+
+    def update(self, progress, message=""):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+        self.progress = min(max(progress, 0.0), 1.0)
+        if message:
+            self.message = message
+
+    def output_path(self):
+        return os.path.join(JOBS_DIR, f"{self.job_id}_{self.file_name or 'result'}")
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'name': self.name,
+            'owner': self.owner,
+            'file_name': self.file_name,
+            'mime': self.mime,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'result_path': self.result_path,
+            'error': self.error,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['job_id'], data['name'], data.get('owner'), data.get('file_name'), data.get('mime', "text/csv"))
+        for field in ['status', 'progress', 'message', 'result_path', 'error', 'created_at', 'finished_at']:
+            setattr(job, field, data.get(field))
+        return job
+
+class JobRunner:
+    def __init__(self, max_workers=JOB_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pos-job")
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        
+        # Finished jobs from previous runs stay available for download
+        for job_id, data in load_data(JOBS_FILE).items():
+            if data.get('status') in ['completed', 'failed', 'cancelled']:
+                self.jobs[job_id] = BackgroundJob.from_dict(data)
+
+    def submit(self, name, func, *args, owner=None, file_name=None, mime="text/csv", params=None, **kwargs):
+        job = BackgroundJob(generate_short_id(), name, owner, file_name, mime)
+        job.params = params
+        with self.lock:
+            self.jobs[job.job_id] = job
+        self.executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        if job.cancel_event.is_set():
+            job.status = 'cancelled'
+            self._finish(job)
+            return
+        
+        job.status = 'running'
+        try:
+            job.result_path = func(job, *args, **kwargs)
+            job.progress = 1.0
+            job.status = 'completed'
+        except JobCancelled:
+            job.status = 'cancelled'
+            job.message = "Cancelled"
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+        self._finish(job)
+
+    def _finish(self, job):
+        job.finished_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if job.status != 'completed' and job.result_path is None and os.path.exists(job.output_path()):
+            try:
+                os.remove(job.output_path())
+            except OSError:
+                pass
+        
+        with self.lock:
+            # Drop the oldest finished jobs and their files beyond the history limit
+            finished = [j for j in self.jobs.values() if j.finished_at]
+            for old_job in finished[:max(0, len(finished) - JOB_HISTORY_LIMIT)]:
+                if old_job.result_path and os.path.exists(old_job.result_path):
+                    try:
+                        os.remove(old_job.result_path)
+                    except OSError:
+                        pass
+                del self.jobs[old_job.job_id]
+            
+            save_data({j.job_id: j.to_dict() for j in self.jobs.values() if j.finished_at}, JOBS_FILE)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job and job.status in ['queued', 'running']:
+            job.cancel_event.set()
+            job.message = "Cancelling..."
+            return True
+        return False
+
+    def find_active(self, name, params):
+        for job in self.jobs.values():
+            if job.name == name and job.params == params and job.status in ['queued', 'running']:
+                return job
+        return None
+
+    def list_jobs(self, owner=None):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        if owner is not None:
+            jobs = [j for j in jobs if j.owner == owner]
+        return list(reversed(jobs))
+
+@st.cache_resource
+def get_job_runner():
+    return JobRunner()
+
+def render_jobs_panel(owner, key_prefix="jobs"):
+    runner = get_job_runner()
+    jobs = runner.list_jobs(owner)
+    
+    if not jobs:
+        st.info("No background jobs")
+        return
+    
+    for job in jobs:
+        with st.container():
+            col1, col2, col3 = st.columns([4, 3, 2])
+            with col1:
+                st.write(f"**{job.name}**")
+                st.caption(f"Started {job.created_at}" + (f" - finished {job.finished_at}" if job.finished_at else ""))
+            with col2:
+                if job.status in ['queued', 'running']:
+                    st.progress(job.progress, text=job.message or job.status.title())
+                elif job.status == 'failed':
+                    st.error(f"Failed: {job.error}")
+                else:
+                    st.write(f"Status: {job.status.title()}")
+                    if job.message and job.status == 'completed':
+                        st.caption(job.message)
+            with col3:
+                if job.status in ['queued', 'running']:
+                    if st.button("Cancel", key=f"{key_prefix}_cancel_{job.job_id}"):
+                        runner.cancel(job.job_id)
+                        st.rerun()
+                elif job.status == 'completed' and job.result_path and os.path.exists(job.result_path):
+                    with open(job.result_path, 'rb') as f:
+                        st.download_button(
+                            label="Download",
+                            data=f,
+                            file_name=job.file_name or os.path.basename(job.result_path),
+                            mime=job.mime,
+                            key=f"{key_prefix}_download_{job.job_id}"
+                        )
+    
+    # Status is refreshed on demand: a rerun loop would hold the script thread and
+    # recompute the rest of the page every second while a job runs
+    if st.button("Refresh Status", key=f"{key_prefix}_refresh"):
+        st.rerun()
+    if any(j.status in ['queued', 'running'] for j in jobs):
+        st.caption("Jobs keep running if you leave this page. Refresh to update their progress.")
+
+# Streaming exports
+# Exports are produced from row generators and written to a file on disk in
+# chunks, so no DataFrame or full CSV string is built for them. The source data
+# is still loaded whole, and st.download_button reads the finished file into
+# memory to serve it, so large exports belong in a background job. Excel output
+# needs openpyxl, which is optional - without it only CSV is offered.
+def excel_export_available():
+    try:
+        import openpyxl
+        return True
+    except ImportError:
+        return False
+
+def available_export_formats():
+    return [name for name in EXPORT_FORMATS if name != "Excel" or excel_export_available()]
+
+def iter_csv_chunks(header, rows, chunk_rows=EXPORT_CHUNK_ROWS):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for index, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if index % chunk_rows == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def write_export(f, header, rows, export_format="CSV"):
+    if export_format == "Excel":
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("Export")
+        sheet.append(list(header))
+        for row in rows:
+            sheet.append(list(row))
+        workbook.save(f)
+    else:
+        for chunk in iter_csv_chunks(header, rows):
+            f.write(chunk)
+
+def export_file_name(base_name, export_format="CSV"):
+    return f"{base_name}.{EXPORT_FORMATS[export_format][0]}"
+
+def file_download_button(label, header, rows, base_name, export_format="CSV", key=None):
+    extension, mime = EXPORT_FORMATS[export_format]
+    fd, path = tempfile.mkstemp(suffix=f".{extension}", dir=JOBS_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_export(f, header, rows, export_format)
+        with open(path, 'rb') as f:
+            st.download_button(
+                label=label,
+                data=f,
+                file_name=export_file_name(base_name, export_format),
+                mime=mime,
+                key=key
+            )
+    finally:
+        os.remove(path)
+
+# Parallel aggregation
+# Historical rebuilds split their input into independent partitions (e.g. one per
+# month), aggregate each partition in a separate process and merge the partial
+# results. Workers are forked so they inherit the partitions from the parent and
+# only the (small) partial aggregates are pickled back. Where fork is not
+# available the partitions are aggregated serially.
+def get_fork_context():
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context("fork")
+
+def _aggregate_partition_group(func, partitions, keys, results):
+    for key in keys:
+        try:
+            results.put((key, func(key, partitions[key]), None))
+        except Exception as e:
+            results.put((key, None, str(e)))
+
+def parallel_map_partitions(func, partitions, workers=None, progress=None):
+    keys = list(partitions.keys())
+    if not keys:
+        return []
+    
+    workers = min(workers or PARALLEL_WORKERS, len(keys))
+    context = get_fork_context()
+    
+    if workers <= 1 or context is None:
+        outputs = []
+        for index, key in enumerate(keys):
+            outputs.append(func(key, partitions[key]))
+            if progress:
+                progress((index + 1) / len(keys))
+        return outputs
+    
+    # Largest partitions first, dealt round-robin, keeps the workers evenly loaded
+    keys.sort(key=lambda k: len(partitions[k]), reverse=True)
+    results = context.Queue()
+    processes = [
+        context.Process(target=_aggregate_partition_group,
+                        args=(func, partitions, keys[i::workers], results), daemon=True)
+        for i in range(workers)
+    ]
+    
+    outputs = []
+    try:
+        for process in processes:
+            process.start()
+        
+        # Drain the queue before joining so workers never block on a full pipe
+        while len(outputs) < len(keys):
+            try:
+                key, output, error = results.get(timeout=1)
+            except Empty:
+                if not any(process.is_alive() for process in processes) and results.empty():
+                    raise RuntimeError("Aggregation worker exited without returning results")
+                continue
+            if error:
+                raise RuntimeError(f"Aggregation of partition {key} failed: {error}")
+            outputs.append(output)
+            if progress:
+                progress(len(outputs) / len(keys))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        results.close()
+    
+    return outputs
+
 # Purchase Order functions
 def generate_purchase_order(supplier_id, items):
     suppliers = load_data(SUPPLIERS_FILE)
@@ -395,10 +965,10 @@ def generate_purchase_order(supplier_id, items):
     po_id = generate_short_id()
     
     # Calculate totals
-    total_cost = 0
+    total_cost_cents = 0
     for item in items:
         product = products.get(item['barcode'], {})
-        total_cost += item['quantity'] * product.get('cost', 0)
+        total_cost_cents += item['quantity'] * to_cents(product.get('cost', 0))
     
     # Create PO
     purchase_orders[po_id] = {
@@ -407,8 +977,9 @@ def generate_purchase_order(supplier_id, items):
         'supplier_name': supplier['name'],
         'date_created': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
         'created_by': st.session_state.user_info['username'],
-        'items': items,
-        'total_cost': total_cost,
+        'items': [with_cents(dict(item), ['cost']) for item in items],
+        'total_cost': from_cents(total_cost_cents),
+        'total_cost_cents': total_cost_cents,
         'status': 'pending',
         'date_received': None,
         'received_by': None
@@ -441,10 +1012,10 @@ def generate_po_report(po_id):
         product = products.get(item['barcode'], {'name': 'Unknown', 'cost': 0})
         report += f"{item['barcode']}\t{product['name']}\t{item['quantity']}\t"
         report += f"{format_currency(product.get('cost', 0))}\t"
-        report += f"{format_currency(item['quantity'] * product.get('cost', 0))}\n"
+        report += f"{format_cents(item['quantity'] * to_cents(product.get('cost', 0)))}\n"
     
     report += "=" * 50 + "\n"
-    report += f"TOTAL COST: {format_currency(po['total_cost'])}\n"
+    report += f"TOTAL COST: {format_cents(cents_of(po, 'total_cost'))}\n"
     report += f"STATUS: {po['status'].upper()}\n"
     
     if po['status'] == 'received':
@@ -453,44 +1024,798 @@ def generate_po_report(po_id):
     return report
 
 def process_received_po(po_id):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    inventory = load_data(INVENTORY_FILE)
+    with get_inventory_lock():
+        purchase_orders = load_data(PURCHASE_ORDERS_FILE)
+        inventory = load_data(INVENTORY_FILE)
     
-    if po_id not in purchase_orders:
-        return False
+        if po_id not in purchase_orders:
+            return False
     
-    po = purchase_orders[po_id]
+        po = purchase_orders[po_id]
     
-    if po['status'] == 'received':
-        return True  # Already processed
+        if po['status'] == 'received':
+            return True  # Already processed
     
-    # Update inventory
-    for item in po['items']:
-        barcode = item['barcode']
-        quantity = item['quantity']
+        # Update inventory
+        movements = []
+        for item in po['items']:
+            barcode = item['barcode']
+            quantity = item['quantity']
+            previous_qty = inventory.get(barcode, {}).get('quantity', 0)
         
-        if barcode in inventory:
-            inventory[barcode]['quantity'] += quantity
-        else:
-            inventory[barcode] = {'quantity': quantity, 'reorder_point': 10}
+            if barcode in inventory:
+                inventory[barcode]['quantity'] += quantity
+            else:
+                inventory[barcode] = {'quantity': quantity, 'reorder_point': 10}
         
-        inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-        inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+            movements.append(stock_movement(barcode, 'Receipt', previous_qty, inventory[barcode]['quantity'],
+                                            reference=po_id, user=st.session_state.user_info['username'],
+                                            unit_cost_cents=cents_of(item, 'cost')))
     
-    # Update PO status
-    po['status'] = 'received'
-    po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-    po['received_by'] = st.session_state.user_info['username']
+        # Update PO status
+        po['status'] = 'received'
+        po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+        po['received_by'] = st.session_state.user_info['username']
     
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    save_data(inventory, INVENTORY_FILE)
-    return True
+        save_data(purchase_orders, PURCHASE_ORDERS_FILE)
+        save_data(inventory, INVENTORY_FILE)
+        record_stock_movements(movements)
+        return True
+
+# Shopping cart
+# The cart is a dict of barcode -> line, so existing readers keep working, but it
+# must only be changed through add/set_quantity/remove. Those keep the subtotal
+# running and bump a version, and price() reuses the last result and the per-line
+# offer allocations for lines that did not change.
+class Cart(dict):
+    def __init__(self, items=None):
+        super().__init__()
+        self.subtotal_cents = 0
+        self.version = 0
+        # Identifies this sale across reruns and retried clicks; see checkout_key
+        self._key_base = str(uuid.uuid4())
+        self._engine = None
+        self._day = None
+        self._allocations = {}
+        self._priced = None
+        for barcode, item in (items or {}).items():
+            self[barcode] = dict(item, price_cents=cents_of(item, 'price'))
+            self.subtotal_cents += self[barcode]['price_cents'] * item['quantity']
+
+    @property
+    def checkout_key(self):
+        # Includes the version, so any change to the cart (even after a sale was
+        # committed but before the cart was reset) makes it a new sale
+        return f"{self._key_base}:{self.version}"
+
+    def _changed(self):
+        self.version += 1
+        self._priced = None
+
+    def add(self, barcode, product, quantity=1):
+        if barcode in self:
+            self[barcode]['quantity'] += quantity
+        else:
+            self[barcode] = {
+                'name': product['name'],
+                'price': product['price'],
+                'price_cents': to_cents(product['price']),
+                'quantity': quantity,
+                'description': product.get('description', ''),
+                'brand': product.get('brand')
+            }
+        self.subtotal_cents += self[barcode]['price_cents'] * quantity
+        self._changed()
+
+    def set_quantity(self, barcode, quantity):
+        line = self[barcode]
+        self.subtotal_cents += line['price_cents'] * (quantity - line['quantity'])
+        line['quantity'] = quantity
+        self._changed()
+
+    def remove(self, barcode):
+        line = self.pop(barcode)
+        self.subtotal_cents -= line['price_cents'] * line['quantity']
+        self._allocations.pop(barcode, None)
+        self._changed()
+
+    def lines(self):
+        return {barcode: (line['price_cents'], line['quantity']) for barcode, line in self.items()}
+
+    def price(self, engine, tax_rate, discount_id=None, day=None):
+        day = day or get_current_datetime().date()
+        key = (self.version, tax_rate, discount_id, day)
+        if self._priced and self._priced[0] == key and self._engine is engine:
+            return self._priced[1]
+        
+        if self._engine is not engine or self._day != day:
+            self._engine, self._day, self._allocations = engine, day, {}
+        
+        lines = self.lines()
+        allocations = {}
+        for barcode, (price_cents, quantity) in lines.items():
+            cached = self._allocations.get(barcode)
+            if cached is None or cached[0] != (price_cents, quantity):
+                cached = ((price_cents, quantity), engine.line_allocation(barcode, price_cents, quantity, day))
+                self._allocations[barcode] = cached
+            allocations[barcode] = cached[1]
+        
+        pricing = engine.price_cart(lines, tax_rate, discount_id, day,
+                                    allocations=allocations, subtotal_cents=self.subtotal_cents)
+        self._priced = (key, pricing)
+        return pricing
+
+def ensure_cart(key='cart'):
+    # Carts saved by older sessions are plain dicts; the class is redefined on each
+    # rerun, so check for the interface rather than using isinstance
+    cart = st.session_state.get(key)
+    if cart is None or not hasattr(cart, 'checkout_key'):
+        st.session_state[key] = Cart(cart)
+    return st.session_state[key]
+
+# Stock movement ledger
+# Every change to a stock level (sale, return, receipt, adjustment, transfer, count)
+# is appended as one JSON line to STOCK_LEDGER_FILE; INVENTORY_FILE only holds the
+# current levels. An in-memory index maps each barcode to the (date, byte offset) of
+# its movements in time order, and is extended with whatever was appended since it
+# was last read, so a product's history is read with a few seeks.
+def stock_movement(barcode, movement_type, previous_qty, new_qty, quantity=None, reference=None,
+                   notes="", user=None, date=None, unit_cost_cents=None):
+    movement = {
+        'barcode': barcode,
+        'date': date or get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+        'type': movement_type,
+        'quantity': abs(new_qty - previous_qty) if quantity is None else quantity,
+        'change': new_qty - previous_qty,
+        'previous_qty': previous_qty,
+        'new_qty': new_qty,
+        'reference': reference,
+        'notes': notes,
+        'user': user
+    }
+    if unit_cost_cents is not None:
+        # Purchase cost of incoming stock; other inflows are valued at the running cost
+        movement['unit_cost_cents'] = unit_cost_cents
+    return movement
+
+class StockLedger:
+    def __init__(self, path=STOCK_LEDGER_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = {}
+        self.size = 0
+        self.inode = None
+
+    def _catch_up(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.index, self.size, self.inode = {}, 0, None
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.size:
+            # Replaced, e.g. by restoring a backup
+            self.index, self.size, self.inode = {}, 0, stat.st_ino
+        if stat.st_size == self.size:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.size)
+            offset = self.size
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # partially written line, picked up next time
+                try:
+                    movement = json.loads(line)
+                    # Kept sorted by date for history(); lines can arrive out of date
+                    # order, e.g. adjustments migrated after live movements
+                    bisect.insort(self.index.setdefault(movement['barcode'], []), (movement['date'], offset))
+                except (ValueError, KeyError):
+                    pass
+                offset += len(line)
+        self.size = offset
+
+    def append(self, movements):
+        if not movements:
+            return
+        data = "".join(json.dumps(movement) + "\n" for movement in movements).encode('utf-8')
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self._catch_up()
+
+    def history(self, barcode, start=None, end=None):
+        # start/end are "YYYY-MM-DD" or full timestamps; both ends inclusive
+        with self.lock:
+            self._catch_up()
+            entries = self.index.get(barcode, [])
+            lo = bisect.bisect_left(entries, (start,)) if start else 0
+            hi = bisect.bisect_right(entries, (end + "~",)) if end else len(entries)
+            offsets = [offset for _, offset in entries[lo:hi]]
+        movements = []
+        with open(self.path, 'rb') as f:
+            for offset in offsets:
+                f.seek(offset)
+                movements.append(json.loads(f.readline()))
+        return movements
+
+    def barcodes(self):
+        with self.lock:
+            self._catch_up()
+            return list(self.index.keys())
+
+@st.cache_resource
+def get_stock_ledger():
+    return StockLedger()
+
+def record_stock_movements(movements):
+    if movements:
+        get_inventory_valuation().apply(movements)
+    get_stock_ledger().append(movements)
+
+@st.cache_resource
+def migrate_stock_adjustments():
+    # Moves adjustment lists kept inside INVENTORY_FILE into the ledger, once per process
+    with get_inventory_lock():
+        inventory = load_data(INVENTORY_FILE)
+        movements = []
+        for barcode, item in inventory.items():
+            for adjustment in item.pop('adjustments', None) or []:
+                previous_qty = adjustment.get('previous_qty', 0)
+                new_qty = adjustment.get('new_qty', previous_qty)
+                movements.append(stock_movement(
+                    barcode, adjustment.get('type', 'Adjustment'), previous_qty, new_qty,
+                    quantity=adjustment.get('quantity'), notes=adjustment.get('notes', ''),
+                    user=adjustment.get('user'), date=adjustment.get('date', '')
+                ))
+        if not movements:
+            return 0
+        movements.sort(key=lambda m: m['date'])
+        # History only: these changes are already reflected in the stock being valued
+        get_stock_ledger().append(movements)
+        save_data(inventory, INVENTORY_FILE)
+        return len(movements)
+
+# Inventory valuation
+# Every movement passed to record_stock_movements() also updates a running valuation
+# in VALUATION_FILE, kept per barcode both as a weighted-average cost (quantity and
+# total value in cents) and as FIFO cost layers. Receipts come in at their purchase
+# cost and other inflows (returns, count corrections) at the current average; outflows
+# are costed at the average and by consuming the oldest layers. Sales, deliveries and
+# their returns add to the day's COGS, and the closing value of each day is kept, so
+# totals are read without touching the inventory. Stock on hand when valuation starts
+# is opened at the product's cost, and a movement whose previous quantity disagrees
+# with the valuation (stock written outside the ledger) is reconciled first.
+def new_valuation_entry(quantity, unit_cost_cents):
+    stocked = max(quantity, 0)
+    return {
+        'quantity': quantity,
+        'value_cents': stocked * unit_cost_cents,
+        'unit_cost_cents': unit_cost_cents,
+        'layers': [[stocked, unit_cost_cents]] if stocked else []
+    }
+
+class InventoryValuation:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self._load()
+
+    def _load(self):
+        state = load_data(VALUATION_FILE)
+        if not state:
+            products = load_data(PRODUCTS_FILE)
+            state = {
+                'opened_at': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+                'skus': {barcode: new_valuation_entry(item.get('quantity', 0),
+                                                      to_cents(products.get(barcode, {}).get('cost', 0)))
+                         for barcode, item in load_data(INVENTORY_FILE).items()}
+            }
+        self.opened_at = state.get('opened_at')
+        self.skus = state['skus']
+        self.cogs = state.get('cogs', {})
+        self.daily = state.get('daily', {})
+        self.value_cents = sum(sku['value_cents'] for sku in self.skus.values())
+        self.fifo_value_cents = sum(qty * cost for sku in self.skus.values() for qty, cost in sku['layers'])
+        if not os.path.exists(VALUATION_FILE):
+            self._save()
+        self.version = get_data_version(VALUATION_FILE)
+
+    def _save(self):
+        self.daily[get_current_datetime().strftime("%Y-%m-%d")] = [self.value_cents, self.fifo_value_cents]
+        save_data({'opened_at': self.opened_at, 'skus': self.skus, 'cogs': self.cogs, 'daily': self.daily},
+                  VALUATION_FILE)
+        self.version = get_data_version(VALUATION_FILE)
+
+    def _refresh(self):
+        # Picks up a replaced file, e.g. a restored backup
+        if self.version != get_data_version(VALUATION_FILE):
+            self._load()
+
+    def _receive(self, sku, units, unit_cost_cents):
+        # Units covering negative stock were already costed when they went out
+        stocked = units - min(units, max(-sku['quantity'], 0))
+        value = stocked * unit_cost_cents
+        if stocked:
+            sku['layers'].append([stocked, unit_cost_cents])
+        sku['quantity'] += units
+        sku['value_cents'] += value
+        if sku['quantity'] > 0:
+            sku['unit_cost_cents'] = round(sku['value_cents'] / sku['quantity'])
+        self.value_cents += value
+        self.fifo_value_cents += value
+        return value, value
+
+    def _issue(self, sku, units):
+        on_hand = min(units, max(sku['quantity'], 0))
+        if on_hand == sku['quantity']:
+            average = sku['value_cents']
+        else:
+            average = round(sku['value_cents'] * on_hand / sku['quantity'])
+        fifo = 0
+        remaining = units
+        layers = sku['layers']
+        while remaining and layers:
+            taken = min(remaining, layers[0][0])
+            fifo += taken * layers[0][1]
+            layers[0][0] -= taken
+            remaining -= taken
+            if not layers[0][0]:
+                layers.pop(0)
+        sku['quantity'] -= units
+        sku['value_cents'] -= average
+        self.value_cents -= average
+        self.fifo_value_cents -= fifo
+        # Units beyond stock on hand are costed at the last average cost
+        shortfall = (units - on_hand) * sku['unit_cost_cents']
+        return -(average + shortfall), -(fifo + remaining * sku['unit_cost_cents'])
+
+    def _move(self, sku, change, unit_cost_cents=None):
+        if change > 0:
+            return self._receive(sku, change, sku['unit_cost_cents'] if unit_cost_cents is None else unit_cost_cents)
+        if change < 0:
+            return self._issue(sku, -change)
+        return 0, 0
+
+    def apply(self, movements):
+        # Annotates each movement with its value change (average cost, cents)
+        with self.lock:
+            self._refresh()
+            products = None
+            for movement in movements:
+                barcode = movement['barcode']
+                sku = self.skus.get(barcode)
+                if sku is None:
+                    unit_cost_cents = movement.get('unit_cost_cents')
+                    if unit_cost_cents is None:
+                        products = products if products is not None else load_data(PRODUCTS_FILE)
+                        unit_cost_cents = to_cents(products.get(barcode, {}).get('cost', 0))
+                    sku = self.skus[barcode] = new_valuation_entry(0, unit_cost_cents)
+                
+                drift = movement['previous_qty'] - sku['quantity']
+                if drift:
+                    self._move(sku, drift)
+                average, fifo = self._move(sku, movement['change'], movement.get('unit_cost_cents'))
+                movement['value_change_cents'] = average
+                
+                if movement['type'] in COGS_MOVEMENT_TYPES:
+                    day = self.cogs.setdefault(movement['date'][:10], [0, 0, 0])
+                    day[0] -= average
+                    day[1] -= fifo
+                    day[2] -= movement['change']
+            self._save()
+
+    def totals(self, method="Weighted Average"):
+        with self.lock:
+            self._refresh()
+            return self.fifo_value_cents if method == "FIFO" else self.value_cents
+
+    def cogs_between(self, start, end, method="Weighted Average"):
+        # (COGS cents, units) for "YYYY-MM-DD" days, both ends inclusive
+        column = 1 if method == "FIFO" else 0
+        with self.lock:
+            self._refresh()
+            days = [values for day, values in self.cogs.items() if start <= day <= end]
+        return sum(values[column] for values in days), sum(values[2] for values in days)
+
+    def value_on(self, day, method="Weighted Average"):
+        # Closing value of the last day with activity on or before day
+        with self.lock:
+            self._refresh()
+            days = sorted(self.daily)
+            i = bisect.bisect_right(days, day)
+            return self.daily[days[i - 1]][1 if method == "FIFO" else 0] if i else None
+
+    def frame(self):
+        with self.lock:
+            self._refresh()
+            rows = [(barcode, sku['quantity'], sku['unit_cost_cents'], sku['value_cents'],
+                     sum(qty * cost for qty, cost in sku['layers']))
+                    for barcode, sku in self.skus.items()]
+        return pd.DataFrame(rows, columns=['barcode', 'quantity', 'unit_cost_cents', 'value_cents',
+                                           'fifo_value_cents'])
+
+@st.cache_resource
+def get_inventory_valuation():
+    return InventoryValuation()
+
+def stock_value_frame(products, method="Weighted Average"):
+    # Valued stock per product, most valuable first
+    def compute():
+        frame = get_inventory_valuation().frame()
+        # Deleted products are kept in the valuation once written off to zero
+        frame = frame[frame['barcode'].isin(products) | (frame['quantity'] != 0)].copy()
+        frame['product'] = [products.get(b, {}).get('name', 'Unknown') for b in frame['barcode']]
+        frame['category'] = [products.get(b, {}).get('category', 'Unknown') for b in frame['barcode']]
+        value_cents = frame['fifo_value_cents'] if method == "FIFO" else frame['value_cents']
+        frame['unit_cost'] = frame['unit_cost_cents'] / MONEY_SCALE
+        frame['total_value'] = value_cents / MONEY_SCALE
+        frame = frame[['product', 'barcode', 'category', 'quantity', 'unit_cost', 'total_value']]
+        return frame.sort_values('total_value', ascending=False, ignore_index=True)
+    return cached_report("Stock Value", (method,), (VALUATION_FILE, PRODUCTS_FILE), compute)
+
+def stock_value_summary(key):
+    # Totals and COGS for the chosen method; returns the method for the detail table
+    valuation = get_inventory_valuation()
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        method = st.radio("Valuation Method", VALUATION_METHODS, horizontal=True, key=f"{key}_method")
+    with col2:
+        start_date = st.date_input("COGS From", value=datetime.date.today() - datetime.timedelta(days=30),
+                                   key=f"{key}_start")
+    with col3:
+        end_date = st.date_input("COGS To", value=datetime.date.today(), key=f"{key}_end")
+    
+    cogs_cents, units = valuation.cogs_between(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"), method)
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Total Inventory Value", format_cents(valuation.totals(method)))
+    col2.metric("Cost of Goods Sold", format_cents(cogs_cents))
+    col3.metric("Units Sold", units)
+    if valuation.opened_at:
+        st.caption(f"Valuation running since {valuation.opened_at}; stock on hand then was opened at product cost")
+    return method
+
+# Low stock tracking
+# The set of items below their reorder point is kept in LOW_STOCK_FILE and synced
+# on every save of INVENTORY_FILE, so views read the list instead of scanning the
+# inventory. Items entering the set raise a 'below' alert and leaving it a
+# 'restocked' one; alerts carry an increasing sequence number so each session
+# can be notified of the ones it has not seen. Writes that bypass save_data
+# (e.g. restoring a backup) are picked up through the file's data version.
+class LowStockTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        state = load_data(LOW_STOCK_FILE)
+        self.items = state.get('items', {})
+        self.alerts = state.get('alerts', [])
+        self.seq = state.get('seq', 0)
+        self.version = None
+        seeded = bool(state)
+        self.sync(load_data(INVENTORY_FILE), alert=seeded)
+
+    def sync(self, inventory, alert=True):
+        with self.lock:
+            now = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+            low = {}
+            for barcode, item in inventory.items():
+                quantity = item.get('quantity', 0)
+                reorder_point = item.get('reorder_point', 10)
+                if quantity < reorder_point:
+                    previous = self.items.get(barcode)
+                    low[barcode] = {
+                        'quantity': quantity,
+                        'reorder_point': reorder_point,
+                        'since': previous['since'] if previous else now
+                    }
+            
+            changed = low != self.items
+            if alert:
+                for barcode in low.keys() - self.items.keys():
+                    self._alert('below', barcode, low[barcode], now)
+                for barcode in self.items.keys() - low.keys():
+                    self._alert('restocked', barcode, inventory.get(barcode, {}), now)
+            self.items = low
+            if changed or not os.path.exists(LOW_STOCK_FILE):
+                save_data({'items': self.items, 'alerts': self.alerts, 'seq': self.seq}, LOW_STOCK_FILE)
+            self.version = get_data_version(INVENTORY_FILE)
+
+    def _alert(self, kind, barcode, item, now):
+        self.seq += 1
+        self.alerts.append({
+            'seq': self.seq,
+            'date': now,
+            'type': kind,
+            'barcode': barcode,
+            'quantity': item.get('quantity', 0),
+            'reorder_point': item.get('reorder_point', 10)
+        })
+        del self.alerts[:-LOW_STOCK_ALERT_LIMIT]
+
+    def _refresh(self):
+        if self.version != get_data_version(INVENTORY_FILE):
+            self.sync(load_data(INVENTORY_FILE))
+
+    def low_stock(self):
+        self._refresh()
+        return dict(self.items)
+
+    def is_low(self, barcode):
+        self._refresh()
+        return barcode in self.items
+
+    def alerts_since(self, seq, kinds=('below',)):
+        self._refresh()
+        return [a for a in self.alerts if a['seq'] > seq and a['type'] in kinds]
+
+@st.cache_resource
+def get_low_stock_tracker():
+    return LowStockTracker()
+
+def low_stock_frame(products):
+    # Current low-stock items with product details, most urgent first
+    items = get_low_stock_tracker().low_stock()
+    frame = pd.DataFrame(
+        [(barcode, products.get(barcode, {}).get('name', 'Unknown'), item['quantity'], item['reorder_point'],
+          products.get(barcode, {}).get('cost', 0), item['since']) for barcode, item in items.items()],
+        columns=['barcode', 'name', 'quantity', 'reorder_point', 'cost', 'since']
+    )
+    frame['needed'] = (frame['reorder_point'] - frame['quantity']).clip(lower=0)
+    return frame.sort_values('needed', ascending=False)
+
+def notify_low_stock_alerts():
+    # Toast new below-reorder-point alerts once per session
+    tracker = get_low_stock_tracker()
+    seen = st.session_state.get('low_stock_seen_seq')
+    if seen is None:
+        st.session_state.low_stock_seen_seq = tracker.seq
+        return
+    alerts = tracker.alerts_since(seen)
+    if alerts:
+        products = load_data(PRODUCTS_FILE)
+        for alert in alerts[-5:]:
+            name = products.get(alert['barcode'], {}).get('name', alert['barcode'])
+            st.toast(f"Low stock: {name} ({alert['quantity']} left, reorder point {alert['reorder_point']})", icon="⚠️")
+        if len(alerts) > 5:
+            st.toast(f"{len(alerts) - 5} more items fell below their reorder point", icon="⚠️")
+    st.session_state.low_stock_seen_seq = tracker.seq
+
+# Checkout commit
+# Sales are committed under the process-wide inventory lock and recorded against
+# the cart's idempotency key. A retry with a key that was already committed (double
+# click, rerun part-way through checkout) returns the original transaction instead
+# of recording the sale and moving stock a second time. All lines are checked
+# against live stock in one pass before anything is written, so concurrent lanes
+# cannot oversell.
+class InsufficientStock(Exception):
+    def __init__(self, shortages):
+        super().__init__(", ".join(f"{s['name']} ({s['available']} of {s['requested']})" for s in shortages))
+        self.shortages = shortages
+
+@st.cache_resource
+def get_inventory_lock():
+    return threading.RLock()
+
+@st.cache_resource
+def get_file_lock(file):
+    # One lock per data file, shared by the page scripts and the scheduler thread
+    return threading.RLock()
+
+def update_records(file, updates=None, removed=()):
+    # Writes edited records over the current file under its lock, so records
+    # changed elsewhere since the page loaded the file are kept
+    with get_file_lock(file):
+        records = load_data(file)
+        records.update(updates or {})
+        for record_id in removed:
+            records.pop(record_id, None)
+        save_data(records, file)
+    return records
+
+@st.cache_resource
+def get_checkout_index():
+    return {'keys': OrderedDict(load_data(CHECKOUT_KEYS_FILE))}
+
+def reserve_stock(inventory, items):
+    shortages = []
+    for barcode, item in items.items():
+        available = inventory.get(barcode, {}).get('quantity', 0)
+        if item['quantity'] > available:
+            shortages.append({
+                'barcode': barcode,
+                'name': item.get('name', barcode),
+                'requested': item['quantity'],
+                'available': max(available, 0)
+            })
+    if shortages:
+        raise InsufficientStock(shortages)
+    
+    for barcode, item in items.items():
+        inventory[barcode]['quantity'] -= item['quantity']
+
+def commit_sale(idempotency_key, sale):
+    index = get_checkout_index()
+    with get_inventory_lock():
+        existing = index['keys'].get(idempotency_key)
+        if existing:
+            transaction = load_data(TRANSACTIONS_FILE).get(existing['transaction_id'])
+            if transaction:
+                return transaction, False
+        
+        inventory = load_data(INVENTORY_FILE)
+        reserve_stock(inventory, sale['items'])
+        
+        transactions = load_data(TRANSACTIONS_FILE)
+        transaction_id = generate_short_id()
+        transaction = dict(sale, transaction_id=transaction_id, idempotency_key=idempotency_key)
+        transactions[transaction_id] = transaction
+        
+        save_data(transactions, TRANSACTIONS_FILE)
+        save_data(inventory, INVENTORY_FILE)
+        record_stock_movements([
+            stock_movement(barcode, 'Sale', inventory[barcode]['quantity'] + item['quantity'],
+                           inventory[barcode]['quantity'], reference=transaction_id,
+                           user=transaction.get('cashier'), date=transaction['date'])
+            for barcode, item in sale['items'].items()
+        ])
+        
+        index['keys'][idempotency_key] = {'transaction_id': transaction_id, 'date': transaction['date']}
+        while len(index['keys']) > CHECKOUT_KEY_LIMIT:
+            index['keys'].popitem(last=False)
+        save_data(dict(index['keys']), CHECKOUT_KEYS_FILE)
+        
+        get_sales_counters().record(sale['items'], transaction['date'])
+        return transaction, True
+
+# Sales counters
+# Per-barcode units and revenue (cents), kept as lifetime totals, daily buckets and
+# running 7/30/90-day window sums, updated at checkout and return time. When the day
+# changes the buckets that fell out of each window are subtracted, so lookups never
+# scan transaction history. Hour-of-day buckets are kept for the last few weeks.
+class SalesCounters:
+    def __init__(self, data=None):
+        data = data or {}
+        self.lock = threading.RLock()
+        self.lifetime = data.get('lifetime', {})
+        self.days = data.get('days', {})
+        self.hours = data.get('hours', {})
+        self.windows = {int(n): totals for n, totals in data.get('windows', {}).items()}
+        for n in SALES_COUNTER_WINDOWS:
+            self.windows.setdefault(n, {})
+        self.as_of = data.get('as_of') or get_current_datetime().strftime("%Y-%m-%d")
+
+    def to_dict(self):
+        return {
+            'lifetime': self.lifetime,
+            'days': self.days,
+            'hours': self.hours,
+            'windows': {str(n): totals for n, totals in self.windows.items()},
+            'as_of': self.as_of,
+            'version': SALES_COUNTERS_VERSION
+        }
+
+    @staticmethod
+    def _add(bucket, barcode, values):
+        totals = bucket.setdefault(barcode, [0] * len(values))
+        for i, value in enumerate(values):
+            totals[i] += value
+        if not any(totals):
+            del bucket[barcode]
+
+    def _roll(self, today):
+        if today <= self.as_of:
+            return
+        as_of = datetime.datetime.strptime(self.as_of, "%Y-%m-%d").date()
+        new_day = datetime.datetime.strptime(today, "%Y-%m-%d").date()
+        
+        for n, totals in self.windows.items():
+            # Days in the window at as_of but not at today
+            first = as_of - timedelta(days=n - 1)
+            last = min(new_day - timedelta(days=n), as_of)
+            day = first
+            while day <= last:
+                for barcode, values in self.days.get(day.strftime("%Y-%m-%d"), {}).items():
+                    self._add(totals, barcode, [-v for v in values])
+                day += timedelta(days=1)
+        
+        oldest_day = (new_day - timedelta(days=max(SALES_COUNTER_WINDOWS) - 1)).strftime("%Y-%m-%d")
+        for day in [d for d in self.days if d < oldest_day]:
+            del self.days[day]
+        oldest_hour = (new_day - timedelta(days=SALES_COUNTER_HOURLY_DAYS - 1)).strftime("%Y-%m-%d")
+        for hour in [h for h in self.hours if h[:10] < oldest_hour]:
+            del self.hours[hour]
+        self.as_of = today
+
+    def _apply(self, items, when, sign):
+        # Returns are applied with the date of the original sale, so they cancel
+        # that sale in the buckets and windows it was counted in
+        day, hour = when[:10], when[:13]
+        as_of = datetime.datetime.strptime(self.as_of, "%Y-%m-%d").date()
+        age = (as_of - datetime.datetime.strptime(day, "%Y-%m-%d").date()).days
+        
+        for barcode, item in items.items():
+            units = sign * item['quantity']
+            revenue_cents = units * cents_of(item, 'price')
+            self._add(self.lifetime, barcode, [units, revenue_cents, 1 if sign > 0 else 0])
+            if age < max(SALES_COUNTER_WINDOWS):
+                self._add(self.days.setdefault(day, {}), barcode, [units, revenue_cents])
+            for n, totals in self.windows.items():
+                if 0 <= age < n:
+                    self._add(totals, barcode, [units, revenue_cents])
+            if age < SALES_COUNTER_HOURLY_DAYS:
+                self._add(self.hours.setdefault(hour, {}), barcode, [units])
+
+    def record(self, items, when, sign=1):
+        with self.lock:
+            self._roll(get_current_datetime().strftime("%Y-%m-%d"))
+            self._apply(items, when, sign)
+            save_data(self.to_dict(), SALES_COUNTERS_FILE)
+
+    def refresh(self):
+        with self.lock:
+            today = get_current_datetime().strftime("%Y-%m-%d")
+            if today > self.as_of:
+                self._roll(today)
+                save_data(self.to_dict(), SALES_COUNTERS_FILE)
+
+    def _totals(self, days):
+        self.refresh()
+        return self.lifetime if days is None else self.windows[days]
+
+    def units(self, barcode, days=None):
+        return self._totals(days).get(barcode, [0, 0])[0]
+
+    def revenue_cents(self, barcode, days=None):
+        return self._totals(days).get(barcode, [0, 0])[1]
+
+    def has_sales(self, barcode):
+        return self.lifetime.get(barcode, [0, 0, 0])[2] > 0
+
+    def velocity(self, barcode, days=30):
+        return self.units(barcode, days) / days
+
+    def top(self, n=10, days=30, by='units'):
+        column = 0 if by == 'units' else 1
+        totals = self._totals(days)
+        return heapq.nlargest(n, ((values[column], barcode) for barcode, values in totals.items() if values[column] > 0))
+
+    def hourly_units(self, hour):
+        # Units per barcode sold in this hour of the day over the hourly history
+        units = {}
+        suffix = f" {hour:02d}"
+        with self.lock:
+            for key, bucket in self.hours.items():
+                if key.endswith(suffix):
+                    for barcode, values in bucket.items():
+                        units[barcode] = units.get(barcode, 0) + values[0]
+        return units
+
+def rebuild_sales_counters():
+    counters = SalesCounters({'as_of': get_current_datetime().strftime("%Y-%m-%d")})
+    for t in load_data(TRANSACTIONS_FILE).values():
+        if t.get('items') and t.get('date'):
+            counters._apply(t['items'], t['date'], 1)
+    for r in load_data(RETURNS_FILE).values():
+        sale_date = r.get('original_date') or r.get('return_date')
+        if r.get('items') and sale_date:
+            counters._apply(r['items'], sale_date, -1)
+    save_data(counters.to_dict(), SALES_COUNTERS_FILE)
+    return counters
+
+@st.cache_resource
+def get_sales_counters():
+    # Built from history the first time (or when the file has an older format),
+    # then maintained incrementally
+    data = load_data(SALES_COUNTERS_FILE)
+    if data.get('version') == SALES_COUNTERS_VERSION:
+        return SalesCounters(data)
+    return rebuild_sales_counters()
 
 # Session state initialization
 if 'user_info' not in st.session_state:
     st.session_state.user_info = None
-if 'cart' not in st.session_state:
-    st.session_state.cart = {}
+ensure_cart()
 if 'current_page' not in st.session_state:
     st.session_state.current_page = "Login"
 if 'shift_started' not in st.session_state:
@@ -664,6 +1989,9 @@ def dashboard():
             st.session_state.current_page = "Login"
             st.rerun()
     
+    if is_manager():
+        notify_low_stock_alerts()
+    
     # Display selected page
     pages[selected_page]()
 
@@ -673,11 +2001,10 @@ def dashboard_content():
     col1, col2, col3 = st.columns(3)
     
     products = load_data(PRODUCTS_FILE)
-    inventory = load_data(INVENTORY_FILE)
     transactions = load_data(TRANSACTIONS_FILE)
     
     total_products = len(products)
-    low_stock_items = sum(1 for item in inventory.values() if item.get('quantity', 0) < item.get('reorder_point', 10))
+    low_stock_items = len(get_low_stock_tracker().low_stock())
     
     today_sales = 0
     today = datetime.date.today()
@@ -719,8 +2046,62 @@ def dashboard_content():
         st.dataframe(trans_df)
     else:
         st.info("No recent transactions")
+    
+    st.subheader("Top Sellers (Last 30 Days)")
+    top_sellers = get_sales_counters().top(10, days=30)
+    if top_sellers:
+        counters = get_sales_counters()
+        st.dataframe(pd.DataFrame([{
+            'product': products.get(barcode, {}).get('name', 'Unknown'),
+            'units': units,
+            'revenue': format_cents(counters.revenue_cents(barcode, 30))
+        } for units, barcode in top_sellers]), hide_index=True)
+    else:
+        st.info("No sales in the last 30 days")
 
 # POS Terminal - Main Page
+# Quick keys are the products selling fastest at this hour of day in this store,
+# ranked from the sales counters (hour-of-day units over the last few weeks, then
+# 7-day units) and cached until the counters or the catalogue change.
+def compute_quick_keys(hour, count):
+    # The app serves a single store, so keys are ranked per hour of the day only
+    counters = get_sales_counters()
+    products = load_data(PRODUCTS_FILE)
+    hourly = counters.hourly_units(hour)
+    recent = {barcode: units for units, barcode in counters.top(count * 4, days=7)}
+    
+    candidates = set(hourly) | set(recent)
+    ranked = heapq.nlargest(
+        count * 2,
+        ((hourly.get(b, 0), recent.get(b, 0), b) for b in candidates
+         if b in products and products[b].get('active', True))
+    )
+    # Keep a few spares so out-of-stock items can be skipped at render time
+    return [barcode for hourly_units, recent_units, barcode in ranked if hourly_units > 0 or recent_units > 0]
+
+def render_quick_keys(inventory):
+    hour = get_current_datetime().hour
+    barcodes = cached_report(
+        "Quick Keys", (hour, QUICK_KEYS_COUNT),
+        (SALES_COUNTERS_FILE, PRODUCTS_FILE),
+        lambda: compute_quick_keys(hour, QUICK_KEYS_COUNT)
+    )
+    barcodes = [b for b in barcodes if inventory.get(b, {}).get('quantity', 0) > 0][:QUICK_KEYS_COUNT]
+    if not barcodes:
+        return
+    
+    products = load_data(PRODUCTS_FILE)
+    st.subheader("Quick Keys")
+    for row_start in range(0, len(barcodes), QUICK_KEYS_PER_ROW):
+        cols = st.columns(QUICK_KEYS_PER_ROW)
+        for col, barcode in zip(cols, barcodes[row_start:row_start + QUICK_KEYS_PER_ROW]):
+            product = products[barcode]
+            with col:
+                if st.button(f"{product['name']}\n{format_currency(product['price'])}",
+                             key=f"quick_key_{barcode}", use_container_width=True):
+                    st.session_state.cart.add(barcode, product, 1)
+                    st.rerun()
+
 def pos_terminal():
     if is_cashier() and not st.session_state.shift_started:
         st.warning("Please start your shift before using the POS terminal")
@@ -745,6 +2126,8 @@ def pos_terminal():
             st.session_state.pos_mode = 'manual'
             st.rerun()
     
+    render_quick_keys(load_data(INVENTORY_FILE))
+    
     if st.session_state.pos_mode == 'scan':
         pos_scan_mode()
     else:
@@ -778,16 +2161,7 @@ def pos_scan_mode():
                 stock = inventory.get(barcode, {}).get('quantity', 0)
                 
                 if stock > 0:
-                    if barcode in st.session_state.cart:
-                        st.session_state.cart[barcode]['quantity'] += 1
-                    else:
-                        st.session_state.cart[barcode] = {
-                            'name': product['name'],
-                            'price': product['price'],
-                            'quantity': 1,
-                            'description': product.get('description', ''),
-                            'brand': product.get('brand')
-                        }
+                    st.session_state.cart.add(barcode, product, 1)
                     st.success(f"Added {product['name']} to cart")
                     st.rerun()
                 else:
@@ -859,16 +2233,7 @@ def pos_scan_mode():
                             
                             # Add to cart button
                             if st.button(f"Add to Cart", key=f"add_{barcode}", use_container_width=True):
-                                if barcode in st.session_state.cart:
-                                    st.session_state.cart[barcode]['quantity'] += 1
-                                else:
-                                    st.session_state.cart[barcode] = {
-                                        'name': product['name'],
-                                        'price': product['price'],
-                                        'quantity': 1,
-                                        'description': product.get('description', ''),
-                                        'brand': product.get('brand')
-                                    }
+                                st.session_state.cart.add(barcode, product, 1)
                                 st.success(f"Added {product['name']} to cart")
                                 st.rerun()
     
@@ -979,24 +2344,586 @@ def pos_manual_mode():
                             
                             # Add to cart button
                             if st.button(f"Add to Cart", key=f"add_manual_{barcode}", use_container_width=True):
-                                if barcode in st.session_state.cart:
-                                    st.session_state.cart[barcode]['quantity'] += quantity
-                                else:
-                                    st.session_state.cart[barcode] = {
-                                        'name': product['name'],
-                                        'price': product['price'],
-                                        'quantity': quantity,
-                                        'description': product.get('description', ''),
-                                        'brand': product.get('brand')
-                                    }
+                                st.session_state.cart.add(barcode, product, quantity)
                                 st.success(f"Added {quantity} {product['name']} to cart")
                                 st.rerun()
     
     display_cart_and_checkout()
     
+# Pricing engine
+# Discounts and offers are compiled once per change of the rule files into lookup
+# tables keyed by barcode and category, so pricing a cart only touches the rules
+# that can apply to its lines. Validity windows are checked at evaluation time.
+def _parse_rule_date(value, default):
+    try:
+        return datetime.datetime.strptime(str(value), "%Y-%m-%d").date()
+    except (ValueError, TypeError):
+        return default
+
+def _rule_window(rule):
+    return (_parse_rule_date(rule.get('start_date'), datetime.date.min),
+            _parse_rule_date(rule.get('end_date'), datetime.date.max))
+
+class PricingEngine:
+    def __init__(self, discounts, offers, products):
+        self.categories = {barcode: p.get('category') for barcode, p in products.items()}
+        self.discounts = {}
+        self.global_discounts = []
+        self.discounts_by_barcode = {}
+        self.discounts_by_category = {}
+        self.offers = {}
+        self.offers_by_barcode = {}
+        
+        for discount_id, discount in discounts.items():
+            if not discount.get('active'):
+                continue
+            start, end = _rule_window(discount)
+            compiled = {
+                'id': discount_id,
+                'name': discount.get('name', discount_id),
+                'type': discount.get('type', 'percentage'),
+                'value': discount.get('value', 0),
+                'start': start,
+                'end': end
+            }
+            self.discounts[discount_id] = compiled
+            
+            if discount.get('apply_to') == "Specific Products":
+                for barcode in discount.get('products', []):
+                    self.discounts_by_barcode.setdefault(barcode, []).append(discount_id)
+            elif discount.get('apply_to') == "Specific Categories":
+                for category in discount.get('categories', []):
+                    self.discounts_by_category.setdefault(category, []).append(discount_id)
+            else:
+                self.global_discounts.append(discount_id)
+        
+        self.skipped_offers = []
+        for offer_id, offer in offers.items():
+            if not offer.get('active'):
+                continue
+            offer_type = str(offer.get('type', '')).replace(' ', '_')
+            # An offer missing the fields its type needs (e.g. edited from another
+            # type) is left out rather than failing the whole index
+            if (offer_type == 'special_price' and not offer.get('product')) or \
+               (offer_type in ('bogo', 'bundle') and not offer.get('products')):
+                self.skipped_offers.append(offer_id)
+                continue
+            start, end = _rule_window(offer)
+            compiled = dict(offer, id=offer_id, type=offer_type, start=start, end=end)
+            compiled['special_price_cents'] = to_cents(offer.get('special_price', 0))
+            compiled['bundle_price_cents'] = to_cents(offer.get('bundle_price', 0))
+            compiled['bundle_items'] = {}
+            for barcode in offer.get('products', []) if compiled['type'] == 'bundle' else []:
+                compiled['bundle_items'][barcode] = compiled['bundle_items'].get(barcode, 0) + 1
+            self.offers[offer_id] = compiled
+            
+            barcodes = [offer.get('product')] if compiled['type'] == 'special_price' else offer.get('products', [])
+            for barcode in set(barcodes):
+                self.offers_by_barcode.setdefault(barcode, []).append(compiled)
+
+    @staticmethod
+    def _valid(rule, day):
+        return rule['start'] <= day <= rule['end']
+
+    def available_discounts(self, day):
+        return [d for d in self.discounts.values() if self._valid(d, day)]
+
+    def offers_for(self, barcode, day):
+        return [o for o in self.offers_by_barcode.get(barcode, []) if self._valid(o, day)]
+
+    def discount_applies(self, discount_id, barcode):
+        if discount_id in self.global_discounts:
+            return True
+        if discount_id in self.discounts_by_barcode.get(barcode, ()):
+            return True
+        return discount_id in self.discounts_by_category.get(self.categories.get(barcode), ())
+
+    def discount_amount(self, discount_id, lines, tax_rate, day, applied_offers=()):
+        # Discounts apply to the tax-inclusive amount of the lines in their scope,
+        # after the offer savings on those lines (spread by line value)
+        discount = self.discounts.get(discount_id)
+        if not discount or not self._valid(discount, day):
+            return 0
+        
+        eligible_cents = sum(price_cents * quantity for barcode, (price_cents, quantity) in lines.items()
+                             if self.discount_applies(discount_id, barcode))
+        for offer in applied_offers:
+            offer_gross = sum(lines[b][0] * lines[b][1] for b in offer['barcodes'])
+            in_scope = sum(lines[b][0] * lines[b][1] for b in offer['barcodes'] if self.discount_applies(discount_id, b))
+            if offer_gross > 0 and in_scope:
+                eligible_cents -= offer['savings_cents'] * in_scope // offer_gross
+        if eligible_cents <= 0:
+            return 0
+        eligible_cents += apply_rate(eligible_cents, tax_rate)
+        
+        if discount['type'] == 'percentage':
+            return apply_rate(eligible_cents, Decimal(str(discount['value'])) / 100)
+        return min(to_cents(discount['value']), eligible_cents)
+
+    def _unit_options(self, barcode, price_cents, day):
+        # Offers that only use units of one product: (units consumed, saving, offer)
+        options = []
+        for offer in self.offers_for(barcode, day):
+            if offer['type'] == 'bogo':
+                buy_quantity = max(int(offer.get('buy_quantity', 1)), 1)
+                get_quantity = max(int(offer.get('get_quantity', 1)), 0)
+                if get_quantity:
+                    options.append((buy_quantity + get_quantity, get_quantity * price_cents, offer))
+            elif offer['type'] == 'special_price':
+                saving = price_cents - offer['special_price_cents']
+                if saving > 0:
+                    options.append((1, saving, offer))
+        return options
+
+    @staticmethod
+    def _best_allocation(quantity, options):
+        # best[n] is the largest saving from n units using single-product offers
+        best = [0] * (quantity + 1)
+        choice = [None] * (quantity + 1)
+        for n in range(1, quantity + 1):
+            best[n] = best[n - 1]
+            for option in options:
+                size, saving = option[0], option[1]
+                if size <= n and best[n - size] + saving > best[n]:
+                    best[n] = best[n - size] + saving
+                    choice[n] = option
+        return best, choice
+
+    def _bundle_saving(self, offer, lines):
+        items = offer['bundle_items']
+        if not items or any(b not in lines for b in items):
+            return 0
+        return sum(lines[b][0] * count for b, count in items.items()) - offer['bundle_price_cents']
+
+    def line_allocation(self, barcode, price_cents, quantity, day):
+        options = self._unit_options(barcode, price_cents, day)
+        return self._best_allocation(int(quantity), options) if options else None
+
+    def evaluate_offers(self, lines, day, allocations=None):
+        # Each unit in the cart goes to at most one offer. Single-product offers
+        # (BOGO, special price) are solved exactly per line with a small DP; bundles
+        # are then taken greedily by marginal gain over what their units would
+        # have saved on their own. Callers may pass per-line allocations they
+        # already hold from an earlier evaluation.
+        if allocations is None:
+            allocations = {barcode: self.line_allocation(barcode, price_cents, quantity, day)
+                           for barcode, (price_cents, quantity) in lines.items()}
+        allocations = {barcode: a for barcode, a in allocations.items() if a is not None}
+        bundles = {}
+        for barcode in lines:
+            for offer in self.offers_for(barcode, day):
+                if offer['type'] == 'bundle' and offer['id'] not in bundles:
+                    saving = self._bundle_saving(offer, lines)
+                    if saving > 0:
+                        bundles[offer['id']] = (offer, saving)
+        
+        available = {barcode: int(quantity) for barcode, (price_cents, quantity) in lines.items()}
+        
+        def unit_loss(barcode, count):
+            best = allocations.get(barcode)
+            if best is None:
+                return 0
+            return best[0][available[barcode]] - best[0][available[barcode] - count]
+        
+        def bundle_gain(offer, saving):
+            items = offer['bundle_items']
+            if any(available[b] < count for b, count in items.items()):
+                return 0
+            return saving - sum(unit_loss(b, count) for b, count in items.items())
+        
+        # Max-heap of bundle gains; applying a bundle only re-scores the bundles
+        # that share a product with it, older heap entries are skipped by version
+        bundles_by_barcode = {}
+        for offer_id, (offer, saving) in bundles.items():
+            for b in offer['bundle_items']:
+                bundles_by_barcode.setdefault(b, []).append(offer_id)
+        
+        versions = dict.fromkeys(bundles, 0)
+        heap = [(-bundle_gain(offer, saving), offer_id, 0) for offer_id, (offer, saving) in bundles.items()]
+        heapq.heapify(heap)
+        
+        bundle_counts = {}
+        while heap:
+            neg_gain, offer_id, version = heapq.heappop(heap)
+            if version != versions[offer_id]:
+                continue
+            if neg_gain >= 0:
+                break
+            
+            offer, saving = bundles[offer_id]
+            for b, count in offer['bundle_items'].items():
+                available[b] -= count
+            bundle_counts[offer_id] = bundle_counts.get(offer_id, 0) + 1
+            
+            affected = {other for b in offer['bundle_items'] for other in bundles_by_barcode[b]}
+            for other in affected:
+                versions[other] += 1
+                other_offer, other_saving = bundles[other]
+                heapq.heappush(heap, (-bundle_gain(other_offer, other_saving), other, versions[other]))
+        
+        applied = []
+        for offer_id, count in bundle_counts.items():
+            offer, saving = bundles[offer_id]
+            applied.append({
+                'offer_id': offer_id,
+                'name': offer.get('name', ''),
+                'type': 'bundle',
+                'barcodes': list(offer['bundle_items']),
+                'description': f"Bundle x{count}",
+                'count': count,
+                'savings_cents': saving * count
+            })
+        
+        for barcode, (best, choice) in allocations.items():
+            per_offer = {}
+            n = available[barcode]
+            while n > 0:
+                option = choice[n]
+                if option is None:
+                    n -= 1
+                    continue
+                size, saving, offer = option
+                entry = per_offer.setdefault(offer['id'], [offer, 0, 0])
+                entry[1] += 1
+                entry[2] += saving
+                n -= size
+            
+            for offer_id, (offer, count, savings_cents) in per_offer.items():
+                if offer['type'] == 'bogo':
+                    description = f"Buy {offer.get('buy_quantity', 1)} Get {offer.get('get_quantity', 1)} Free x{count}"
+                else:
+                    description = f"Special price on {count}"
+                applied.append({
+                    'offer_id': offer_id,
+                    'name': offer.get('name', ''),
+                    'type': offer['type'],
+                    'barcodes': [barcode],
+                    'description': description,
+                    'count': count,
+                    'savings_cents': savings_cents
+                })
+        return applied
+
+    def price_cart(self, lines, tax_rate, discount_id=None, day=None, allocations=None, subtotal_cents=None):
+        day = day or get_current_datetime().date()
+        if subtotal_cents is None:
+            subtotal_cents = sum(price_cents * quantity for price_cents, quantity in lines.values())
+        tax_cents = apply_rate(subtotal_cents, tax_rate)
+        applied_offers = self.evaluate_offers(lines, day, allocations)
+        offer_cents = sum(o['savings_cents'] for o in applied_offers)
+        # The discount never takes the total below zero
+        remaining_cents = max(subtotal_cents + tax_cents - offer_cents, 0)
+        discount_cents = self.discount_amount(discount_id, lines, tax_rate, day, applied_offers) if discount_id else 0
+        discount_cents = min(discount_cents, remaining_cents)
+        
+        return {
+            'subtotal_cents': subtotal_cents,
+            'tax_cents': tax_cents,
+            'discount_cents': discount_cents,
+            'offer_cents': offer_cents,
+            'applied_offers': applied_offers,
+            'total_cents': max(remaining_cents - discount_cents, 0)
+        }
+
+@st.cache_resource
+def get_pricing_engine_holder():
+    return {'key': None, 'engine': None, 'lock': threading.Lock()}
+
+def get_pricing_engine():
+    holder = get_pricing_engine_holder()
+    key = tuple(get_data_version(f) for f in (DISCOUNTS_FILE, OFFERS_FILE, PRODUCTS_FILE))
+    with holder['lock']:
+        if holder['key'] != key:
+            holder['engine'] = PricingEngine(load_data(DISCOUNTS_FILE), load_data(OFFERS_FILE), load_data(PRODUCTS_FILE))
+            holder['key'] = key
+        return holder['engine']
+
+# Promotion scheduler
+# A heap of activation/expiry events for discounts and offers, plus scheduled price
+# changes. Events are applied at their boundary by a background thread (and on every
+# script run), through save_data() so the pricing engine is rebuilt. Each boundary
+# is recorded on the rule so it only fires once; editing the dates re-arms it.
+# A rule created or edited after its start keeps the active flag the manager chose.
+def _parse_schedule_time(value):
+    try:
+        return datetime.datetime.strptime(str(value), "%Y-%m-%d %H:%M")
+    except (ValueError, TypeError):
+        return None
+
+def _rule_edited_at(rule):
+    for field in ['updated_at', 'created_at']:
+        try:
+            return datetime.datetime.strptime(str(rule.get(field)), "%Y-%m-%d %H:%M:%S")
+        except (ValueError, TypeError):
+            continue
+    return None
+
+class PromotionScheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.sources_key = None
+        self.last_error = None
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name="pos-scheduler", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _now():
+        return get_current_datetime().replace(tzinfo=None)
+
+    @staticmethod
+    def _sources_key():
+        return tuple(get_data_version(f) for f in (DISCOUNTS_FILE, OFFERS_FILE, PRICE_SCHEDULE_FILE))
+
+    def _rebuild(self):
+        events = []
+        for file in (DISCOUNTS_FILE, OFFERS_FILE):
+            for rule_id, rule in load_data(file).items():
+                start, end = _rule_window(rule)
+                if start != datetime.date.min and rule.get('activated_for') != rule.get('start_date'):
+                    start_at = datetime.datetime.combine(start, datetime.time.min)
+                    edited_at = _rule_edited_at(rule)
+                    if edited_at is None or edited_at < start_at:
+                        events.append((start_at, 'activate', file, rule_id))
+                if end < datetime.date.max and rule.get('expired_for') != rule.get('end_date'):
+                    events.append((datetime.datetime.combine(end + timedelta(days=1), datetime.time.min), 'expire', file, rule_id))
+        
+        for change_id, change in load_data(PRICE_SCHEDULE_FILE).items():
+            effective_at = _parse_schedule_time(change.get('effective_at'))
+            if change.get('status') == 'scheduled' and effective_at:
+                events.append((effective_at, 'price', PRICE_SCHEDULE_FILE, change_id))
+        
+        heapq.heapify(events)
+        self.heap = events
+
+    def _refresh(self):
+        key = self._sources_key()
+        if key != self.sources_key:
+            self._rebuild()
+            self.sources_key = key
+
+    def upcoming(self, limit=50):
+        with self.lock:
+            self._refresh()
+            return heapq.nsmallest(limit, self.heap)
+
+    def run_due(self, now=None):
+        with self.lock:
+            self._refresh()
+            now = now or self._now()
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+            if due:
+                self._apply(due, now)
+            return due
+
+    def _apply(self, due, now):
+        now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+        by_file = {}
+        for when, kind, file, record_id in due:
+            by_file.setdefault(file, []).append((kind, record_id))
+        
+        for file, events in by_file.items():
+            with get_file_lock(file):
+                records = load_data(file)
+                changed = False
+                
+                if file == PRICE_SCHEDULE_FILE:
+                    with get_file_lock(PRODUCTS_FILE):
+                        products = load_data(PRODUCTS_FILE)
+                        products_changed = False
+                        price_changes = {}
+                        for kind, change_id in events:
+                            change = records.get(change_id)
+                            if not change or change.get('status') != 'scheduled':
+                                continue
+                            product = products.get(change.get('barcode'))
+                            if product is None:
+                                change['status'] = 'failed'
+                                change['error'] = "Product not found"
+                            else:
+                                change['old_price'] = product.get('price')
+                                product['price'] = change['new_price']
+                                price_changes[change['barcode']] = (change['old_price'], change['new_price'])
+                                product['price_updated_at'] = now_str
+                                products_changed = True
+                                change['status'] = 'applied'
+                            change['applied_at'] = now_str
+                            changed = True
+                        if products_changed:
+                            save_data(products, PRODUCTS_FILE)
+                            record_price_history(price_changes, "Scheduled price change", when=now_str)
+                else:
+                    for kind, rule_id in events:
+                        rule = records.get(rule_id)
+                        if not rule:
+                            continue
+                        start, end = _rule_window(rule)
+                        # The rule may have been edited since the event was queued
+                        if kind == 'activate' and start <= now.date() and rule.get('activated_for') != rule.get('start_date'):
+                            rule['activated_for'] = rule.get('start_date')
+                            if now.date() <= end:
+                                rule['active'] = True
+                            changed = True
+                        elif kind == 'expire' and end < now.date() and rule.get('expired_for') != rule.get('end_date'):
+                            rule['expired_for'] = rule.get('end_date')
+                            rule['active'] = False
+                            changed = True
+                
+                if changed:
+                    save_data(records, file)
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_due()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+            
+            wait = SCHEDULER_POLL_SECONDS
+            with self.lock:
+                if self.heap:
+                    wait = min(wait, max((self.heap[0][0] - self._now()).total_seconds(), 1))
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
+
+@st.cache_resource
+def get_promotion_scheduler():
+    return PromotionScheduler()
+
+# Customer lookup
+# Loyalty customers are indexed once per change of LOYALTY_FILE: phone digits and
+# lowercased emails in sorted lists for prefix search with bisect, and name tokens
+# mapped to customer ids. A query only walks the keys that share its prefix. Digit
+# tokens in a name query ("john 555") filter the name matches by phone prefix or suffix.
+CUSTOMER_SEARCH_LIMIT = 20
+
+def _normalize_phone(value):
+    return "".join(ch for ch in str(value or "") if ch.isdigit())
+
+def _name_tokens(value):
+    return [t for t in re.split(r"[^0-9a-z]+", str(value or "").lower()) if t]
+
+def _prefix_range(keys, prefix):
+    lo = bisect.bisect_left(keys, prefix)
+    hi = bisect.bisect_left(keys, prefix + "\uffff")
+    return lo, hi
+
+class CustomerIndex:
+    def __init__(self, customers):
+        self.customers = customers
+        phones = []
+        phone_tails = []
+        emails = []
+        tokens = {}
+        for customer_id, customer in customers.items():
+            phone = _normalize_phone(customer.get('phone'))
+            if phone:
+                phones.append((phone, customer_id))
+                phone_tails.append((phone[::-1], customer_id))
+            email = str(customer.get('email') or "").strip().lower()
+            if email:
+                emails.append((email, customer_id))
+            for token in set(_name_tokens(customer.get('name'))):
+                tokens.setdefault(token, []).append(customer_id)
+        phones.sort()
+        phone_tails.sort()
+        emails.sort()
+        self.phone_keys = [k for k, _ in phones]
+        self.phone_ids = [v for _, v in phones]
+        # Reversed digits, so the last digits of a number can be looked up too
+        self.phone_tail_keys = [k for k, _ in phone_tails]
+        self.phone_tail_ids = [v for _, v in phone_tails]
+        self.email_keys = [k for k, _ in emails]
+        self.email_ids = [v for _, v in emails]
+        self.token_keys = sorted(tokens)
+        self.token_ids = [tokens[k] for k in self.token_keys]
+        self.order = sorted(customers, key=self.sort_key)
+        self.rank = {customer_id: i for i, customer_id in enumerate(self.order)}
+
+    def __len__(self):
+        return len(self.customers)
+
+    def sort_key(self, customer_id):
+        return (str(self.customers[customer_id].get('name', '')).lower(), customer_id)
+
+    def label(self, customer_id):
+        customer = self.customers[customer_id]
+        return f"{customer.get('name', '')} - {customer.get('phone') or 'No phone'}"
+
+    def _ids_with_prefix(self, keys, ids, prefix):
+        lo, hi = _prefix_range(keys, prefix)
+        return ids[lo:hi]
+
+    def _name_matches(self, query_tokens):
+        matches = None
+        # Rarest token first keeps the candidate set small
+        candidates = []
+        for token in query_tokens:
+            lo, hi = _prefix_range(self.token_keys, token)
+            candidates.append((hi - lo, lo, hi))
+        for _, lo, hi in sorted(candidates):
+            found = set()
+            for ids in self.token_ids[lo:hi]:
+                found.update(ids if matches is None else (i for i in ids if i in matches))
+            matches = found
+            if not matches:
+                break
+        return matches or set()
+
+    def _phone_matches(self, customer_id, numbers):
+        phone = _normalize_phone(self.customers[customer_id].get('phone'))
+        return all(phone.startswith(number) or phone.endswith(number) for number in numbers)
+
+    def search(self, query, limit=CUSTOMER_SEARCH_LIMIT):
+        query = str(query or "").strip().lower()
+        if not query:
+            return []
+        if "@" in query:
+            matches = self._ids_with_prefix(self.email_keys, self.email_ids, query)
+        else:
+            digits = _normalize_phone(query)
+            if digits and not any(ch.isalpha() for ch in query):
+                matches = (self._ids_with_prefix(self.phone_keys, self.phone_ids, digits) +
+                           self._ids_with_prefix(self.phone_tail_keys, self.phone_tail_ids, digits[::-1]))
+            else:
+                tokens = _name_tokens(query)
+                matches = self._name_matches(tokens)
+                words = [t for t in tokens if not t.isdigit()]
+                numbers = [t for t in tokens if t.isdigit()]
+                if not matches and words and numbers:
+                    matches = {i for i in self._name_matches(words) if self._phone_matches(i, numbers)}
+                if not matches:
+                    matches = self._ids_with_prefix(self.email_keys, self.email_ids, query)
+        return heapq.nsmallest(limit, set(matches), key=self.rank.__getitem__)
+
+    def page(self, offset, size):
+        return self.order[offset:offset + size]
+
+@st.cache_resource
+def get_customer_index_holder():
+    return {'version': None, 'index': None, 'lock': threading.Lock()}
+
+def get_customer_index():
+    holder = get_customer_index_holder()
+    version = get_data_version(LOYALTY_FILE)
+    with holder['lock']:
+        if holder['version'] != version:
+            holder['index'] = CustomerIndex(load_data(LOYALTY_FILE).get('customers', {}))
+            holder['version'] = version
+        return holder['index']
+
+def customer_search_box(key, label="Search Customer (phone, name or email)"):
+    index = get_customer_index()
+    query = st.text_input(label, key=key)
+    return index, query, index.search(query)
+
 # Common cart and checkout display
 def display_cart_and_checkout():
-    settings = load_data(SETTINGS_FILE)
+    settings = get_settings()
     
     st.header("Current Sale")
     if st.session_state.cart:
@@ -1017,114 +2944,143 @@ def display_cart_and_checkout():
                         key=f"edit_{barcode}"
                     )
                     if new_qty != item['quantity']:
-                        st.session_state.cart[barcode]['quantity'] = new_qty
+                        st.session_state.cart.set_quantity(barcode, new_qty)
                         st.rerun()
                 with col3:
-                    st.write(f"{format_currency(item['price'] * item['quantity'])}")
+                    st.write(f"{format_cents(item['price_cents'] * item['quantity'])}")
                 with col4:
                     if st.button("❌", key=f"remove_{barcode}"):
-                        del st.session_state.cart[barcode]
+                        st.session_state.cart.remove(barcode)
                         st.rerun()
         
-        subtotal = sum(item['price'] * item['quantity'] for item in st.session_state.cart.values())
+        engine = get_pricing_engine()
+        today = get_current_datetime().date()
         tax_rate = settings.get('tax_rate', 0.0)
-        tax_amount = subtotal * tax_rate
-        total = subtotal + tax_amount
+        
+        discount_options = {d['name']: d['id'] for d in engine.available_discounts(today)}
+        selected_discount = st.selectbox("Apply Discount", [""] + list(discount_options.keys())) if discount_options else ""
+        
+        pricing = st.session_state.cart.price(engine, tax_rate, discount_options.get(selected_discount), today)
+        subtotal_cents = pricing['subtotal_cents']
+        tax_cents = pricing['tax_cents']
+        total_cents = pricing['total_cents']
         
         st.markdown("---")
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("Summary")
-            st.write(f"Subtotal: {format_currency(subtotal)}")
-            st.write(f"Tax ({tax_rate*100}%): {format_currency(tax_amount)}")
-            st.write(f"Total: {format_currency(total)}")
-        
-        discounts = load_data(DISCOUNTS_FILE)
-        active_discounts = [d for d in discounts.values() if d['active']]
-        
-        if active_discounts:
-            discount_options = {d['name']: d for d in active_discounts}
-            selected_discount = st.selectbox("Apply Discount", [""] + list(discount_options.keys()))
-            
+            st.write(f"Subtotal: {format_cents(subtotal_cents)}")
+            st.write(f"Tax ({tax_rate*100}%): {format_cents(tax_cents)}")
             if selected_discount:
-                discount = discount_options[selected_discount]
-                if discount['type'] == 'percentage':
-                    discount_amount = total * (discount['value'] / 100)
-                else:
-                    discount_amount = discount['value']
-                
-                total -= discount_amount
-                st.write(f"Discount Applied: -{format_currency(discount_amount)}")
-                st.write(f"New Total: {format_currency(total)}")
-        
-        offers = load_data(OFFERS_FILE)
-        active_offers = [o for o in offers.values() if o['active']]
-        
-        for offer in active_offers:
-            if offer['type'] == 'bogo':
-                for barcode, item in st.session_state.cart.items():
-                    if barcode in offer.get('products', []):
-                        if item['quantity'] >= offer['buy_quantity']:
-                            free_qty = (item['quantity'] // offer['buy_quantity']) * offer['get_quantity']
-                            st.info(f"BOGO Offer Applied: Buy {offer['buy_quantity']} Get {offer['get_quantity']} Free on {item['name']}")
-                            st.info(f"You get {free_qty} {item['name']} free")
-                            total -= free_qty * item['price']
+                st.write(f"Discount Applied: -{format_cents(pricing['discount_cents'])}")
+            for offer in pricing['applied_offers']:
+                item_names = ", ".join(st.session_state.cart[b]['name'] for b in offer['barcodes'])
+                st.info(f"{offer['name'] or 'Offer'} Applied: {offer['description']} on {item_names} "
+                        f"(-{format_cents(offer['savings_cents'])})")
+            st.write(f"Total: {format_cents(total_cents)}")
         
         with col2:
             st.subheader("Payment")
             payment_method = st.selectbox("Payment Method", ["Cash", "Credit Card", "Debit Card", "Mobile Payment"])
-            amount_tendered = st.number_input("Amount Tendered", min_value=0.0, value=total, step=1.0)
+            amount_tendered = st.number_input("Amount Tendered", min_value=0.0, value=from_cents(total_cents), step=1.0)
+            tendered_cents = to_cents(amount_tendered)
+            
+            # Shortages from the last attempt, until the cart is changed
+            shortages = st.session_state.get('checkout_shortages')
+            shortages = shortages[1] if shortages and shortages[0] == st.session_state.cart.version else []
+            if shortages:
+                for shortage in shortages:
+                    st.error(f"{shortage['name']}: {shortage['requested']} in cart, only {shortage['available']} in stock")
+                if st.button("Reduce to Available Stock", use_container_width=True):
+                    for shortage in shortages:
+                        if shortage['barcode'] not in st.session_state.cart:
+                            continue
+                        if shortage['available'] > 0:
+                            st.session_state.cart.set_quantity(shortage['barcode'], shortage['available'])
+                        else:
+                            st.session_state.cart.remove(shortage['barcode'])
+                    st.session_state.checkout_shortages = None
+                    st.rerun()
             
             if st.button("Complete Sale", use_container_width=True):
-                if amount_tendered < total:
+                if tendered_cents < total_cents:
                     st.error("Amount tendered is less than total")
                 else:
-                    transactions = load_data(TRANSACTIONS_FILE)
-                    transaction_id = generate_short_id()
+                    discount_cents = total_cents - (subtotal_cents + tax_cents)
+                    change_cents = tendered_cents - total_cents
                     
-                    transactions[transaction_id] = {
-                        'transaction_id': transaction_id,
+                    sale = {
                         'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-                        'items': st.session_state.cart,
-                        'subtotal': subtotal,
-                        'tax': tax_amount,
-                        'discount': total - (subtotal + tax_amount),
-                        'total': total,
+                        'items': {barcode: with_cents(dict(item), ['price']) for barcode, item in st.session_state.cart.items()},
+                        'subtotal': from_cents(subtotal_cents),
+                        'tax': from_cents(tax_cents),
+                        'discount': from_cents(discount_cents),
+                        'total': from_cents(total_cents),
                         'payment_method': payment_method,
-                        'amount_tendered': amount_tendered,
-                        'change': amount_tendered - total,
+                        'amount_tendered': from_cents(tendered_cents),
+                        'change': from_cents(change_cents),
+                        'subtotal_cents': subtotal_cents,
+                        'tax_cents': tax_cents,
+                        'discount_cents': discount_cents,
+                        'total_cents': total_cents,
+                        'amount_tendered_cents': tendered_cents,
+                        'change_cents': change_cents,
+                        'discount_id': discount_options.get(selected_discount),
+                        'offers_applied': [
+                            {'offer_id': o['offer_id'], 'barcodes': o['barcodes'], 'savings_cents': o['savings_cents']}
+                            for o in pricing['applied_offers']
+                        ],
                         'cashier': st.session_state.user_info['username'],
                         'shift_id': st.session_state.shift_id if is_cashier() else None
                     }
                     
-                    inventory = load_data(INVENTORY_FILE)
-                    for barcode, item in st.session_state.cart.items():
-                        if barcode in inventory:
-                            inventory[barcode]['quantity'] -= item['quantity']
-                        else:
-                            inventory[barcode] = {'quantity': -item['quantity']}
-                    
-                    save_data(transactions, TRANSACTIONS_FILE)
-                    save_data(inventory, INVENTORY_FILE)
+                    try:
+                        transaction, created = commit_sale(st.session_state.cart.checkout_key, sale)
+                    except InsufficientStock as e:
+                        st.session_state.checkout_shortages = (st.session_state.cart.version, e.shortages)
+                        st.rerun()
+                    st.session_state.checkout_shortages = None
                     
-                    receipt = generate_receipt(transactions[transaction_id])
+                    receipt = generate_receipt(transaction)
                     st.subheader("Receipt")
                     st.text(receipt)
                     
-                    if print_receipt(receipt):
-                        st.success("Receipt printed successfully")
-                    else:
-                        st.warning("Receipt could not be printed automatically")
-                    
-                    if payment_method == "Cash" and settings.get('cash_drawer_enabled', False):
-                        open_cash_drawer()
+                    if created:
+                        if print_receipt(receipt):
+                            st.success("Receipt printed successfully")
+                        else:
+                            st.warning("Receipt could not be printed automatically")
+                        
+                        if payment_method == "Cash" and settings.get('cash_drawer_enabled', False):
+                            open_cash_drawer()
                     
-                    st.session_state.cart = {}
-                    st.success("Sale completed successfully!")
+                    st.session_state.cart = Cart()
+                    if created:
+                        st.success("Sale completed successfully!")
+                    else:
+                        st.info(f"This sale was already recorded as transaction {transaction['transaction_id']}")
                     
     else:
         st.info("Cart is empty")
 
+def apply_outdoor_order_stock(order, movement_type, username):
+    # Deliveries take the order's items out of stock and returns put them back
+    sign = -1 if movement_type == 'Outdoor Delivery' else 1
+    now = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+    with get_inventory_lock():
+        inventory = load_data(INVENTORY_FILE)
+        movements = []
+        for barcode, item in order['items'].items():
+            if barcode in inventory:
+                previous_qty = inventory[barcode]['quantity']
+                inventory[barcode]['quantity'] += sign * item['quantity']
+                movements.append(stock_movement(barcode, movement_type, previous_qty, inventory[barcode]['quantity'],
+                                                reference=order['order_id'], user=username))
+                inventory[barcode]['last_updated'] = now
+                inventory[barcode]['updated_by'] = username
+        save_data(inventory, INVENTORY_FILE)
+        record_stock_movements(movements)
+
 def outdoor_sales_portal():
     if not is_cashier():
         st.warning("You don't have permission to access this page")
@@ -1139,10 +3095,11 @@ def outdoor_sales_portal():
         
         products = load_data(PRODUCTS_FILE)
         inventory = load_data(INVENTORY_FILE)
-        customers = load_data(LOYALTY_FILE).get('customers', {})
         
         # Customer selection
-        customer_options = {f"{v['name']} - {v.get('phone', 'No phone')}": k for k, v in customers.items()}
+        customer_index, _, customer_matches = customer_search_box("outdoor_customer_search")
+        customers = customer_index.customers
+        customer_options = {customer_index.label(k): k for k in customer_matches}
         customer_options["New Customer"] = "new"
         
         selected_customer = st.selectbox("Select Customer", [""] + list(customer_options.keys()))
@@ -1222,7 +3179,7 @@ def outdoor_sales_portal():
         # Display current outdoor order
         st.subheader("Current Outdoor Order")
         if st.session_state.outdoor_cart:
-            total = 0
+            total_cents = 0
             for barcode, item in st.session_state.outdoor_cart.items():
                 col1, col2, col3, col4 = st.columns([4, 2, 2, 1])
                 with col1:
@@ -1232,15 +3189,15 @@ def outdoor_sales_portal():
                 with col2:
                     st.write(f"Qty: {item['quantity']}")
                 with col3:
-                    item_total = item['price'] * item['quantity']
-                    st.write(f"Total: {format_currency(item_total)}")
-                    total += item_total
+                    item_total_cents = to_cents(item['price']) * item['quantity']
+                    st.write(f"Total: {format_cents(item_total_cents)}")
+                    total_cents += item_total_cents
                 with col4:
                     if st.button("❌", key=f"remove_outdoor_{barcode}"):
                         del st.session_state.outdoor_cart[barcode]
                         st.rerun()
             
-            st.write(f"**Order Total: {format_currency(total)}**")
+            st.write(f"**Order Total: {format_cents(total_cents)}**")
             
             # Delivery address
             if selected_customer and selected_customer != "New Customer" and customer.get('address'):
@@ -1265,19 +3222,20 @@ def outdoor_sales_portal():
                     
                     # Handle customer
                     if selected_customer == "New Customer":
-                        loyalty_data = load_data(LOYALTY_FILE)
                         customer_id = generate_short_id()
-                        loyalty_data['customers'][customer_id] = {
-                            'id': customer_id,
-                            'name': new_customer_name,
-                            'phone': new_customer_phone,
-                            'email': new_customer_email,
-                            'address': new_customer_address,
-                            'points': 0,
-                            'tier': 'Bronze',
-                            'date_added': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                        save_data(loyalty_data, LOYALTY_FILE)
+                        with get_file_lock(LOYALTY_FILE):
+                            loyalty_data = load_data(LOYALTY_FILE)
+                            loyalty_data['customers'][customer_id] = {
+                                'id': customer_id,
+                                'name': new_customer_name,
+                                'phone': new_customer_phone,
+                                'email': new_customer_email,
+                                'address': new_customer_address,
+                                'points': 0,
+                                'tier': 'Bronze',
+                                'date_added': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                            }
+                            save_data(loyalty_data, LOYALTY_FILE)
                     else:
                         customer_id = customer_options[selected_customer]
                     
@@ -1287,8 +3245,9 @@ def outdoor_sales_portal():
                         'customer_id': customer_id,
                         'customer_name': new_customer_name if selected_customer == "New Customer" else customers[customer_id]['name'],
                         'customer_phone': new_customer_phone if selected_customer == "New Customer" else customers[customer_id].get('phone', ''),
-                        'items': st.session_state.outdoor_cart,
-                        'total': total,
+                        'items': {barcode: with_cents(dict(item), ['price']) for barcode, item in st.session_state.outdoor_cart.items()},
+                        'total': from_cents(total_cents),
+                        'total_cents': total_cents,
                         'delivery_address': delivery_address,
                         'notes': order_notes,
                         'status': 'pending_approval',
@@ -1372,16 +3331,8 @@ def outdoor_sales_portal():
                             outdoor_orders[order['order_id']]['delivered_by'] = st.session_state.user_info['username']
                             outdoor_orders[order['order_id']]['delivery_date'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
                             
-                            # Update inventory
-                            inventory = load_data(INVENTORY_FILE)
-                            for barcode, item in order['items'].items():
-                                if barcode in inventory:
-                                    inventory[barcode]['quantity'] -= item['quantity']
-                                    inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                    inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                            
                             save_data(outdoor_orders, OUTDOOR_ORDERS_FILE)
-                            save_data(inventory, INVENTORY_FILE)
+                            apply_outdoor_order_stock(order, 'Outdoor Delivery', st.session_state.user_info['username'])
                             st.success("Order marked as delivered. Inventory updated.")
                             st.rerun()
                     
@@ -1391,16 +3342,8 @@ def outdoor_sales_portal():
                             outdoor_orders[order['order_id']]['return_date'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
                             outdoor_orders[order['order_id']]['return_reason'] = st.text_input("Return Reason", key=f"reason_tab2_{order['order_id']}")
                             
-                            # Update inventory
-                            inventory = load_data(INVENTORY_FILE)
-                            for barcode, item in order['items'].items():
-                                if barcode in inventory:
-                                    inventory[barcode]['quantity'] += item['quantity']
-                                    inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                    inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                            
                             save_data(outdoor_orders, OUTDOOR_ORDERS_FILE)
-                            save_data(inventory, INVENTORY_FILE)
+                            apply_outdoor_order_stock(order, 'Outdoor Return', st.session_state.user_info['username'])
                             st.success("Return processed. Inventory updated.")
                             st.rerun()
     
@@ -1473,16 +3416,8 @@ def outdoor_sales_portal():
                         outdoor_orders[order['order_id']]['delivered_by'] = st.session_state.user_info['username']
                         outdoor_orders[order['order_id']]['delivery_date'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
                         
-                        # Update inventory
-                        inventory = load_data(INVENTORY_FILE)
-                        for barcode, item in order['items'].items():
-                            if barcode in inventory:
-                                inventory[barcode]['quantity'] -= item['quantity']
-                                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                        
                         save_data(outdoor_orders, OUTDOOR_ORDERS_FILE)
-                        save_data(inventory, INVENTORY_FILE)
+                        apply_outdoor_order_stock(order, 'Outdoor Delivery', st.session_state.user_info['username'])
                         st.success("Order marked as delivered. Inventory updated.")
                         st.rerun()
 
@@ -1583,7 +3518,7 @@ def brands_management():
                         
                         brands_data['brand_products'] = brand_products
                         
-                        save_data(products, PRODUCTS_FILE)
+                        update_records(PRODUCTS_FILE, {barcode: products[barcode]})
                         save_data(brands_data, BRANDS_FILE)
                         st.success(f"Brand '{selected_brand}' assigned to {product['name']}")
                         st.rerun()
@@ -1614,7 +3549,8 @@ def brands_management():
                     
                     brands_data['brand_products'] = brand_products
                     
-                    save_data(products, PRODUCTS_FILE)
+                    update_records(PRODUCTS_FILE, {all_products[label]: products[all_products[label]]
+                                                   for label in selected_products})
                     save_data(brands_data, BRANDS_FILE)
                     st.success(f"Brand '{bulk_brand}' assigned to {updated_count} products")
                     st.rerun()
@@ -1782,17 +3718,17 @@ def generate_receipt(transaction):
     
     # Items
     for barcode, item in transaction['items'].items():
-        receipt += f"{item['name']} x{item['quantity']}: {format_currency(item['price'] * item['quantity'])}\n"
+        receipt += f"{item['name']} x{item['quantity']}: {format_cents(cents_of(item, 'price') * item['quantity'])}\n"
     
     receipt += "=" * 40 + "\n"
-    receipt += f"Subtotal: {format_currency(transaction['subtotal'])}\n"
-    receipt += f"Tax: {format_currency(transaction['tax'])}\n"
-    if transaction['discount'] != 0:
-        receipt += f"Discount: -{format_currency(abs(transaction['discount']))}\n"
-    receipt += f"Total: {format_currency(transaction['total'])}\n"
+    receipt += f"Subtotal: {format_cents(cents_of(transaction, 'subtotal'))}\n"
+    receipt += f"Tax: {format_cents(cents_of(transaction, 'tax'))}\n"
+    if cents_of(transaction, 'discount') != 0:
+        receipt += f"Discount: -{format_cents(abs(cents_of(transaction, 'discount')))}\n"
+    receipt += f"Total: {format_cents(cents_of(transaction, 'total'))}\n"
     receipt += f"Payment Method: {transaction['payment_method']}\n"
-    receipt += f"Amount Tendered: {format_currency(transaction['amount_tendered'])}\n"
-    receipt += f"Change: {format_currency(transaction['change'])}\n"
+    receipt += f"Amount Tendered: {format_cents(cents_of(transaction, 'amount_tendered'))}\n"
+    receipt += f"Change: {format_cents(cents_of(transaction, 'change'))}\n"
     receipt += "=" * 40 + "\n"
     
     if settings.get('receipt_footer', ''):
@@ -1853,25 +3789,34 @@ def returns_management():
                 
                 if st.button("Process Return"):
                     returned_items = {}
-                    total_refund = 0
+                    refund_cents = 0
                     
                     for barcode, item in transaction['items'].items():
                         return_qty = st.session_state.get(f"return_{barcode}", 0)
                         if return_qty > 0:
+                            price_cents = cents_of(item, 'price')
                             returned_items[barcode] = {
                                 'name': item['name'],
                                 'quantity': return_qty,
-                                'price': item['price'],
-                                'subtotal': return_qty * item['price']
+                                'price': from_cents(price_cents),
+                                'subtotal': from_cents(return_qty * price_cents),
+                                'price_cents': price_cents,
+                                'subtotal_cents': return_qty * price_cents
                             }
-                            total_refund += return_qty * item['price']
+                            refund_cents += return_qty * price_cents
                     
                     if not returned_items:
                         st.error("No items selected for return")
                     else:
-                        original_tax_rate = transaction['tax'] / transaction['subtotal']
-                        tax_refund = total_refund * original_tax_rate
-                        total_refund += tax_refund
+                        # Refund tax at the rate actually charged on the original sale
+                        original_subtotal_cents = cents_of(transaction, 'subtotal')
+                        tax_refund_cents = apply_rate(
+                            refund_cents,
+                            Decimal(cents_of(transaction, 'tax')) / original_subtotal_cents
+                        ) if original_subtotal_cents else 0
+                        refund_cents += tax_refund_cents
+                        total_refund = from_cents(refund_cents)
+                        tax_refund = from_cents(tax_refund_cents)
                         
                         returns = load_data(RETURNS_FILE)
                         return_id = generate_short_id()
@@ -1884,18 +3829,13 @@ def returns_management():
                             'items': returned_items,
                             'total_refund': total_refund,
                             'tax_refund': tax_refund,
+                            'total_refund_cents': refund_cents,
+                            'tax_refund_cents': tax_refund_cents,
                             'reason': return_reason,
                             'processed_by': st.session_state.user_info['username'],
                             'shift_id': st.session_state.shift_id if is_cashier() else None
                         }
                         
-                        inventory = load_data(INVENTORY_FILE)
-                        for barcode, item in returned_items.items():
-                            if barcode in inventory:
-                                inventory[barcode]['quantity'] += item['quantity']
-                            else:
-                                inventory[barcode] = {'quantity': item['quantity']}
-                        
                         refund_method = transaction['payment_method']
                         
                         if refund_method == "Cash":
@@ -1921,7 +3861,21 @@ def returns_management():
                             st.success(f"Refund request for {format_currency(total_refund)} to original payment method has been submitted")
                         
                         save_data(returns, RETURNS_FILE)
-                        save_data(inventory, INVENTORY_FILE)
+                        with get_inventory_lock():
+                            inventory = load_data(INVENTORY_FILE)
+                            movements = []
+                            for barcode, item in returned_items.items():
+                                previous_qty = inventory.get(barcode, {}).get('quantity', 0)
+                                if barcode in inventory:
+                                    inventory[barcode]['quantity'] += item['quantity']
+                                else:
+                                    inventory[barcode] = {'quantity': item['quantity']}
+                                movements.append(stock_movement(barcode, 'Return', previous_qty, inventory[barcode]['quantity'],
+                                                                reference=return_id, notes=return_reason,
+                                                                user=st.session_state.user_info['username']))
+                            save_data(inventory, INVENTORY_FILE)
+                            record_stock_movements(movements)
+                        get_sales_counters().record(returned_items, returns[return_id]['original_date'], sign=-1)
                         
                         return_receipt = generate_return_receipt(returns[return_id])
                         st.subheader("Return Receipt")
@@ -2004,7 +3958,7 @@ def returns_management():
             else:
                 refund_summary = {
                     'Total Refunds': len(filtered_returns),
-                    'Total Amount Refunded': sum(r['total_refund'] for r in filtered_returns),
+                    'Total Amount Refunded': from_cents(sum(cents_of(r, 'total_refund') for r in filtered_returns)),
                     'Cash Refunds': sum(1 for r in filtered_returns if r['refund_method'] == "Cash"),
                     'Card Refunds': sum(1 for r in filtered_returns if r['refund_method'] in ["Credit Card", "Debit Card"]),
                     'Pending Refunds': sum(1 for r in filtered_returns if r['status'] == "Pending")
@@ -2037,9 +3991,9 @@ def generate_return_receipt(return_data):
         receipt += f"{item['name']} x{item['quantity']}: {format_currency(item['subtotal'])}\n"
     
     receipt += "=" * 40 + "\n"
-    receipt += f"Subtotal Refund: {format_currency(return_data['total_refund'] - return_data['tax_refund'])}\n"
-    receipt += f"Tax Refund: {format_currency(return_data['tax_refund'])}\n"
-    receipt += f"Total Refund: {format_currency(return_data['total_refund'])}\n"
+    receipt += f"Subtotal Refund: {format_cents(cents_of(return_data, 'total_refund') - cents_of(return_data, 'tax_refund'))}\n"
+    receipt += f"Tax Refund: {format_cents(cents_of(return_data, 'tax_refund'))}\n"
+    receipt += f"Total Refund: {format_cents(cents_of(return_data, 'total_refund'))}\n"
     receipt += f"Refund Method: {return_data['refund_method']}\n"
     receipt += f"Status: {return_data['status']}\n"
     receipt += "=" * 40 + "\n"
@@ -2063,10 +4017,10 @@ def generate_purchase_order(supplier_id, items):
     po_id = generate_short_id()
     
     # Calculate totals
-    total_cost = 0
+    total_cost_cents = 0
     for item in items:
         product = products.get(item['barcode'], {})
-        total_cost += item['quantity'] * product.get('cost', 0)
+        total_cost_cents += item['quantity'] * to_cents(product.get('cost', 0))
     
     # Create PO
     purchase_orders[po_id] = {
@@ -2075,8 +4029,9 @@ def generate_purchase_order(supplier_id, items):
         'supplier_name': supplier['name'],
         'date_created': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
         'created_by': st.session_state.user_info['username'],
-        'items': items,
-        'total_cost': total_cost,
+        'items': [with_cents(dict(item), ['cost']) for item in items],
+        'total_cost': from_cents(total_cost_cents),
+        'total_cost_cents': total_cost_cents,
         'status': 'pending',  # pending, partially_received, received, cancelled
         'receipts': [],  # Array to track multiple receipts
         'date_received': None,
@@ -2110,10 +4065,10 @@ def generate_po_report(po_id):
         product = products.get(item['barcode'], {'name': 'Unknown', 'cost': 0})
         report += f"{item['barcode']}\t{product['name']}\t{item['quantity']}\t"
         report += f"{format_currency(product.get('cost', 0))}\t"
-        report += f"{format_currency(item['quantity'] * product.get('cost', 0))}\n"
+        report += f"{format_cents(item['quantity'] * to_cents(product.get('cost', 0)))}\n"
     
     report += "=" * 50 + "\n"
-    report += f"TOTAL COST: {format_currency(po['total_cost'])}\n"
+    report += f"TOTAL COST: {format_cents(cents_of(po, 'total_cost'))}\n"
     report += f"STATUS: {po['status'].upper().replace('_', ' ')}\n"
     
     if po['receipts']:
@@ -2129,75 +4084,362 @@ def generate_po_report(po_id):
     return report
 
 def process_received_po(po_id, received_items, notes, mark_as_complete=False):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    inventory = load_data(INVENTORY_FILE)
-    products = load_data(PRODUCTS_FILE)
+    with get_inventory_lock():
+        purchase_orders = load_data(PURCHASE_ORDERS_FILE)
+        inventory = load_data(INVENTORY_FILE)
+        products = load_data(PRODUCTS_FILE)
     
-    if po_id not in purchase_orders:
-        return False
+        if po_id not in purchase_orders:
+            return False
     
-    po = purchase_orders[po_id]
+        po = purchase_orders[po_id]
     
-    if po['status'] == 'received':
-        return True  # Already fully processed
+        if po['status'] == 'received':
+            return True  # Already fully processed
     
-    # Update inventory only for received items
-    for item in received_items:
-        if item['received_quantity'] > 0:
-            barcode = item['barcode']
+        # Update inventory only for received items
+        movements = []
+        for item in received_items:
+            if item['received_quantity'] > 0:
+                barcode = item['barcode']
+                previous_qty = inventory.get(barcode, {}).get('quantity', 0)
             
-            if barcode in inventory:
-                inventory[barcode]['quantity'] += item['received_quantity']
-            else:
-                # Initialize inventory with default values if product doesn't exist in inventory
-                inventory[barcode] = {
-                    'quantity': item['received_quantity'],
-                    'reorder_point': 10,  # Default reorder point
-                    'cost': products.get(barcode, {}).get('cost', 0)  # Get cost from products if available
-                }
+                if barcode in inventory:
+                    inventory[barcode]['quantity'] += item['received_quantity']
+                else:
+                    # Initialize inventory with default values if product doesn't exist in inventory
+                    inventory[barcode] = {
+                        'quantity': item['received_quantity'],
+                        'reorder_point': 10,  # Default reorder point
+                        'cost': products.get(barcode, {}).get('cost', 0)  # Get cost from products if available
+                    }
             
-            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-    
-    # Update PO status
-    if all(item['received_quantity'] == item['ordered_quantity'] for item in received_items):
-        po['status'] = 'received'
-    elif mark_as_complete:
-        po['status'] = 'partially_received'
-    else:
-        po['status'] = 'pending'  # Still waiting for more items
-    
-    # Add receipt details to PO
-    po['receipts'] = po.get('receipts', [])
-    po['receipts'].append({
-        'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-        'received_by': st.session_state.user_info['username'],
-        'items': received_items,
-        'notes': notes
+                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+                movements.append(stock_movement(barcode, 'Receipt', previous_qty, inventory[barcode]['quantity'],
+                                                reference=po_id, notes=notes,
+                                                user=st.session_state.user_info['username'],
+                                                unit_cost_cents=cents_of(item, 'cost')))
+    
+        # Update PO status
+        if all(item['received_quantity'] == item['ordered_quantity'] for item in received_items):
+            po['status'] = 'received'
+        elif mark_as_complete:
+            po['status'] = 'partially_received'
+        else:
+            po['status'] = 'pending'  # Still waiting for more items
+    
+        # Add receipt details to PO
+        po['receipts'] = po.get('receipts', [])
+        po['receipts'].append({
+            'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+            'received_by': st.session_state.user_info['username'],
+            'items': received_items,
+            'notes': notes
+        })
+    
+        # Update the PO items if partially received and marked as complete
+        if mark_as_complete and po['status'] == 'partially_received':
+            # Adjust PO items to only include remaining quantities
+            po['items'] = [
+                {
+                    'barcode': item['barcode'],
+                    'name': item['name'],
+                    'quantity': item['ordered_quantity'] - item['received_quantity'],
+                    'cost': item['cost']
+                }
+                for item in received_items
+                if item['received_quantity'] < item['ordered_quantity']
+            ]
+    
+        # Update completion info if fully or partially completed
+        if po['status'] in ['received', 'partially_received']:
+            po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+            po['received_by'] = st.session_state.user_info['username']
+    
+        save_data(purchase_orders, PURCHASE_ORDERS_FILE)
+        save_data(inventory, INVENTORY_FILE)
+        record_stock_movements(movements)
+        return True
+
+# Reorder engine
+# Demand is taken from the per-day buckets of the sales counters (net of returns)
+# as a days x SKUs matrix, so every rate below is one vectorized pass over the
+# whole catalog. The daily rate blends a short and a long rolling mean; with the
+# supplier's lead time L and review period R it gives
+#   reorder point = rate * L + safety stock,  order-up-to = rate * (L + R) + safety stock
+# where safety stock = z * sigma * sqrt(L). Items without sales in the history
+# window fall back to their static reorder point.
+def daily_units_frame(days, end=None):
+    counters = get_sales_counters()
+    counters.refresh()
+    end = end or get_current_datetime().date()
+    index = pd.date_range(end=pd.Timestamp(end), periods=days, freq='D')
+    keys = set(index.strftime("%Y-%m-%d"))
+    with counters.lock:
+        rows = [(day, barcode, values[0])
+                for day, bucket in counters.days.items() if day in keys
+                for barcode, values in bucket.items()]
+    if not rows:
+        return pd.DataFrame(index=index, dtype=np.float64)
+    frame = pd.DataFrame(rows, columns=['day', 'barcode', 'units'])
+    matrix = frame.pivot_table(index='day', columns='barcode', values='units', aggfunc='sum', fill_value=0)
+    matrix.index = pd.to_datetime(matrix.index)
+    return matrix.reindex(index, fill_value=0).clip(lower=0).astype(np.float64)
+
+def demand_rates(matrix):
+    # Per-SKU daily rate and daily standard deviation over the history window
+    if matrix.empty:
+        return pd.DataFrame(columns=['daily_demand', 'demand_std', 'units'], dtype=np.float64)
+    short = matrix.rolling(REORDER_SHORT_WINDOW, min_periods=1).mean().iloc[-1]
+    long = matrix.rolling(REORDER_LONG_WINDOW, min_periods=1).mean().iloc[-1]
+    return pd.DataFrame({
+        'daily_demand': (short + long) / 2,
+        'demand_std': matrix.std(ddof=0),
+        'units': matrix.sum()
     })
+
+def open_po_quantities(purchase_orders):
+    # Units still to arrive per barcode on draft and open POs
+    on_order = {}
+    for po in purchase_orders.values():
+        if po.get('status') not in OPEN_PO_STATUSES:
+            continue
+        received = {}
+        if po['status'] != 'partially_received':
+            # Partially received POs keep only the remaining quantities in 'items'
+            for receipt in po.get('receipts', []):
+                for item in receipt['items']:
+                    received[item['barcode']] = received.get(item['barcode'], 0) + item.get('received_quantity', 0)
+        for item in po.get('items', []):
+            outstanding = max(item['quantity'] - received.get(item['barcode'], 0), 0)
+            on_order[item['barcode']] = on_order.get(item['barcode'], 0) + outstanding
+    return on_order
+
+def supplier_lookup(suppliers):
+    # Products reference suppliers by name
+    lookup = {}
+    for supplier_id, supplier in suppliers.items():
+        lookup.setdefault(supplier.get('name', ''), supplier_id)
+    return lookup
+
+def compute_reorder_plan(products, inventory, suppliers, purchase_orders, end=None):
+    barcodes = [b for b in inventory if b in products and products[b].get('active', True)]
+    columns = ['barcode', 'name', 'supplier', 'supplier_id', 'on_hand', 'on_order', 'daily_demand',
+               'lead_time', 'safety_stock', 'reorder_point', 'order_up_to', 'order_qty', 'cost', 'has_history']
+    if not barcodes:
+        return pd.DataFrame(columns=columns)
+    
+    lookup = supplier_lookup(suppliers)
+    on_order = open_po_quantities(purchase_orders)
+    plan = pd.DataFrame({
+        'barcode': barcodes,
+        'name': [products[b].get('name', '') for b in barcodes],
+        'supplier': [products[b].get('supplier', '') for b in barcodes],
+        'on_hand': np.asarray([inventory[b].get('quantity', 0) for b in barcodes], dtype=np.int64),
+        'on_order': np.asarray([on_order.get(b, 0) for b in barcodes], dtype=np.int64),
+        'static_reorder_point': np.asarray([inventory[b].get('reorder_point', 10) for b in barcodes], dtype=np.int64),
+        'cost': [products[b].get('cost', 0) for b in barcodes]
+    }).set_index('barcode')
+    plan['supplier_id'] = plan['supplier'].map(lookup)
+    lead_times = {k: v.get('lead_time_days', DEFAULT_LEAD_TIME_DAYS) for k, v in suppliers.items()}
+    plan['lead_time'] = plan['supplier_id'].map(lead_times).fillna(DEFAULT_LEAD_TIME_DAYS).astype(np.int64)
+    
+    rates = demand_rates(daily_units_frame(REORDER_HISTORY_DAYS, end)).reindex(plan.index, fill_value=0.0)
+    plan['daily_demand'] = rates['daily_demand']
+    plan['has_history'] = rates['units'] > 0
+    
+    lead = plan['lead_time'].to_numpy(dtype=np.float64)
+    safety = REORDER_SERVICE_Z * rates['demand_std'].to_numpy() * np.sqrt(lead)
+    demand = plan['daily_demand'].to_numpy()
+    reorder_point = np.ceil(demand * lead + safety)
+    order_up_to = np.ceil(demand * (lead + REORDER_REVIEW_DAYS) + safety)
+    static = plan['static_reorder_point'].to_numpy(dtype=np.float64)
+    history = plan['has_history'].to_numpy()
+    plan['safety_stock'] = np.ceil(safety).astype(np.int64)
+    plan['reorder_point'] = np.where(history, reorder_point, static).astype(np.int64)
+    plan['order_up_to'] = np.where(history, np.maximum(order_up_to, reorder_point), static).astype(np.int64)
+    
+    position = plan['on_hand'] + plan['on_order']
+    plan['order_qty'] = (plan['order_up_to'] - position).where(position <= plan['reorder_point'], 0).clip(lower=0)
+    plan = plan[plan['order_qty'] > 0].reset_index()
+    return plan[columns].sort_values(['supplier', 'order_qty'], ascending=[True, False], ignore_index=True)
+
+def reorder_plan():
+    deps = (SALES_COUNTERS_FILE, INVENTORY_FILE, PRODUCTS_FILE, SUPPLIERS_FILE, PURCHASE_ORDERS_FILE)
+    today = get_current_datetime().strftime("%Y-%m-%d")
+    return cached_report("Reorder Plan", (today,), deps, lambda: compute_reorder_plan(
+        load_data(PRODUCTS_FILE), load_data(INVENTORY_FILE), load_data(SUPPLIERS_FILE),
+        load_data(PURCHASE_ORDERS_FILE)))
+
+def create_draft_purchase_orders(plan, username):
+    # One draft PO per supplier, written in a single save; rows without a known supplier are skipped
+    suppliers = load_data(SUPPLIERS_FILE)
+    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
+    now = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+    created = []
     
-    # Update the PO items if partially received and marked as complete
-    if mark_as_complete and po['status'] == 'partially_received':
-        # Adjust PO items to only include remaining quantities
-        po['items'] = [
-            {
-                'barcode': item['barcode'],
-                'name': item['name'],
-                'quantity': item['ordered_quantity'] - item['received_quantity'],
-                'cost': item['cost']
-            }
-            for item in received_items
-            if item['received_quantity'] < item['ordered_quantity']
-        ]
-    
-    # Update completion info if fully or partially completed
-    if po['status'] in ['received', 'partially_received']:
-        po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-        po['received_by'] = st.session_state.user_info['username']
+    for supplier_id, group in plan.dropna(subset=['supplier_id']).groupby('supplier_id', sort=False):
+        if supplier_id not in suppliers:
+            continue
+        items = [with_cents({
+            'barcode': row.barcode,
+            'name': row.name,
+            'quantity': int(row.order_qty),
+            'cost': row.cost
+        }, ['cost']) for row in group.itertuples(index=False)]
+        total_cost_cents = sum(item['quantity'] * item['cost_cents'] for item in items)
+        po_id = generate_short_id()
+        purchase_orders[po_id] = {
+            'po_id': po_id,
+            'supplier_id': supplier_id,
+            'supplier_name': suppliers[supplier_id]['name'],
+            'date_created': now,
+            'created_by': username,
+            'items': items,
+            'total_cost': from_cents(total_cost_cents),
+            'total_cost_cents': total_cost_cents,
+            'status': 'draft',
+            'source': 'reorder',
+            'date_received': None,
+            'received_by': None
+        }
+        created.append(po_id)
     
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    save_data(inventory, INVENTORY_FILE)
-    return True
+    if created:
+        save_data(purchase_orders, PURCHASE_ORDERS_FILE)
+    return created
+
+# Stockout forecasting
+# Per-SKU daily demand is fitted once a day over the last FORECAST_HISTORY_DAYS
+# complete days of TRANSACTIONS_FILE. Each SKU's history starts at its first sale;
+# smooth sellers get simple exponential smoothing and intermittent ones (average
+# interval between sales above FORECAST_CROSTON_ADI) Croston's method with the
+# Syntetos-Boylan bias correction. The recursions step through the days with
+# every SKU updated at once. Only the rates are stored in FORECAST_FILE, so days
+# until stockout are projected against live stock levels.
+def sales_history_matrix(transactions, days, end):
+    index = pd.date_range(end=pd.Timestamp(end), periods=days, freq='D')
+    start = index[0].strftime("%Y-%m-%d")
+    last = index[-1].strftime("%Y-%m-%d")
+    rows = []
+    for t in transactions.values():
+        day = str(t.get('date', ''))[:10]
+        if start <= day <= last:
+            for barcode, item in t.get('items', {}).items():
+                rows.append((day, barcode, item.get('quantity', 0)))
+    if not rows:
+        return pd.DataFrame(index=index, dtype=np.float64)
+    frame = pd.DataFrame(rows, columns=['day', 'barcode', 'units'])
+    matrix = frame.pivot_table(index='day', columns='barcode', values='units', aggfunc='sum', fill_value=0)
+    matrix.index = pd.to_datetime(matrix.index)
+    return matrix.reindex(index, fill_value=0).clip(lower=0).astype(np.float64)
+
+def fit_demand_forecasts(matrix):
+    units = matrix.to_numpy(dtype=np.float64)
+    sku_count = units.shape[1]
+    sold = units > 0
+    sales_days = sold.sum(axis=0)
+    live = np.cumsum(sold, axis=0) > 0
+    live_days = live.sum(axis=0)
+    adi = np.divide(live_days, sales_days, out=np.zeros(sku_count), where=sales_days > 0)
+    
+    # Initial states: mean daily demand since the first sale, mean sale size and interval
+    level = np.divide(units.sum(axis=0), live_days, out=np.zeros(sku_count), where=live_days > 0)
+    size = np.divide(units.sum(axis=0), sales_days, out=np.zeros(sku_count), where=sales_days > 0)
+    interval = np.maximum(adi, 1.0)
+    since = np.ones(sku_count)
+    a, b = FORECAST_SES_ALPHA, FORECAST_CROSTON_ALPHA
+    started = np.zeros(sku_count, dtype=bool)
+    for day in range(units.shape[0]):
+        y, on, hit = units[day], live[day], sold[day]
+        level = np.where(on, a * y + (1 - a) * level, level)
+        size = np.where(hit, b * y + (1 - b) * size, size)
+        # The first sale has no preceding interval
+        interval = np.where(hit & started, b * since + (1 - b) * interval, interval)
+        since = np.where(hit, 1.0, since + 1)
+        started = on
+    
+    croston = (1 - b / 2) * size / interval
+    intermittent = adi > FORECAST_CROSTON_ADI
+    return pd.DataFrame({
+        'model': np.where(sales_days == 0, 'none', np.where(intermittent, 'croston', 'ses')),
+        'daily_forecast': np.where(sales_days == 0, 0.0, np.where(intermittent, croston, level)),
+        'adi': adi,
+        'sales_days': sales_days
+    }, index=matrix.columns)
+
+def build_stock_forecast(today=None):
+    today = today or get_current_datetime().date()
+    matrix = sales_history_matrix(load_data(TRANSACTIONS_FILE), FORECAST_HISTORY_DAYS, today - timedelta(days=1))
+    fitted = fit_demand_forecasts(matrix)
+    forecast = {
+        'as_of': today.strftime("%Y-%m-%d"),
+        'built_at': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+        'history_days': FORECAST_HISTORY_DAYS,
+        'skus': {barcode: [row.model, round(float(row.daily_forecast), 4), round(float(row.adi), 2)]
+                 for barcode, row in zip(fitted.index, fitted.itertuples(index=False))}
+    }
+    save_data(forecast, FORECAST_FILE)
+    return forecast
+
+def run_stock_forecast_job(job):
+    job.update(0.0, "Fitting demand forecasts")
+    started = time.time()
+    forecast = build_stock_forecast()
+    job.update(0.9, "Writing forecast")
+    output_path = job.output_path()
+    pd.DataFrame.from_dict(forecast['skus'], orient='index', columns=['model', 'daily_forecast', 'adi']) \
+        .rename_axis('barcode').to_csv(output_path)
+    job.message = f"Forecast {len(forecast['skus'])} SKUs in {time.time() - started:.1f}s"
+    return output_path
+
+def submit_stock_forecast_job(owner="system"):
+    runner = get_job_runner()
+    if not runner.find_active("Stock forecast", ()):
+        runner.submit("Stock forecast", run_stock_forecast_job, owner=owner,
+                      file_name=f"stock_forecast_{datetime.date.today()}.csv", params=())
+
+def refresh_stock_forecast():
+    # The first run of each day refits the forecast in the background
+    as_of = cached_report("Stock Forecast Date", (), (FORECAST_FILE,),
+                          lambda: load_data(FORECAST_FILE).get('as_of'))
+    if as_of != get_current_datetime().strftime("%Y-%m-%d"):
+        submit_stock_forecast_job()
+    return as_of
+
+def compute_stockout_projection(forecast, products, inventory, suppliers):
+    columns = ['barcode', 'name', 'quantity', 'model', 'daily_forecast', 'days_to_stockout',
+               'stockout_date', 'lead_time', 'at_risk']
+    skus = forecast.get('skus', {})
+    barcodes = [b for b in inventory if b in products]
+    if not barcodes:
+        return pd.DataFrame(columns=columns)
+    
+    lookup = supplier_lookup(suppliers)
+    lead_times = {k: v.get('lead_time_days', DEFAULT_LEAD_TIME_DAYS) for k, v in suppliers.items()}
+    frame = pd.DataFrame({
+        'barcode': barcodes,
+        'name': [products[b].get('name', '') for b in barcodes],
+        'quantity': np.asarray([max(inventory[b].get('quantity', 0), 0) for b in barcodes], dtype=np.int64),
+        'model': [skus.get(b, ['none'])[0] for b in barcodes],
+        'daily_forecast': np.asarray([skus[b][1] if b in skus else 0.0 for b in barcodes], dtype=np.float64),
+        'lead_time': [lead_times.get(lookup.get(products[b].get('supplier', '')), DEFAULT_LEAD_TIME_DAYS)
+                      for b in barcodes]
+    })
+    rate = frame['daily_forecast'].to_numpy()
+    frame['days_to_stockout'] = np.divide(frame['quantity'].to_numpy(), rate, out=np.full(len(frame), np.inf),
+                                          where=rate > 0)
+    as_of = pd.Timestamp(forecast.get('as_of') or get_current_datetime().date())
+    finite = np.isfinite(frame['days_to_stockout'])
+    frame['stockout_date'] = (as_of + pd.to_timedelta(frame['days_to_stockout'].where(finite), unit='D')).dt.date
+    frame['at_risk'] = frame['days_to_stockout'] < frame['lead_time']
+    return frame[columns].sort_values('days_to_stockout', ignore_index=True)
+
+def stockout_projection():
+    deps = (FORECAST_FILE, INVENTORY_FILE, PRODUCTS_FILE, SUPPLIERS_FILE)
+    return cached_report("Stockout Projection", (), deps, lambda: compute_stockout_projection(
+        load_data(FORECAST_FILE), load_data(PRODUCTS_FILE), load_data(INVENTORY_FILE), load_data(SUPPLIERS_FILE)))
 
 def purchase_orders_management():
     if not is_manager():
@@ -2213,7 +4455,6 @@ def purchase_orders_management():
         
         suppliers = load_data(SUPPLIERS_FILE)
         products = load_data(PRODUCTS_FILE)
-        inventory = load_data(INVENTORY_FILE)
         
         if not suppliers:
             st.warning("No suppliers available. Please add suppliers first.")
@@ -2226,35 +4467,35 @@ def purchase_orders_management():
         if 'po_items' not in st.session_state:
             st.session_state.po_items = []
         
-        # Display low stock items
-        low_stock_items = []
-        for barcode, inv_data in inventory.items():
-            if barcode in products and inv_data.get('quantity', 0) < inv_data.get('reorder_point', 10):
-                product = products[barcode]
-                low_stock_items.append({
-                    'barcode': barcode,
-                    'name': product['name'],
-                    'current_stock': inv_data.get('quantity', 0),
-                    'reorder_point': inv_data.get('reorder_point', 10),
-                    'cost': product.get('cost', 0),
-                    'quantity': max(inv_data.get('reorder_point', 10) - inv_data.get('quantity', 0), 1)
-                })
-        
-        if low_stock_items:
-            st.info("The following items are below reorder point:")
-            low_stock_df = pd.DataFrame(low_stock_items)
-            st.dataframe(low_stock_df[['name', 'current_stock', 'reorder_point', 'cost']])
-            
-            if st.button("Add All Low Stock Items to PO"):
-                for item in low_stock_items:
-                    if not any(i['barcode'] == item['barcode'] for i in st.session_state.po_items):
-                        st.session_state.po_items.append({
-                            'barcode': item['barcode'],
-                            'name': item['name'],
-                            'quantity': item['quantity'],
-                            'cost': item['cost']
-                        })
-                st.rerun()
+        # Demand-driven suggestions across the whole catalog
+        st.subheader("Reorder Suggestions")
+        plan = reorder_plan()
+        if plan.empty:
+            st.info("No items need reordering at current demand and stock levels")
+        else:
+            unassigned = plan['supplier_id'].isna()
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Items to Reorder", len(plan))
+            col2.metric("Suppliers", plan.loc[~unassigned, 'supplier_id'].nunique())
+            col3.metric("Estimated Cost", format_cents(int((plan['order_qty'] * cents_array(plan['cost'])).sum())))
+            
+            display = plan.rename(columns={
+                'name': 'Product', 'supplier': 'Supplier', 'on_hand': 'On Hand', 'on_order': 'On Order',
+                'daily_demand': 'Daily Demand', 'lead_time': 'Lead Time (days)', 'safety_stock': 'Safety Stock',
+                'reorder_point': 'Reorder Point', 'order_up_to': 'Order Up To', 'order_qty': 'Suggested Qty'
+            })
+            display['Daily Demand'] = display['Daily Demand'].round(2)
+            st.dataframe(display[['Product', 'Supplier', 'On Hand', 'On Order', 'Daily Demand', 'Lead Time (days)',
+                                  'Safety Stock', 'Reorder Point', 'Order Up To', 'Suggested Qty']])
+            if unassigned.any():
+                st.warning(f"{int(unassigned.sum())} suggested items have no matching supplier and will not be included in draft POs")
+            
+            if st.button("Generate Draft POs"):
+                created = create_draft_purchase_orders(plan, st.session_state.user_info['username'])
+                if created:
+                    st.success(f"Created {len(created)} draft purchase orders. Review and submit them under View POs.")
+                else:
+                    st.warning("No draft purchase orders were created")
         
         with st.form("po_form"):
             supplier_options = {f"{v['name']} ({k})": k for k, v in suppliers.items()}
@@ -2364,7 +4605,7 @@ def purchase_orders_management():
         else:
             col1, col2 = st.columns(2)
             with col1:
-                status_filter = st.selectbox("Filter by Status", ["All", "pending", "partially_received", "received"])
+                status_filter = st.selectbox("Filter by Status", ["All", "draft", "pending", "partially_received", "received"])
             with col2:
                 supplier_filter = st.selectbox("Filter by Supplier", ["All"] + list(set(po['supplier_name'] for po in purchase_orders.values())))
             
@@ -2433,6 +4674,23 @@ def purchase_orders_management():
                             receipt_df = pd.DataFrame(receipt['items'])
                             st.dataframe(receipt_df)
                     
+                    if po['status'] == 'draft':
+                        col1, col2 = st.columns(2)
+                        with col1:
+                            if st.button("Submit PO"):
+                                po['status'] = 'pending'
+                                po['submitted_by'] = st.session_state.user_info['username']
+                                po['date_submitted'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                                save_data(purchase_orders, PURCHASE_ORDERS_FILE)
+                                st.success("Purchase order submitted")
+                                st.rerun()
+                        with col2:
+                            if st.button("Discard Draft"):
+                                del purchase_orders[po_id]
+                                save_data(purchase_orders, PURCHASE_ORDERS_FILE)
+                                st.success("Draft discarded")
+                                st.rerun()
+                    
                     if st.button("Print PO"):
                         po_report = generate_po_report(po_id)
                         if print_receipt(po_report):
@@ -2520,10 +4778,10 @@ def generate_purchase_order(supplier_id, items):
     po_id = generate_short_id()
     
     # Calculate totals
-    total_cost = 0
+    total_cost_cents = 0
     for item in items:
         product = products.get(item['barcode'], {})
-        total_cost += item['quantity'] * product.get('cost', 0)
+        total_cost_cents += item['quantity'] * to_cents(product.get('cost', 0))
     
     # Create PO
     purchase_orders[po_id] = {
@@ -2532,8 +4790,9 @@ def generate_purchase_order(supplier_id, items):
         'supplier_name': supplier['name'],
         'date_created': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
         'created_by': st.session_state.user_info['username'],
-        'items': items,
-        'total_cost': total_cost,
+        'items': [with_cents(dict(item), ['cost']) for item in items],
+        'total_cost': from_cents(total_cost_cents),
+        'total_cost_cents': total_cost_cents,
         'status': 'pending',
         'date_received': None,
         'received_by': None
@@ -2566,10 +4825,10 @@ def generate_po_report(po_id):
         product = products.get(item['barcode'], {'name': 'Unknown', 'cost': 0})
         report += f"{item['barcode']}\t{product['name']}\t{item['quantity']}\t"
         report += f"{format_currency(product.get('cost', 0))}\t"
-        report += f"{format_currency(item['quantity'] * product.get('cost', 0))}\n"
+        report += f"{format_cents(item['quantity'] * to_cents(product.get('cost', 0)))}\n"
     
     report += "=" * 50 + "\n"
-    report += f"TOTAL COST: {format_currency(po['total_cost'])}\n"
+    report += f"TOTAL COST: {format_cents(cents_of(po, 'total_cost'))}\n"
     report += f"STATUS: {po['status'].upper()}\n"
     
     if po['status'] == 'received':
@@ -2578,78 +4837,448 @@ def generate_po_report(po_id):
     return report
 
 def process_received_po(po_id, received_items, notes, mark_as_complete=False):
-    purchase_orders = load_data(PURCHASE_ORDERS_FILE)
-    inventory = load_data(INVENTORY_FILE)
-    products = load_data(PRODUCTS_FILE)
+    with get_inventory_lock():
+        purchase_orders = load_data(PURCHASE_ORDERS_FILE)
+        inventory = load_data(INVENTORY_FILE)
+        products = load_data(PRODUCTS_FILE)
     
-    if po_id not in purchase_orders:
-        return False
+        if po_id not in purchase_orders:
+            return False
     
-    po = purchase_orders[po_id]
+        po = purchase_orders[po_id]
     
-    if po['status'] == 'received':
-        return True  # Already fully processed
+        if po['status'] == 'received':
+            return True  # Already fully processed
     
-    # Initialize receipts if not exists
-    if 'receipts' not in po:
-        po['receipts'] = []
+        # Initialize receipts if not exists
+        if 'receipts' not in po:
+            po['receipts'] = []
     
-    # Update inventory only for received items
-    for item in received_items:
-        if item['received_quantity'] > 0:
-            barcode = item['barcode']
+        # Update inventory only for received items
+        movements = []
+        for item in received_items:
+            if item['received_quantity'] > 0:
+                barcode = item['barcode']
+                previous_qty = inventory.get(barcode, {}).get('quantity', 0)
+            
+                if barcode in inventory:
+                    inventory[barcode]['quantity'] += item['received_quantity']
+                else:
+                    # Initialize inventory with default values if product doesn't exist in inventory
+                    inventory[barcode] = {
+                        'quantity': item['received_quantity'],
+                        'reorder_point': 10,  # Default reorder point
+                        'cost': products.get(barcode, {}).get('cost', 0)  # Get cost from products if available
+                    }
             
+                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+                movements.append(stock_movement(barcode, 'Receipt', previous_qty, inventory[barcode]['quantity'],
+                                                reference=po_id, notes=notes,
+                                                user=st.session_state.user_info['username'],
+                                                unit_cost_cents=cents_of(item, 'cost')))
+    
+        # Update PO status
+        if all(item['received_quantity'] == item['ordered_quantity'] for item in received_items):
+            po['status'] = 'received'
+        elif mark_as_complete:
+            po['status'] = 'partially_received'
+        else:
+            po['status'] = 'pending'  # Still waiting for more items
+    
+        # Add receipt details to PO
+        po['receipts'].append({
+            'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+            'received_by': st.session_state.user_info['username'],
+            'items': received_items,
+            'notes': notes
+        })
+    
+        # Update the PO items if partially received and marked as complete
+        if mark_as_complete and po['status'] == 'partially_received':
+            # Adjust PO items to only include remaining quantities
+            po['items'] = [
+                {
+                    'barcode': item['barcode'],
+                    'name': item['name'],
+                    'quantity': item['ordered_quantity'] - item['received_quantity'],
+                    'cost': item['cost']
+                }
+                for item in received_items
+                if item['received_quantity'] < item['ordered_quantity']
+            ]
+    
+        # Update completion info if fully or partially completed
+        if po['status'] in ['received', 'partially_received']:
+            po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+            po['received_by'] = st.session_state.user_info['username']
+    
+        save_data(purchase_orders, PURCHASE_ORDERS_FILE)
+        save_data(inventory, INVENTORY_FILE)
+        record_stock_movements(movements)
+        return True
+
+# Bulk product import
+# The CSV is read in chunks of PRODUCT_IMPORT_CHUNK_ROWS rows as strings and each
+# chunk is validated column-wise; the first failing check of a row is its error.
+# Errors are (source row, message) pairs, where row 2 is the first data line.
+# Rows are merged into the loaded data files, which are written once at the end.
+def iter_product_import_chunks(source, chunk_rows=PRODUCT_IMPORT_CHUNK_ROWS):
+    reader = pd.read_csv(source, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+    first_row = 2
+    for chunk in reader:
+        chunk = chunk.rename(columns=lambda c: str(c).strip().lower())
+        present = [c for c in PRODUCT_IMPORT_COLUMNS if c in chunk.columns]
+        chunk = chunk.reindex(columns=PRODUCT_IMPORT_COLUMNS, fill_value="")
+        chunk[present] = chunk[present].apply(lambda col: col.str.strip())
+        chunk.index = pd.RangeIndex(first_row, first_row + len(chunk), name='row')
+        first_row += len(chunk)
+        yield chunk
+
+def _flag_rows(errors, mask, message):
+    # Only rows without an earlier error take the new message
+    mask = mask & errors.isna()
+    if mask.any():
+        errors[mask] = message[mask] if isinstance(message, pd.Series) else message
+    return errors
+
+def parse_product_values(chunk):
+    # Blank cells take the default, unparseable ones are left as NaN for the validators
+    values = pd.DataFrame({
+        column: pd.to_numeric(chunk[column].replace("", default), errors='coerce')
+        for column, default in (('price', 0.0), ('cost', 0.0), ('initial_stock', 0), ('reorder_point', 10))
+    }, index=chunk.index)
+    values['active'] = ~chunk['active'].str.lower().isin(["false", "0", "no", "n"])
+    return values
+
+# Import validation
+# Validators are registered in order with a stage: 'record' checks run before the
+# import mode decides whether a row is skipped, 'values' checks only count for rows
+# that would be imported. Each takes (chunk, values, context) and returns a list of
+# (mask, message) pairs.
+PRODUCT_VALIDATORS = []
+
+def product_validator(stage):
+    def register(func):
+        PRODUCT_VALIDATORS.append((stage, func))
+        return func
+    return register
+
+@product_validator('record')
+def validate_product_name(chunk, values, context):
+    return [(chunk['name'] == "", "Missing product name")]
+
+@product_validator('record')
+def validate_product_barcode(chunk, values, context):
+    barcodes = chunk['barcode']
+    checks = []
+    if not context['generate_barcodes']:
+        checks.append(((barcodes == "") | (barcodes == "AUTO_GENERATE"), "Missing barcode and generation disabled"))
+    checks.append((~barcodes.str.fullmatch(r"\d*"),
+                   "Invalid barcode format '" + barcodes + "' - must be digits only"))
+    checks.append((~barcodes.str.len().isin([12, 13]),
+                   "Invalid barcode length '" + barcodes + "' - must be 12 or 13 digits"))
+    return checks
+
+@product_validator('values')
+def validate_product_prices(chunk, values, context):
+    return [
+        (~np.isfinite(values['price']), "Price must be a number"),
+        (values['price'] <= 0, "Price must be greater than 0"),
+        (~np.isfinite(values['cost']), "Cost must be a number"),
+        (values['cost'] <= 0, "Cost must be greater than 0")
+    ]
+
+@product_validator('values')
+def validate_product_stock(chunk, values, context):
+    checks = []
+    for column, label in (('initial_stock', "Initial stock"), ('reorder_point', "Reorder point")):
+        column_values = values[column]
+        checks.append((~np.isfinite(column_values) | (column_values % 1 > 0), label + " must be a whole number"))
+        checks.append((column_values < 0, label + " cannot be negative"))
+        checks.append((column_values > STOCK_QUANTITY_LIMIT, f"{label} cannot exceed {STOCK_QUANTITY_LIMIT:,}"))
+    return checks
+
+@product_validator('values')
+def validate_product_references(chunk, values, context):
+    if not context['require_references']:
+        return []
+    checks = []
+    for column, known, label in (('category', context['categories'], "Category"),
+                                 ('brand', context['brands'], "Brand"),
+                                 ('supplier', context['suppliers'], "Supplier")):
+        column_values = chunk[column]
+        checks.append(((column_values != "") & ~column_values.isin(known),
+                       label + " '" + column_values + "' does not exist"))
+    return checks
+
+def product_import_context(generate_barcodes=True, require_references=False):
+    categories_data = load_data(CATEGORIES_FILE)
+    suppliers = load_data(SUPPLIERS_FILE)
+    return {
+        'generate_barcodes': generate_barcodes,
+        'require_references': require_references,
+        'categories': set(categories_data.get('categories', [])),
+        'brands': set(load_data(BRANDS_FILE).get('brands', [])),
+        # Suppliers may be given by name or id
+        'suppliers': set(suppliers) | {s.get('name') for s in suppliers.values() if isinstance(s, dict)}
+    }
+
+def validate_product_chunk(chunk, context):
+    if context['generate_barcodes']:
+        missing = (chunk['barcode'] == "") | (chunk['barcode'] == "AUTO_GENERATE")
+        chunk.loc[missing, 'barcode'] = [generate_barcode() for _ in range(int(missing.sum()))]
+    values = parse_product_values(chunk)
+    stage_errors = {}
+    for stage, validator in PRODUCT_VALIDATORS:
+        errors = stage_errors.setdefault(stage, pd.Series(np.nan, index=chunk.index, dtype=object))
+        for mask, message in validator(chunk, values, context):
+            _flag_rows(errors, mask, message)
+    return chunk, values, stage_errors
+
+def iter_validated_product_chunks(source, context, chunk_rows=PRODUCT_IMPORT_CHUNK_ROWS):
+    # Chunks are validated serially: sending each validated chunk back from a worker
+    # process cost more than the vectorised checks it saved
+    for chunk in iter_product_import_chunks(source, chunk_rows):
+        yield validate_product_chunk(chunk, context)
+
+def import_products_csv(source, import_mode, generate_barcodes=True, stop_on_error=False,
+                        username=None, progress=None, chunk_rows=PRODUCT_IMPORT_CHUNK_ROWS,
+                        require_references=False, dry_run=False):
+    # With dry_run the rows are validated and counted but nothing is written
+    products = load_data(PRODUCTS_FILE)
+    categories_data = load_data(CATEGORIES_FILE)
+    categories_data.setdefault('categories', [])
+    categories_data.setdefault('subcategories', {})
+    brands_data = load_data(BRANDS_FILE)
+    brands_data.setdefault('brands', [])
+    brand_products = brands_data.setdefault('brand_products', {})
+    known_categories = set(categories_data['categories'])
+    known_brands = set(brands_data['brands'])
+    existing = set(products)
+    seen = {}
+    stock_updates = {}
+    now = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+    
+    results = {'rows': 0, 'processed': 0, 'added': 0, 'updated': 0, 'skipped': 0, 'errors': []}
+    
+    context = product_import_context(generate_barcodes, require_references)
+    chunks = iter_validated_product_chunks(source, context, chunk_rows)
+    for chunk, values, stage_errors in chunks:
+        results['rows'] += len(chunk)
+        barcodes = chunk['barcode']
+        errors = stage_errors['record']
+        
+        exists = barcodes.isin(existing)
+        if import_mode == "Add new products only":
+            mode_skip = exists & errors.isna()
+        elif import_mode == "Update existing products":
+            mode_skip = ~exists & errors.isna()
+        else:
+            mode_skip = pd.Series(False, index=chunk.index)
+        value_errors = stage_errors['values']
+        _flag_rows(errors, value_errors.notna() & ~mode_skip, value_errors)
+        
+        # Set-based duplicate detection over the rows that would be imported, across chunks
+        candidates = errors.isna() & ~mode_skip
+        first_seen = barcodes[candidates].map(seen)
+        rows_by_barcode = pd.Series(chunk.index[candidates], index=first_seen.index).groupby(barcodes[candidates])
+        first_row = first_seen.fillna(rows_by_barcode.transform('min')).astype(int)
+        repeated = barcodes[candidates].duplicated() | first_seen.notna()
+        _flag_rows(errors, repeated.reindex(chunk.index, fill_value=False),
+                   ("Duplicate barcode '" + barcodes + "' (first seen on row " +
+                    first_row.astype(str).reindex(chunk.index, fill_value="") + ")"))
+        
+        failed = errors.notna()
+        stop = stop_on_error and failed.any()
+        if stop:
+            # Keep only the rows before the first error, as a row-by-row import would
+            cutoff = failed.idxmax()
+            in_range = chunk.index <= cutoff
+            failed, mode_skip, chunk, values, exists = (failed[in_range], mode_skip[in_range],
+                                                        chunk[in_range], values[in_range], exists[in_range])
+            errors = errors[in_range]
+            barcodes = chunk['barcode']
+        
+        results['errors'].extend(zip(errors[failed].index.tolist(), errors[failed].tolist()))
+        results['skipped'] += int(failed.sum()) + int(mode_skip.sum())
+        
+        ok = ~failed & ~mode_skip
+        processed = int(ok.sum())
+        updated = int(exists[ok].sum())
+        results['processed'] += processed
+        results['updated'] += updated
+        results['added'] += processed - updated
+        # existing stays the pre-import catalogue, so a barcode repeated in a later
+        # chunk is reported as a duplicate in every mode, whatever the chunk size
+        seen.update(zip(barcodes[ok], chunk.index[ok]))
+        if progress:
+            progress(results['rows'])
+        if dry_run:
+            if stop:
+                break
+            continue
+        
+        rows = chunk[ok].drop(columns=['price', 'cost', 'initial_stock', 'reorder_point', 'active'])
+        rows = rows.join(values[ok].astype({'price': float, 'cost': float,
+                                            'initial_stock': np.int64, 'reorder_point': np.int64}))
+        rows['supplier'] = rows['supplier'].where(rows['supplier'] != "", None)
+        
+        for record, is_update in zip(rows.to_dict('records'), exists[ok].tolist()):
+            barcode = record['barcode']
+            stock = record.pop('initial_stock')
+            reorder_point = record.pop('reorder_point')
+            record['last_updated'] = now
+            if is_update:
+                record['updated_by'] = username
+                record['date_added'] = products[barcode].get('date_added')
+            else:
+                record['date_added'] = now
+                record['added_by'] = username
+            products[barcode] = record
+            stock_updates[barcode] = (stock, reorder_point, to_cents(record['cost']))
+        
+        # New categories and brands, and the brand to product mapping
+        for category in set(rows['category'].unique()) - known_categories - {""}:
+            categories_data['categories'].append(category)
+            categories_data['subcategories'][category] = []
+            known_categories.add(category)
+        for brand, brand_barcodes in rows[rows['brand'] != ""].groupby('brand')['barcode']:
+            if brand not in known_brands:
+                brands_data['brands'].append(brand)
+                known_brands.add(brand)
+            listed = brand_products.setdefault(brand, [])
+            listed_set = set(listed)
+            listed.extend(b for b in brand_barcodes if b not in listed_set)
+        if stop:
+            break
+    chunks.close()
+    
+    if dry_run:
+        return results
+    update_records(PRODUCTS_FILE, {barcode: products[barcode] for barcode in stock_updates})
+    save_data(categories_data, CATEGORIES_FILE)
+    save_data(brands_data, BRANDS_FILE)
+    
+    # Stock is merged into the current inventory under the lock, so sales made
+    # while the file was being validated are kept
+    with get_inventory_lock():
+        inventory = load_data(INVENTORY_FILE)
+        movements = []
+        for barcode, (stock, reorder_point, unit_cost_cents) in stock_updates.items():
             if barcode in inventory:
-                inventory[barcode]['quantity'] += item['received_quantity']
+                inventory[barcode]['reorder_point'] = reorder_point
+                inventory[barcode]['last_updated'] = now
+                inventory[barcode]['updated_by'] = username
             else:
-                # Initialize inventory with default values if product doesn't exist in inventory
                 inventory[barcode] = {
-                    'quantity': item['received_quantity'],
-                    'reorder_point': 10,  # Default reorder point
-                    'cost': products.get(barcode, {}).get('cost', 0)  # Get cost from products if available
+                    'quantity': stock,
+                    'reorder_point': reorder_point,
+                    'last_updated': now,
+                    'updated_by': username
                 }
-            
-            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-    
-    # Update PO status
-    if all(item['received_quantity'] == item['ordered_quantity'] for item in received_items):
-        po['status'] = 'received'
-    elif mark_as_complete:
-        po['status'] = 'partially_received'
+                if stock:
+                    movements.append(stock_movement(barcode, 'Initial Stock', 0, stock, notes="Product import",
+                                                    user=username, date=now, unit_cost_cents=unit_cost_cents))
+        save_data(inventory, INVENTORY_FILE)
+        record_stock_movements(movements)
+    return results
+
+# Mass repricing
+# A repricing rule selects products by category/brand/supplier and changes their
+# price by a percentage or a fixed amount, optionally rounding to .99 or whole units
+# and keeping a minimum margin over cost. It is computed in integer cents over the
+# whole catalogue at once; the preview and the applied change use the same code.
+PRICE_ROUNDING_OPTIONS = ["No rounding", "Round to .99", "Round to whole"]
+
+def record_price_history(changes, source, user=None, details=None, when=None):
+    # changes: {barcode: (old_price, new_price)}; one history entry per batch
+    if not changes:
+        return None
+    batch_id = generate_short_id()
+    update_records(PRICE_HISTORY_FILE, {batch_id: {
+        'date': when or get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
+        'source': source,
+        'user': user,
+        'details': details or {},
+        'changes': {barcode: {'old_price': old, 'new_price': new} for barcode, (old, new) in changes.items()}
+    }})
+    return batch_id
+
+def products_price_frame(products):
+    frame = pd.DataFrame(
+        [(p.get('name', ''), p.get('category', ''), p.get('brand', ''), p.get('supplier') or '',
+          p.get('price', 0) or 0, p.get('cost', 0) or 0) for p in products.values()],
+        index=pd.Index(list(products.keys()), name='barcode'),
+        columns=['name', 'category', 'brand', 'supplier', 'price', 'cost']
+    )
+    frame['price_cents'] = cents_array(frame['price'])
+    frame['cost_cents'] = cents_array(frame['cost'])
+    return frame
+
+def _round_prices(cents, rounding, up=False):
+    step = np.ceil if up else np.rint
+    if rounding == "Round to .99":
+        return np.maximum(step((cents + 1) / MONEY_SCALE) * MONEY_SCALE - 1, MONEY_SCALE - 1).astype(np.int64)
+    if rounding == "Round to whole":
+        return np.maximum(step(cents / MONEY_SCALE) * MONEY_SCALE, MONEY_SCALE).astype(np.int64)
+    return np.asarray(cents, dtype=np.int64)
+
+def compute_repricing(products, rule):
+    frame = products_price_frame(products)
+    selected = pd.Series(True, index=frame.index)
+    for column in ('category', 'brand', 'supplier'):
+        if rule.get(column):
+            selected &= frame[column].isin(rule[column])
+    frame = frame[selected]
+    
+    old = frame['price_cents'].to_numpy()
+    if rule['change_type'] == "Percentage":
+        new = np.rint(old * (1 + rule['amount'] / 100))
     else:
-        po['status'] = 'pending'  # Still waiting for more items
-    
-    # Add receipt details to PO
-    po['receipts'].append({
-        'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-        'received_by': st.session_state.user_info['username'],
-        'items': received_items,
-        'notes': notes
-    })
-    
-    # Update the PO items if partially received and marked as complete
-    if mark_as_complete and po['status'] == 'partially_received':
-        # Adjust PO items to only include remaining quantities
-        po['items'] = [
-            {
-                'barcode': item['barcode'],
-                'name': item['name'],
-                'quantity': item['ordered_quantity'] - item['received_quantity'],
-                'cost': item['cost']
-            }
-            for item in received_items
-            if item['received_quantity'] < item['ordered_quantity']
-        ]
-    
-    # Update completion info if fully or partially completed
-    if po['status'] in ['received', 'partially_received']:
-        po['date_received'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-        po['received_by'] = st.session_state.user_info['username']
-    
-    save_data(purchase_orders, PURCHASE_ORDERS_FILE)
-    save_data(inventory, INVENTORY_FILE)
-    return True
+        new = old + to_cents(rule['amount'])
+    new = _round_prices(np.maximum(new, 1), rule.get('rounding'))
+    # Unpriced items are left alone, and the floors only hold up prices the rule changed
+    changed = (old > 0) & (new != old)
+    new = np.where(changed, new, old)
+    
+    floor_applied = np.zeros(len(frame), dtype=bool)
+    if rule.get('min_margin') is not None:
+        floor = _round_prices(np.ceil(frame['cost_cents'].to_numpy() * (1 + rule['min_margin'] / 100)),
+                              rule.get('rounding'), up=True)
+        # A price cut is held at the floor, never turned into an increase
+        floor = np.where(new < old, np.minimum(floor, old), floor)
+        floor_applied = changed & (new < floor)
+        new = np.where(floor_applied, floor, new)
+    
+    preview = pd.DataFrame({
+        'name': frame['name'],
+        'category': frame['category'],
+        'brand': frame['brand'],
+        'cost': frame['cost_cents'] / MONEY_SCALE,
+        'old_price': old / MONEY_SCALE,
+        'new_price': new / MONEY_SCALE,
+        'change_pct': np.where(old > 0, (new - old) / np.maximum(old, 1) * 100, 0.0).round(2),
+        'margin_floor': floor_applied
+    }, index=frame.index)
+    return preview[changed & (new != old)]
+
+def apply_repricing(rule, username):
+    with get_file_lock(PRODUCTS_FILE):
+        products = load_data(PRODUCTS_FILE)
+        preview = compute_repricing(products, rule)
+        if preview.empty:
+            return preview, None
+        now = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+        changes = {}
+        for barcode, old_price, new_price in zip(preview.index, preview['old_price'].tolist(), preview['new_price'].tolist()):
+            product = products[barcode]
+            changes[barcode] = (product.get('price'), new_price)
+            product['price'] = new_price
+            product['price_updated_at'] = now
+        save_data(products, PRODUCTS_FILE)
+        batch_id = record_price_history(changes, "Mass price update", username, rule, now)
+    return preview, batch_id
 
 # product Management 
 def product_management():
@@ -2659,13 +5288,14 @@ def product_management():
     
     st.title("Product Management")
     
-    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
         "Add Product", 
         "View/Edit Products", 
         "Delete Product", 
         "Bulk Import", 
         "Template Management",
-        "Category Management"
+        "Category Management",
+        "Mass Price Update"
     ])
     
     # Helper function to load categories with proper structure
@@ -2825,7 +5455,6 @@ def product_management():
                         st.error(error)
                 else:
                     products = load_data(PRODUCTS_FILE)
-                    inventory = load_data(INVENTORY_FILE)
                     
                     # Generate barcode if needed
                     if not barcode or barcode_option == "Generate Automatically":
@@ -2865,7 +5494,7 @@ def product_management():
                             products[barcode]['image'] = image_path
                         
                         # Initialize inventory
-                        inventory[barcode] = {
+                        inventory_item = {
                             'quantity': initial_stock,
                             'reorder_point': reorder_point,
                             'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
@@ -2883,8 +5512,15 @@ def product_management():
                             brands_data['brand_products'] = brand_products
                             save_data(brands_data, BRANDS_FILE)
                         
-                        save_data(products, PRODUCTS_FILE)
-                        save_data(inventory, INVENTORY_FILE)
+                        update_records(PRODUCTS_FILE, {barcode: products[barcode]})
+                        with get_inventory_lock():
+                            inventory = load_data(INVENTORY_FILE)
+                            inventory[barcode] = inventory_item
+                            save_data(inventory, INVENTORY_FILE)
+                            if initial_stock:
+                                record_stock_movements([stock_movement(barcode, 'Initial Stock', 0, initial_stock,
+                                                                       user=st.session_state.user_info['username'],
+                                                                       unit_cost_cents=to_cents(cost))])
                         st.success(f"Product '{name}' added successfully with barcode: {barcode}")
 
     with tab2:
@@ -3113,12 +5749,6 @@ def product_management():
                                         f.write(new_image.getbuffer())
                                     products[barcode]['image'] = image_path
                                 
-                                # Update inventory
-                                inventory[barcode]['quantity'] = new_stock
-                                inventory[barcode]['reorder_point'] = reorder_point
-                                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                                
                                 # Update brand mapping if brand changed
                                 old_brand = product.get('brand')
                                 if old_brand != brand:
@@ -3139,8 +5769,22 @@ def product_management():
                                     brands_data['brand_products'] = brand_products
                                     save_data(brands_data, BRANDS_FILE)
                                 
-                                save_data(products, PRODUCTS_FILE)
-                                save_data(inventory, INVENTORY_FILE)
+                                update_records(PRODUCTS_FILE, {barcode: products[barcode]})
+                                
+                                # Update inventory
+                                with get_inventory_lock():
+                                    inventory = load_data(INVENTORY_FILE)
+                                    inventory_item = inventory.setdefault(barcode, {})
+                                    previous_qty = inventory_item.get('quantity', 0)
+                                    inventory_item['quantity'] = new_stock
+                                    inventory_item['reorder_point'] = reorder_point
+                                    inventory_item['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                                    inventory_item['updated_by'] = st.session_state.user_info['username']
+                                    save_data(inventory, INVENTORY_FILE)
+                                    if new_stock != previous_qty:
+                                        record_stock_movements([stock_movement(barcode, 'Set Stock', previous_qty, new_stock,
+                                                                               notes="Product edit",
+                                                                               user=st.session_state.user_info['username'])])
                                 st.success("Product updated successfully")
                                 
     with tab3:
@@ -3198,8 +5842,7 @@ def product_management():
                         st.write(f"**Status:** {'Active' if product.get('active', True) else 'Inactive'}")
                     
                     # Check if product has sales history
-                    transactions = load_data(TRANSACTIONS_FILE)
-                    has_sales = any(barcode in t.get('items', {}) for t in transactions.values())
+                    has_sales = get_sales_counters().has_sales(barcode)
                     
                     if has_sales:
                         st.error("⚠️ This product has sales history. Deleting it may affect reports.")
@@ -3217,7 +5860,7 @@ def product_management():
                             products[barcode]['active'] = False
                             products[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
                             products[barcode]['updated_by'] = st.session_state.user_info['username']
-                            save_data(products, PRODUCTS_FILE)
+                            update_records(PRODUCTS_FILE, {barcode: products[barcode]})
                             st.success("Product deactivated successfully")
                         else:
                             # Permanent deletion
@@ -3230,8 +5873,6 @@ def product_management():
                             
                             # Remove from products and inventory
                             del products[barcode]
-                            if barcode in inventory:
-                                del inventory[barcode]
                             
                             # Remove from brand mapping
                             brand = product.get('brand')
@@ -3243,8 +5884,17 @@ def product_management():
                                 brands_data['brand_products'] = brand_products
                                 save_data(brands_data, BRANDS_FILE)
                             
-                            save_data(products, PRODUCTS_FILE)
-                            save_data(inventory, INVENTORY_FILE)
+                            update_records(PRODUCTS_FILE, removed=[barcode])
+                            with get_inventory_lock():
+                                inventory = load_data(INVENTORY_FILE)
+                                if barcode in inventory:
+                                    # Write the remaining stock off so the ledger and valuation end at zero
+                                    previous_qty = inventory.pop(barcode).get('quantity', 0)
+                                    save_data(inventory, INVENTORY_FILE)
+                                    if previous_qty:
+                                        record_stock_movements([stock_movement(
+                                            barcode, 'Delete', previous_qty, 0, notes="Product permanently deleted",
+                                            user=st.session_state.user_info['username'])])
                             st.success("Product permanently deleted")
 
     with tab4:
@@ -3288,13 +5938,13 @@ def product_management():
         
         if uploaded_file:
             try:
-                # Read and preview the CSV
-                df = pd.read_csv(uploaded_file)
+                # Preview the first rows; the import streams the file in chunks
+                df = pd.read_csv(uploaded_file, nrows=5)
                 st.success("CSV file loaded successfully")
                 
                 # Show preview
                 st.write("**Data Preview:**")
-                st.dataframe(df.head())
+                st.dataframe(df)
                 
                 # Validation options
                 st.subheader("Import Options")
@@ -3306,183 +5956,65 @@ def product_management():
                                           key="import_mode")
                     on_error = st.radio("On Error", 
                                        ["Skip row and continue", "Stop import"],
+                                       help="Stop import keeps the rows before the first invalid row "
+                                            "(bad value, missing field or duplicate barcode) and reads no further",
                                        key="on_error")
                 
                 with col2:
                     generate_barcodes = st.checkbox("Generate missing barcodes", value=True,
                                                   help="Automatically generate barcodes for rows with empty or AUTO_GENERATE values",
                                                   key="generate_barcodes")
-                    validate_data = st.checkbox("Validate data before import", value=True,
-                                              help="Check for data issues before importing",
-                                              key="validate_data")
+                    require_references = st.checkbox("Reject unknown categories, brands and suppliers", value=False,
+                                                     help="Otherwise new categories and brands are created",
+                                                     key="require_references")
                 
-                if st.button("Validate Data" if validate_data else "Import Products", key="import_btn"):
-                    products = load_data(PRODUCTS_FILE)
-                    inventory = load_data(INVENTORY_FILE)
-                    categories_data = load_categories_data()
-                    brands_data = load_data(BRANDS_FILE)
-                    suppliers = load_data(SUPPLIERS_FILE)
-                    
-                    results = {
-                        'processed': 0,
-                        'added': 0,
-                        'updated': 0,
-                        'skipped': 0,
-                        'errors': []
-                    }
-                    
-                    # Get all existing barcodes for quick lookup
-                    existing_barcodes = set(products.keys())
+                col1, col2 = st.columns(2)
+                with col1:
+                    validate_clicked = st.button("Validate Before Import", key="validate_btn",
+                                                 help="Dry run: check every row without saving anything")
+                with col2:
+                    import_clicked = st.button("Import Products", key="import_btn")
+                
+                if validate_clicked or import_clicked:
+                    dry_run = validate_clicked
+                    action = "Validated" if dry_run else "Imported"
+                    uploaded_file.seek(0)
+                    progress_bar = st.progress(0.0, text="Validating products..." if dry_run else "Importing products...")
                     
-                    for index, row in df.iterrows():
-                        try:
-                            # Skip empty rows
-                            if pd.isna(row.get('name')) or not str(row.get('name')).strip():
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Missing product name")
-                                continue
-                            
-                            # Handle barcode
-                            barcode = str(row.get('barcode', '')).strip()
-                            if not barcode or barcode == 'AUTO_GENERATE':
-                                if generate_barcodes:
-                                    barcode = generate_barcode()
-                                else:
-                                    results['skipped'] += 1
-                                    results['errors'].append(f"Row {index+2}: Missing barcode and generation disabled")
-                                    continue
-                            
-                            # Validate barcode format
-                            if barcode and not barcode.isdigit():
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Invalid barcode format '{barcode}' - must be digits only")
-                                continue
-                            
-                            if barcode and len(barcode) not in [12, 13]:
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Invalid barcode length '{barcode}' - must be 12 or 13 digits")
-                                continue
-                            
-                            # Check if product exists
-                            product_exists = barcode in existing_barcodes
-                            
-                            # Determine if we should process based on import mode
-                            if import_mode == "Add new products only" and product_exists:
-                                results['skipped'] += 1
-                                continue
-                            if import_mode == "Update existing products" and not product_exists:
-                                results['skipped'] += 1
-                                continue
-                            
-                            # Prepare product data with proper validation
-                            product_data = {
-                                'barcode': barcode,
-                                'name': str(row.get('name', '')).strip(),
-                                'description': str(row.get('description', '')).strip() if pd.notna(row.get('description')) else '',
-                                'price': float(row.get('price', 0)) if pd.notna(row.get('price')) else 0.0,
-                                'cost': float(row.get('cost', 0)) if pd.notna(row.get('cost')) else 0.0,
-                                'category': str(row.get('category', '')).strip() if pd.notna(row.get('category')) else '',
-                                'subcategory': str(row.get('subcategory', '')).strip() if pd.notna(row.get('subcategory')) else '',
-                                'brand': str(row.get('brand', '')).strip() if pd.notna(row.get('brand')) else '',
-                                'supplier': str(row.get('supplier', '')).strip() if pd.notna(row.get('supplier')) else None,
-                                'active': bool(row.get('active', True)) if pd.notna(row.get('active')) else True,
-                                'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                            }
-                            
-                            # Validate required fields
-                            if not product_data['name']:
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Product name is required")
-                                continue
-                            
-                            if product_data['price'] <= 0:
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Price must be greater than 0")
-                                continue
-                            
-                            if product_data['cost'] <= 0:
-                                results['skipped'] += 1
-                                results['errors'].append(f"Row {index+2}: Cost must be greater than 0")
-                                continue
-                            
-                            # Set added_by/updated_by based on whether it's new or existing
-                            if product_exists:
-                                product_data['updated_by'] = st.session_state.user_info['username']
-                                # Preserve original date added
-                                product_data['date_added'] = products[barcode].get('date_added')
-                            else:
-                                product_data['date_added'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                product_data['added_by'] = st.session_state.user_info['username']
-                            
-                            # Validate category and subcategory
-                            category = product_data['category']
-                            if category and category not in categories_data.get('categories', []):
-                                # Add new category if it doesn't exist
-                                if category not in categories_data.get('categories', []):
-                                    categories_data['categories'].append(category)
-                                    categories_data['subcategories'][category] = []
-                            
-                            # Validate brand
-                            brand = product_data['brand']
-                            if brand and brand not in brands_data.get('brands', []):
-                                # Add new brand if it doesn't exist
-                                brands_data['brands'].append(brand)
-                            
-                            # Save product
-                            products[barcode] = product_data
-                            
-                            # Handle inventory
-                            initial_stock = int(row.get('initial_stock', 0)) if pd.notna(row.get('initial_stock')) else 0
-                            reorder_point = int(row.get('reorder_point', 10)) if pd.notna(row.get('reorder_point')) else 10
-                            
-                            if barcode in inventory:
-                                inventory[barcode]['reorder_point'] = reorder_point
-                                inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                                inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                            else:
-                                inventory[barcode] = {
-                                    'quantity': initial_stock,
-                                    'reorder_point': reorder_point,
-                                    'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-                                    'updated_by': st.session_state.user_info['username']
-                                }
-                            
-                            # Update brand mapping
-                            if brand:
-                                brand_products = brands_data.get('brand_products', {})
-                                if brand not in brand_products:
-                                    brand_products[brand] = []
-                                if barcode not in brand_products[brand]:
-                                    brand_products[brand].append(barcode)
-                                brands_data['brand_products'] = brand_products
-                            
-                            results['processed'] += 1
-                            if product_exists:
-                                results['updated'] += 1
-                            else:
-                                results['added'] += 1
-                            
-                        except Exception as e:
-                            results['skipped'] += 1
-                            results['errors'].append(f"Row {index+2}: Error - {str(e)}")
-                            if on_error == "Stop import":
-                                break
+                    def report_progress(rows):
+                        fraction = min(uploaded_file.tell() / max(uploaded_file.size, 1), 1.0)
+                        progress_bar.progress(fraction, text=f"{action} {rows:,} rows...")
                     
-                    # Save all data
-                    save_data(products, PRODUCTS_FILE)
-                    save_data(inventory, INVENTORY_FILE)
-                    save_data(categories_data, CATEGORIES_FILE)
-                    save_data(brands_data, BRANDS_FILE)
+                    results = import_products_csv(
+                        uploaded_file, import_mode,
+                        generate_barcodes=generate_barcodes,
+                        stop_on_error=on_error == "Stop import",
+                        username=st.session_state.user_info['username'],
+                        progress=report_progress,
+                        require_references=require_references,
+                        dry_run=dry_run
+                    )
+                    progress_bar.progress(1.0, text=f"Read {results['rows']:,} rows")
                     
-                    # Show results
-                    st.success(f"Import completed: {results['processed']} processed, "
-                             f"{results['added']} added, {results['updated']} updated, "
-                             f"{results['skipped']} skipped")
+                    if dry_run:
+                        st.info(f"Validation completed: {results['processed']} rows can be imported "
+                                f"({results['added']} new, {results['updated']} updates), "
+                                f"{results['skipped']} would be skipped. Nothing was saved.")
+                    else:
+                        st.success(f"Import completed: {results['processed']} processed, "
+                                 f"{results['added']} added, {results['updated']} updated, "
+                                 f"{results['skipped']} skipped")
                     
                     if results['errors']:
                         st.warning(f"Encountered {len(results['errors'])} errors:")
-                        for error in results['errors']:
-                            st.write(f"- {error}")
+                        errors_df = pd.DataFrame(results['errors'], columns=['Row', 'Error'])
+                        st.dataframe(errors_df, hide_index=True)
+                        st.download_button(
+                            label="Download Error Report",
+                            data=errors_df.to_csv(index=False).encode('utf-8'),
+                            file_name="product_import_errors.csv",
+                            mime="text/csv"
+                        )
                 
             except Exception as e:
                 st.error(f"Error reading CSV file: {str(e)}")
@@ -3687,8 +6219,203 @@ def product_management():
                     
             except Exception as e:
                 st.error(f"Error reading category file: {str(e)}")
-                
-                
+    
+    with tab7:
+        st.header("Mass Price Update")
+        
+        products = load_data(PRODUCTS_FILE)
+        if not products:
+            st.info("No products available")
+        else:
+            categories_data = load_categories_data()
+            brands = load_data(BRANDS_FILE).get('brands', [])
+            suppliers = load_data(SUPPLIERS_FILE)
+            
+            st.subheader("Select Products")
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                reprice_categories = st.multiselect("Categories", categories_data.get('categories', []),
+                                                    key="reprice_categories")
+            with col2:
+                reprice_brands = st.multiselect("Brands", brands, key="reprice_brands")
+            with col3:
+                reprice_suppliers = st.multiselect("Suppliers", [v['name'] for v in suppliers.values()],
+                                                   key="reprice_suppliers")
+            
+            st.subheader("Price Change")
+            col1, col2 = st.columns(2)
+            with col1:
+                change_type = st.radio("Change Type", ["Percentage", "Fixed Amount"], horizontal=True,
+                                       key="reprice_change_type")
+                amount = st.number_input("Change (%)" if change_type == "Percentage" else "Change Amount",
+                                         value=0.0, step=1.0 if change_type == "Percentage" else 0.01,
+                                         format="%.2f", key="reprice_amount",
+                                         help="Use a negative value to lower prices")
+            with col2:
+                rounding = st.selectbox("Rounding", PRICE_ROUNDING_OPTIONS, key="reprice_rounding")
+                use_margin_floor = st.checkbox("Keep a minimum margin over cost", value=True,
+                                               key="reprice_use_margin")
+                min_margin = st.number_input("Minimum Margin over Cost (%)", min_value=0.0, value=10.0,
+                                             step=1.0, key="reprice_min_margin",
+                                             disabled=not use_margin_floor)
+            
+            rule = {
+                'category': reprice_categories,
+                'brand': reprice_brands,
+                'supplier': reprice_suppliers,
+                'change_type': change_type,
+                'amount': amount,
+                'rounding': rounding,
+                'min_margin': min_margin if use_margin_floor else None
+            }
+            preview = compute_repricing(products, rule)
+            
+            # Result of the last apply, shown once after the rerun
+            applied_message = st.session_state.get('reprice_applied')
+            if applied_message:
+                st.success(applied_message)
+                st.session_state.reprice_applied = None
+            
+            st.subheader("Preview")
+            if preview.empty:
+                st.info("No prices would change")
+            else:
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Products Changing", len(preview))
+                col2.metric("Average Change", f"{preview['change_pct'].mean():.2f}%")
+                col3.metric("Held at Margin Floor", int(preview['margin_floor'].sum()))
+                st.dataframe(preview.reset_index(), hide_index=True)
+                
+                if st.button(f"Apply New Prices to {len(preview)} Products", key="reprice_apply"):
+                    applied, batch_id = apply_repricing(rule, st.session_state.user_info['username'])
+                    st.session_state.reprice_applied = f"Updated {len(applied)} prices (price history batch {batch_id})"
+                    st.rerun()
+            
+            with st.expander("Recent Price Changes"):
+                history = load_data(PRICE_HISTORY_FILE)
+                if not history:
+                    st.info("No price changes recorded")
+                else:
+                    st.dataframe(pd.DataFrame([
+                        {
+                            'Batch': batch_id,
+                            'Date': batch['date'],
+                            'Source': batch['source'],
+                            'User': batch.get('user') or '',
+                            'Products': len(batch['changes'])
+                        } for batch_id, batch in history.items()
+                    ]).sort_values('Date', ascending=False).head(20), hide_index=True)
+
+# Bulk stock updates
+# An uploaded count sheet is merged against current levels in one join. Quantities
+# are applied as Set, Add or Remove (per row via an optional 'mode' column, else the
+# chosen default); repeated barcodes are summed, e.g. one item counted in two aisles.
+# The merge is recomputed under the inventory lock against live levels when applied,
+# and all movements are appended to the stock ledger as one batch.
+STOCK_UPDATE_MODES = ["Set", "Add", "Remove"]
+
+def inventory_levels_frame(inventory):
+    return pd.DataFrame(
+        [(item.get('quantity', 0), item.get('reorder_point', 10)) for item in inventory.values()],
+        index=pd.Index(list(inventory.keys()), name='barcode'),
+        columns=['quantity', 'reorder_point']
+    )
+
+def read_count_sheet(source):
+    sheet = pd.read_csv(source, dtype=str, keep_default_na=False)
+    sheet = sheet.rename(columns=lambda c: str(c).strip().lower())
+    sheet = sheet.reindex(columns=['barcode', 'quantity', 'reorder_point', 'mode'], fill_value="")
+    sheet = sheet.apply(lambda col: col.str.strip())
+    sheet.index = pd.RangeIndex(2, len(sheet) + 2, name='row')
+    return sheet
+
+def merge_count_sheet(sheet, inventory, products, default_mode="Set"):
+    counted = pd.to_numeric(sheet['quantity'], errors='coerce')
+    reorder = pd.to_numeric(sheet['reorder_point'], errors='coerce')
+    modes = sheet['mode'].str.title().replace("", default_mode)
+    
+    errors = pd.Series(np.nan, index=sheet.index, dtype=object)
+    _flag_rows(errors, sheet['barcode'] == "", "Missing barcode")
+    _flag_rows(errors, ~sheet['barcode'].isin(products.keys()), "Unknown product '" + sheet['barcode'] + "'")
+    _flag_rows(errors, ~modes.isin(STOCK_UPDATE_MODES), "Invalid mode '" + sheet['mode'] + "'")
+    _flag_rows(errors, (counted.isna() & (sheet['quantity'] != "")) | np.isinf(counted), "Quantity must be a number")
+    _flag_rows(errors, counted < 0, "Quantity cannot be negative")
+    _flag_rows(errors, counted > STOCK_QUANTITY_LIMIT, f"Quantity cannot exceed {STOCK_QUANTITY_LIMIT:,}")
+    _flag_rows(errors, counted % 1 > 0, "Quantity must be a whole number")
+    _flag_rows(errors, (reorder.isna() & (sheet['reorder_point'] != "")) | np.isinf(reorder), "Reorder point must be a number")
+    _flag_rows(errors, reorder < 0, "Reorder point cannot be negative")
+    _flag_rows(errors, reorder > STOCK_QUANTITY_LIMIT, f"Reorder point cannot exceed {STOCK_QUANTITY_LIMIT:,}")
+    _flag_rows(errors, reorder % 1 > 0, "Reorder point must be a whole number")
+    _flag_rows(errors, counted.isna() & reorder.isna(), "Nothing to update")
+    
+    valid = errors.isna()
+    rows = pd.DataFrame({
+        'barcode': sheet['barcode'],
+        'mode': modes,
+        'counted': counted,
+        'reorder_point': reorder
+    })[valid]
+    # One line per barcode and mode; a barcode may not be both set and adjusted
+    plan = rows.groupby(['barcode', 'mode'], sort=False).agg(
+        counted=('counted', 'sum'),
+        counts=('counted', 'count'),
+        new_reorder_point=('reorder_point', 'last')
+    ).reset_index()
+    plan['counted'] = plan['counted'].where(plan['counts'] > 0)
+    plan = plan.drop(columns='counts')
+    mixed = plan['barcode'].duplicated(keep=False)
+    if mixed.any():
+        mixed_rows = rows.index[rows['barcode'].isin(plan.loc[mixed, 'barcode']).to_numpy()]
+        errors[mixed_rows] = "Barcode appears with more than one mode"
+        plan = plan[~mixed]
+    
+    levels = inventory_levels_frame(inventory)
+    plan = plan.join(levels, on='barcode').fillna({'quantity': 0, 'reorder_point': 10})
+    counted = plan['counted']
+    delta = np.select([plan['mode'] == "Add", plan['mode'] == "Remove"], [counted, -counted], counted - plan['quantity'])
+    plan['new_quantity'] = np.where(counted.isna(), plan['quantity'], plan['quantity'] + np.nan_to_num(delta))
+    
+    # Removals (summed over repeated rows) may not take stock below zero
+    overdrawn = (plan['mode'] == "Remove") & (plan['new_quantity'] < 0)
+    if overdrawn.any():
+        over = plan[overdrawn]
+        messages = pd.Series(("Cannot remove " + over['counted'].astype(np.int64).astype(str) + ", only " +
+                              over['quantity'].astype(np.int64).astype(str) + " in stock").to_numpy(),
+                             index=over['barcode'])
+        over_rows = errors.isna() & (modes == "Remove") & sheet['barcode'].isin(messages.index)
+        _flag_rows(errors, over_rows, sheet['barcode'].map(messages))
+        plan = plan[~overdrawn]
+    plan['variance'] = plan['new_quantity'] - plan['quantity']
+    plan['new_reorder_point'] = plan['new_reorder_point'].fillna(plan['reorder_point'])
+    plan['name'] = plan['barcode'].map(lambda b: products[b].get('name', b))
+    plan = plan.astype({'quantity': np.int64, 'reorder_point': np.int64, 'new_quantity': np.int64,
+                        'variance': np.int64, 'new_reorder_point': np.int64})
+    
+    failed = errors.notna()
+    return plan, list(zip(errors[failed].index.tolist(), errors[failed].tolist()))
+
+def apply_count_sheet(sheet, default_mode, username, notes=""):
+    with get_inventory_lock():
+        inventory = load_data(INVENTORY_FILE)
+        plan, errors = merge_count_sheet(sheet, inventory, load_data(PRODUCTS_FILE), default_mode)
+        now = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+        movements = []
+        for line in plan.itertuples(index=False):
+            item = inventory.setdefault(line.barcode, {'quantity': 0, 'reorder_point': 10})
+            item['quantity'] = int(line.new_quantity)
+            item['reorder_point'] = int(line.new_reorder_point)
+            item['last_updated'] = now
+            item['updated_by'] = username
+            if line.variance:
+                movements.append(stock_movement(
+                    line.barcode, f"{line.mode} Stock", int(line.quantity), int(line.new_quantity),
+                    quantity=int(line.new_quantity) if line.mode == "Set" else None,
+                    notes=notes or "Bulk update", user=username, date=now
+                ))
+        save_data(inventory, INVENTORY_FILE)
+        record_stock_movements(movements)
+    return plan, errors
+
 # Inventory Management
 def inventory_management():
     if not is_manager():
@@ -3697,11 +6424,12 @@ def inventory_management():
     
     st.title("Inventory Management")
     
-    tab1, tab2, tab3, tab4 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5 = st.tabs([
         "Current Inventory", 
         "Stock Adjustment", 
         "Inventory Reports", 
-        "Bulk Update"
+        "Bulk Update",
+        "Stockout Forecast"
     ])
     
     with tab1:
@@ -3714,6 +6442,7 @@ def inventory_management():
             st.info("No inventory items available")
         else:
             # Merge product info with inventory
+            low_stock = get_low_stock_tracker().low_stock()
             inventory_list = []
             for barcode, inv_data in inventory.items():
                 product = products.get(barcode, {'name': 'Unknown Product', 'price': 0})
@@ -3722,7 +6451,7 @@ def inventory_management():
                     'barcode': barcode,
                     'quantity': inv_data.get('quantity', 0),
                     'reorder_point': inv_data.get('reorder_point', 10),
-                    'status': 'Low Stock' if inv_data.get('quantity', 0) < inv_data.get('reorder_point', 10) else 'OK',
+                    'status': 'Low Stock' if barcode in low_stock else 'OK',
                     'last_updated': inv_data.get('last_updated', 'N/A')
                 })
             
@@ -3753,12 +6482,11 @@ def inventory_management():
             
             # Export option
             if st.button("Export Inventory to CSV", key="export_inv_csv"):
-                csv = inventory_df.to_csv(index=False)
-                st.download_button(
-                    label="Download CSV",
-                    data=csv,
-                    file_name=f"inventory_report_{datetime.date.today()}.csv",
-                    mime="text/csv",
+                file_download_button(
+                    "Download CSV",
+                    list(inventory_df.columns),
+                    inventory_df.itertuples(index=False),
+                    f"inventory_report_{datetime.date.today()}",
                     key="inv_download_csv"
                 )
     
@@ -3826,35 +6554,33 @@ def inventory_management():
                     )
                     
                     if st.form_submit_button("Submit Adjustment"):
-                        if barcode not in inventory:
-                            inventory[barcode] = {'quantity': 0, 'reorder_point': new_reorder}
-                        
-                        if adjustment_type == "Add Stock":
-                            inventory[barcode]['quantity'] += quantity
-                        elif adjustment_type == "Remove Stock":
-                            inventory[barcode]['quantity'] -= quantity
-                        elif adjustment_type == "Set Stock":
-                            inventory[barcode]['quantity'] = quantity
-                        elif adjustment_type == "Transfer Stock":
-                            inventory[barcode]['quantity'] -= quantity
-                        
-                        inventory[barcode]['reorder_point'] = new_reorder
-                        inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                        inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                        
-                        adjustments = inventory[barcode].get('adjustments', [])
-                        adjustments.append({
-                            'date': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
-                            'type': adjustment_type,
-                            'quantity': quantity,
-                            'previous_qty': current_qty,
-                            'new_qty': inventory[barcode]['quantity'],
-                            'notes': notes,
-                            'user': st.session_state.user_info['username']
-                        })
-                        inventory[barcode]['adjustments'] = adjustments
-                        
-                        save_data(inventory, INVENTORY_FILE)
+                        with get_inventory_lock():
+                            inventory = load_data(INVENTORY_FILE)
+                            previous_qty = inventory.get(barcode, {}).get('quantity', 0)
+                            if barcode not in inventory:
+                                inventory[barcode] = {'quantity': 0, 'reorder_point': new_reorder}
+                            
+                            if adjustment_type == "Add Stock":
+                                inventory[barcode]['quantity'] += quantity
+                            elif adjustment_type == "Remove Stock":
+                                inventory[barcode]['quantity'] -= quantity
+                            elif adjustment_type == "Set Stock":
+                                inventory[barcode]['quantity'] = quantity
+                            elif adjustment_type == "Transfer Stock":
+                                inventory[barcode]['quantity'] -= quantity
+                            
+                            inventory[barcode]['reorder_point'] = new_reorder
+                            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
+                            
+                            save_data(inventory, INVENTORY_FILE)
+                            record_stock_movements([stock_movement(
+                                barcode, adjustment_type, previous_qty, inventory[barcode]['quantity'],
+                                quantity=quantity,
+                                reference=transfer_to if adjustment_type == "Transfer Stock" else None,
+                                notes=notes,
+                                user=st.session_state.user_info['username']
+                            )])
                         st.success("Inventory updated successfully")
     
     with tab3:
@@ -3892,22 +6618,8 @@ def inventory_management():
                 st.dataframe(inv_df)
             
             elif report_type == "Stock Value":
-                value_list = []
-                for barcode, inv_data in inventory.items():
-                    product = products.get(barcode, {'name': 'Unknown', 'cost': 0})
-                    value_list.append({
-                        'product': product['name'],
-                        'barcode': barcode,
-                        'quantity': inv_data.get('quantity', 0),
-                        'unit_cost': product.get('cost', 0),
-                        'total_value': inv_data.get('quantity', 0) * product.get('cost', 0)
-                    })
-                
-                value_df = pd.DataFrame(value_list)
-                total_value = value_df['total_value'].sum()
-                
-                st.write(f"Total Inventory Value: {format_currency(total_value)}")
-                st.dataframe(value_df.sort_values('total_value', ascending=False))
+                method = stock_value_summary("inv_value")
+                st.dataframe(stock_value_frame(products, method).drop(columns=['category']))
             
             elif report_type == "Stock Movement":
                 st.info("Select a product to view movement history")
@@ -3921,40 +6633,27 @@ def inventory_management():
                 
                 if selected_product:
                     barcode = product_options[selected_product]
-                    inventory = load_data(INVENTORY_FILE)
                     
-                    if barcode in inventory and 'adjustments' in inventory[barcode]:
-                        adjustments = inventory[barcode]['adjustments']
-                        st.dataframe(pd.DataFrame(adjustments))
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        movement_start = st.date_input("From", value=datetime.date.today() - timedelta(days=90),
+                                                       key="movement_start")
+                    with col2:
+                        movement_end = st.date_input("To", value=datetime.date.today(), key="movement_end")
+                    
+                    movements = get_stock_ledger().history(barcode, movement_start.strftime("%Y-%m-%d"),
+                                                           movement_end.strftime("%Y-%m-%d"))
+                    if movements:
+                        movement_df = pd.DataFrame(movements).drop(columns='barcode')
+                        st.dataframe(movement_df.iloc[::-1], hide_index=True)
                     else:
-                        st.info("No adjustment history for this product")
+                        st.info("No stock movements for this product in the selected period")
             
             elif report_type == "Inventory Audit":
                 st.info("Inventory audit would compare physical counts with system records")
-                if st.button("Generate Audit Sheet", key="gen_audit_sheet"):
-                    audit_data = []
-                    for barcode, inv_data in inventory.items():
-                        product = products.get(barcode, {'name': 'Unknown'})
-                        audit_data.append({
-                            'Product': product['name'],
-                            'Barcode': barcode,
-                            'System Quantity': inv_data.get('quantity', 0),
-                            'Physical Count': "",
-                            'Variance': "",
-                            'Notes': ""
-                        })
-                    
-                    audit_df = pd.DataFrame(audit_data)
-                    st.dataframe(audit_df)
-                    
-                    csv = audit_df.to_csv(index=False)
-                    st.download_button(
-                        label="Download Audit Sheet",
-                        data=csv,
-                        file_name=f"inventory_audit_{datetime.date.today()}.csv",
-                        mime="text/csv",
-                        key="download_audit"
-                    )
+                if st.button("Generate Audit Sheet", key="gen_audit_sheet_bg"):
+                    submit_inventory_audit_job()
+                    st.success("Audit sheet is being generated. Download it from Reports & Analytics > Background Jobs when ready.")
     
     with tab4:
         st.header("Bulk Inventory Update")
@@ -3965,7 +6664,8 @@ def inventory_management():
         template_data = {
             "barcode": ["123456789012", ""],
             "quantity": [10, ""],
-            "reorder_point": [5, ""]
+            "reorder_point": [5, ""],
+            "mode": ["Set", ""]
         }
         template_df = pd.DataFrame(template_data)
         
@@ -3985,49 +6685,72 @@ def inventory_management():
         
         if uploaded_file:
             try:
-                df = pd.read_csv(uploaded_file)
-                st.dataframe(df)
+                sheet = read_count_sheet(uploaded_file)
+                
+                col1, col2 = st.columns(2)
+                with col1:
+                    default_mode = st.radio("Quantity Mode", STOCK_UPDATE_MODES, horizontal=True,
+                                            help="Used for rows without a mode. Set replaces the stock level with the "
+                                                 "counted quantity, Add and Remove adjust it",
+                                            key="inv_update_mode")
+                with col2:
+                    update_notes = st.text_input("Notes", value="Bulk update", key="inv_update_notes")
+                
+                plan, errors = merge_count_sheet(sheet, load_data(INVENTORY_FILE), load_data(PRODUCTS_FILE), default_mode)
+                
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Items to Update", len(plan))
+                col2.metric("Net Variance", int(plan['variance'].sum()))
+                col3.metric("Rows with Errors", len(errors))
+                
+                st.write("**Variance Preview:**")
+                st.dataframe(
+                    plan[['barcode', 'name', 'mode', 'quantity', 'new_quantity', 'variance',
+                          'reorder_point', 'new_reorder_point']].sort_values('variance', key=np.abs, ascending=False),
+                    hide_index=True
+                )
+                if errors:
+                    st.warning(f"{len(errors)} rows will be skipped:")
+                    st.dataframe(pd.DataFrame(errors, columns=['Row', 'Error']), hide_index=True)
                 
                 if st.button("Update Inventory", key="inv_update_btn"):
-                    inventory = load_data(INVENTORY_FILE)
-                    products = load_data(PRODUCTS_FILE)
-                    updated = 0
-                    errors = 0
-                    
-                    for _, row in df.iterrows():
-                        try:
-                            barcode = str(row['barcode']).strip()
-                            
-                            if barcode not in products:
-                                errors += 1
-                                continue
-                            
-                            if barcode not in inventory:
-                                inventory[barcode] = {
-                                    'quantity': 0,
-                                    'reorder_point': 10
-                                }
-                            
-                            if not pd.isna(row['quantity']):
-                                inventory[barcode]['quantity'] = int(row['quantity'])
-                            
-                            if not pd.isna(row['reorder_point']):
-                                inventory[barcode]['reorder_point'] = int(row['reorder_point'])
-                            
-                            inventory[barcode]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                            inventory[barcode]['updated_by'] = st.session_state.user_info['username']
-                            
-                            updated += 1
-                        
-                        except Exception as e:
-                            errors += 1
-                            continue
-                    
-                    save_data(inventory, INVENTORY_FILE)
-                    st.success(f"Update completed: {updated} items updated, {errors} errors")
+                    plan, errors = apply_count_sheet(sheet, default_mode, st.session_state.user_info['username'],
+                                                     update_notes)
+                    st.success(f"Update completed: {len(plan)} items updated, {len(errors)} errors")
             except Exception as e:
                 st.error(f"Error reading CSV file: {str(e)}")
 
+    with tab5:
+        st.header("Stockout Forecast")
+        
+        as_of = refresh_stock_forecast()
+        if not as_of:
+            st.info("The forecast is being built in the background. Check back shortly.")
+        else:
+            projection = stockout_projection()
+            st.caption(f"Demand fitted on sales up to the day before {as_of}; "
+                       f"items at risk run out before a delivery ordered today would arrive")
+            
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Forecast Items", int((projection['model'] != 'none').sum()))
+            col2.metric("At Risk Before Delivery", int(projection['at_risk'].sum()))
+            col3.metric("Out Within 7 Days", int((projection['days_to_stockout'] <= 7).sum()))
+            
+            show = st.radio("Show", ["At risk", "All forecast items"], horizontal=True, key="forecast_filter")
+            view = projection[projection['at_risk']] if show == "At risk" else projection[projection['model'] != 'none']
+            view = view.rename(columns={
+                'name': 'Product', 'quantity': 'On Hand', 'model': 'Model', 'daily_forecast': 'Daily Forecast',
+                'days_to_stockout': 'Days to Stockout', 'stockout_date': 'Stockout Date', 'lead_time': 'Lead Time (days)'
+            })
+            view['Daily Forecast'] = view['Daily Forecast'].round(2)
+            view['Days to Stockout'] = view['Days to Stockout'].round(1)
+            st.dataframe(view[['barcode', 'Product', 'On Hand', 'Daily Forecast', 'Days to Stockout', 'Stockout Date',
+                               'Lead Time (days)', 'Model']], hide_index=True)
+            
+            if st.button("Refit Forecast Now"):
+                submit_stock_forecast_job(st.session_state.user_info['username'])
+                st.success("Forecast refit started. Progress is shown under Reports > Background Jobs.")
+
 # User Management
 def user_management():
     if not is_admin():
@@ -4249,7 +6972,7 @@ def discounts_management():
     
     st.title("Discounts & Promotions")
     
-    tab1, tab2, tab3 = st.tabs(["Add Discount", "View/Edit Discounts", "Bulk Import"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Add Discount", "View/Edit Discounts", "Bulk Import", "Schedule"])
     
     with tab1:
         st.header("Add New Discount")
@@ -4317,8 +7040,7 @@ def discounts_management():
                     elif apply_to == "Specific Products":
                         discount_data['products'] = [product_options[p] for p in selected_products]
                     
-                    discounts[discount_id] = discount_data
-                    save_data(discounts, DISCOUNTS_FILE)
+                    update_records(DISCOUNTS_FILE, {discount_id: discount_data})
                     st.success("Discount added successfully")
     
     with tab2:
@@ -4400,7 +7122,7 @@ def discounts_management():
                                 discounts[discount_id].pop('categories', None)
                                 discounts[discount_id].pop('products', None)
                             
-                            save_data(discounts, DISCOUNTS_FILE)
+                            update_records(DISCOUNTS_FILE, {discount_id: discounts[discount_id]})
                             st.success("Discount updated successfully")
     
     with tab3:
@@ -4438,7 +7160,7 @@ def discounts_management():
                 st.dataframe(df)
                 
                 if st.button("Import Discounts"):
-                    discounts = load_data(DISCOUNTS_FILE)
+                    new_discounts = {}
                     products = load_data(PRODUCTS_FILE)
                     categories = load_data(CATEGORIES_FILE).get('categories', [])
                     imported = 0
@@ -4489,20 +7211,223 @@ def discounts_management():
                                     continue
                                 discount_data['products'] = valid_prods
                             
-                            discounts[discount_id] = discount_data
+                            new_discounts[discount_id] = discount_data
                             imported += 1
                         
                         except Exception as e:
                             errors += 1
                             continue
                     
-                    save_data(discounts, DISCOUNTS_FILE)
+                    update_records(DISCOUNTS_FILE, new_discounts)
                     st.success(f"Import completed: {imported} new discounts, {errors} errors")
             except Exception as e:
                 st.error(f"Error reading CSV file: {str(e)}")
+    
+    with tab4:
+        st.header("Scheduled Changes")
+        
+        scheduler = get_promotion_scheduler()
+        if scheduler.last_error:
+            st.warning(f"Last scheduler run failed: {scheduler.last_error}")
+        
+        st.subheader("Schedule Price Change")
+        products = load_data(PRODUCTS_FILE)
+        
+        with st.form("schedule_price_form"):
+            product_options = {f"{v['name']} ({k})": k for k, v in products.items()}
+            selected_product = st.selectbox("Product*", [""] + list(product_options.keys()))
+            new_price = st.number_input("New Price*", min_value=0.01, value=1.0, step=1.0)
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                effective_date = st.date_input("Effective Date*", value=datetime.date.today() + datetime.timedelta(days=1))
+            with col2:
+                effective_time = st.time_input("Effective Time*", value=datetime.time(0, 0))
+            
+            if st.form_submit_button("Schedule Price Change"):
+                if not selected_product:
+                    st.error("Please select a product")
+                else:
+                    change_id = generate_short_id()
+                    update_records(PRICE_SCHEDULE_FILE, {change_id: {
+                        'id': change_id,
+                        'barcode': product_options[selected_product],
+                        'new_price': new_price,
+                        'effective_at': datetime.datetime.combine(effective_date, effective_time).strftime("%Y-%m-%d %H:%M"),
+                        'status': 'scheduled',
+                        'created_by': st.session_state.user_info['username'],
+                        'created_at': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                    }})
+                    scheduler.wakeup.set()
+                    st.success("Price change scheduled")
+        
+        st.subheader("Upcoming Events")
+        discounts = load_data(DISCOUNTS_FILE)
+        offers = load_data(OFFERS_FILE)
+        price_schedule = load_data(PRICE_SCHEDULE_FILE)
+        
+        events = scheduler.upcoming()
+        if not events:
+            st.info("No scheduled events")
+        else:
+            event_rows = []
+            for when, kind, file, record_id in events:
+                if file == PRICE_SCHEDULE_FILE:
+                    change = price_schedule.get(record_id, {})
+                    product = products.get(change.get('barcode'), {'name': 'Unknown'})
+                    target = f"{product['name']} -> {format_currency(change.get('new_price', 0))}"
+                else:
+                    rule = (discounts if file == DISCOUNTS_FILE else offers).get(record_id, {})
+                    target = f"{'Discount' if file == DISCOUNTS_FILE else 'Offer'}: {rule.get('name', record_id)}"
+                event_rows.append({
+                    'When': when.strftime("%Y-%m-%d %H:%M"),
+                    'Event': {'activate': "Activate", 'expire': "Expire", 'price': "Price Change"}[kind],
+                    'Target': target
+                })
+            st.dataframe(pd.DataFrame(event_rows), hide_index=True)
+        
+        pending_changes = {k: v for k, v in price_schedule.items() if v.get('status') == 'scheduled'}
+        if pending_changes:
+            st.subheader("Pending Price Changes")
+            for change_id, change in sorted(pending_changes.items(), key=lambda x: x[1]['effective_at']):
+                product = products.get(change['barcode'], {'name': 'Unknown'})
+                col1, col2 = st.columns([4, 1])
+                with col1:
+                    st.write(f"{product['name']}: {format_currency(product.get('price', 0))} -> "
+                             f"{format_currency(change['new_price'])} at {change['effective_at']}")
+                with col2:
+                    if st.button("Cancel", key=f"cancel_price_{change_id}"):
+                        # The scheduler may have applied the change since the page loaded
+                        with get_file_lock(PRICE_SCHEDULE_FILE):
+                            current = load_data(PRICE_SCHEDULE_FILE)
+                            if current.get(change_id, {}).get('status') == 'scheduled':
+                                current[change_id]['status'] = 'cancelled'
+                                current[change_id]['cancelled_by'] = st.session_state.user_info['username']
+                                save_data(current, PRICE_SCHEDULE_FILE)
+                        st.rerun()
 
 
 # Offers Management
+# What-if simulation: replay historical carts through a PricingEngine built from a
+# candidate set of discounts and offers and compare with what was actually charged.
+# Amounts are pre-tax cents. The recorded discount of each sale is spread over its
+# lines pro rata; in the scenario the best candidate discount is applied to every cart.
+def build_candidate_engine(discount_ids, offer_ids, ignore_windows=True):
+    def candidates(records, ids):
+        selected = {}
+        for record_id in ids:
+            if record_id in records:
+                rule = dict(records[record_id], active=True)
+                if ignore_windows:
+                    rule.pop('start_date', None)
+                    rule.pop('end_date', None)
+                selected[record_id] = rule
+        return selected
+    
+    return PricingEngine(candidates(load_data(DISCOUNTS_FILE), discount_ids),
+                         candidates(load_data(OFFERS_FILE), offer_ids),
+                         load_data(PRODUCTS_FILE))
+
+def simulate_partition(transactions, engine, start_date, end_date):
+    # barcode -> [quantity, actual revenue, simulated revenue]
+    results = {}
+    discount_ids = list(engine.discounts)
+    
+    for t in transactions:
+        try:
+            day = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
+        except (ValueError, TypeError):
+            continue
+        if not start_date <= day <= end_date or not t.get('items'):
+            continue
+        
+        lines = {barcode: (cents_of(item, 'price'), int(item.get('quantity', 0)))
+                 for barcode, item in t['items'].items()}
+        subtotal_cents = sum(price_cents * quantity for price_cents, quantity in lines.values())
+        if subtotal_cents <= 0:
+            continue
+        
+        # Actual: recorded discount (tax-inclusive, negative) brought back to pre-tax
+        tax_cents = cents_of(t, 'tax')
+        actual_reduction = -cents_of(t, 'discount') * subtotal_cents / (subtotal_cents + tax_cents)
+        
+        # Scenario: offers plus the best single candidate discount
+        line_savings = dict.fromkeys(lines, 0)
+        for offer in engine.evaluate_offers(lines, day):
+            offer_gross = sum(lines[b][0] * lines[b][1] for b in offer['barcodes'])
+            for b in offer['barcodes']:
+                line_savings[b] += offer['savings_cents'] * lines[b][0] * lines[b][1] / offer_gross
+        
+        best_discount, best_amount = None, 0
+        for discount_id in discount_ids:
+            amount = engine.discount_amount(discount_id, lines, 0, day)
+            if amount > best_amount:
+                best_discount, best_amount = discount_id, amount
+        if best_discount:
+            eligible = {b: lines[b][0] * lines[b][1] for b in lines if engine.discount_applies(best_discount, b)}
+            eligible_total = sum(eligible.values())
+            for b, gross in eligible.items():
+                line_savings[b] += best_amount * gross / eligible_total
+        
+        for barcode, (price_cents, quantity) in lines.items():
+            gross = price_cents * quantity
+            row = results.setdefault(barcode, [0, 0.0, 0.0])
+            row[0] += quantity
+            row[1] += gross - actual_reduction * gross / subtotal_cents
+            row[2] += gross - line_savings[barcode]
+    
+    return results
+
+def run_promotion_simulation(discount_ids, offer_ids, start_date, end_date, ignore_windows=True,
+                             workers=None, progress=None):
+    engine = build_candidate_engine(discount_ids, offer_ids, ignore_windows)
+    products = load_data(PRODUCTS_FILE)
+    partitions = partition_transactions_by_month(load_data(TRANSACTIONS_FILE))
+    
+    partials = parallel_map_partitions(
+        lambda month, chunk: simulate_partition(chunk, engine, start_date, end_date),
+        partitions, workers=workers, progress=progress
+    )
+    
+    merged = {}
+    for partial in partials:
+        for barcode, values in partial.items():
+            _add_to_bucket(merged, barcode, *values)
+    
+    rows = []
+    for barcode, (quantity, actual_cents, simulated_cents) in merged.items():
+        product = products.get(barcode, {})
+        cost_cents = to_cents(product.get('cost', 0)) * quantity
+        rows.append({
+            'barcode': barcode,
+            'product': product.get('name', 'Unknown'),
+            'category': product.get('category', 'Unknown'),
+            'quantity': quantity,
+            'actual_revenue': round(actual_cents) / MONEY_SCALE,
+            'simulated_revenue': round(simulated_cents) / MONEY_SCALE,
+            'actual_margin': (round(actual_cents) - cost_cents) / MONEY_SCALE,
+            'simulated_margin': (round(simulated_cents) - cost_cents) / MONEY_SCALE
+        })
+    
+    columns = ['barcode', 'product', 'category', 'quantity', 'actual_revenue', 'simulated_revenue',
+               'actual_margin', 'simulated_margin']
+    result_df = pd.DataFrame(rows, columns=columns)
+    result_df['revenue_delta'] = result_df['simulated_revenue'] - result_df['actual_revenue']
+    result_df['margin_delta'] = result_df['simulated_margin'] - result_df['actual_margin']
+    return result_df.sort_values('margin_delta')
+
+def run_promotion_simulation_job(job, discount_ids, offer_ids, start_date, end_date, ignore_windows):
+    job.update(0.0, "Replaying transactions")
+    result_df = run_promotion_simulation(
+        discount_ids, offer_ids, start_date, end_date, ignore_windows,
+        progress=lambda done: job.update(done * 0.95, f"Replayed {done:.0%} of history")
+    )
+    
+    job.update(0.95, "Saving results")
+    output_path = job.output_path()
+    result_df.to_csv(output_path, index=False)
+    return output_path
+
 def offers_management():
     if not is_manager():
         st.warning("You don't have permission to access this page")
@@ -4510,7 +7435,7 @@ def offers_management():
     
     st.title("Offers Management")
     
-    tab1, tab2, tab3 = st.tabs(["Add Offer", "View/Edit Offers", "Bulk Import"])
+    tab1, tab2, tab3, tab4 = st.tabs(["Add Offer", "View/Edit Offers", "Bulk Import", "What-If Simulator"])
     
     with tab1:
         st.header("Add New Offer")
@@ -4569,7 +7494,7 @@ def offers_management():
                         'id': offer_id,
                         'name': name,
                         'description': description,
-                        'type': offer_type.lower(),
+                        'type': offer_type.lower().replace(' ', '_'),
                         'start_date': start_date.strftime("%Y-%m-%d"),
                         'end_date': end_date.strftime("%Y-%m-%d"),
                         'active': active,
@@ -4588,8 +7513,7 @@ def offers_management():
                         offer_data['product'] = product_options[selected_product]
                         offer_data['special_price'] = special_price
                     
-                    offers[offer_id] = offer_data
-                    save_data(offers, OFFERS_FILE)
+                    update_records(OFFERS_FILE, {offer_id: offer_data})
                     st.success("Offer added successfully")
     
     with tab2:
@@ -4601,6 +7525,10 @@ def offers_management():
         if not offers:
             st.info("No offers available")
         else:
+            skipped = get_pricing_engine().skipped_offers
+            if skipped:
+                st.warning("These active offers are missing products for their type and are ignored at checkout: " +
+                           ", ".join(offers[o].get('name', o) for o in skipped if o in offers))
             for offer_id, offer in offers.items():
                 with st.expander(f"{offer['name']} - {'Active' if offer['active'] else 'Inactive'}"):
                     with st.form(key=f"edit_{offer_id}"):
@@ -4609,7 +7537,7 @@ def offers_management():
                         
                         offer_type = st.selectbox("Type", 
                                                 ["BOGO", "Bundle", "Special Price"], 
-                                                index=["BOGO", "Bundle", "Special Price"].index(offer['type'].title()))
+                                                index=["BOGO", "Bundle", "Special Price"].index(offer['type'].replace('_', ' ').title()))
                         
                         if offer['type'] == "bogo":
                             col1, col2 = st.columns(2)
@@ -4640,7 +7568,7 @@ def offers_management():
                                                          value=offer.get('bundle_price', 0.0), 
                                                          step=1.0)
                         
-                        elif offer['type'] == "special_price":
+                        elif offer['type'].replace(' ', '_') == "special_price":
                             product_options = {f"{v['name']} ({k})": k for k, v in products.items()}
                             selected_product = st.selectbox("Product", 
                                                           [""] + list(product_options.keys()), 
@@ -4664,7 +7592,7 @@ def offers_management():
                         if st.form_submit_button("Update Offer"):
                             offers[offer_id]['name'] = name
                             offers[offer_id]['description'] = description
-                            offers[offer_id]['type'] = offer_type.lower()
+                            offers[offer_id]['type'] = offer_type.lower().replace(' ', '_')
                             offers[offer_id]['start_date'] = start_date.strftime("%Y-%m-%d")
                             offers[offer_id]['end_date'] = end_date.strftime("%Y-%m-%d")
                             offers[offer_id]['active'] = active
@@ -4678,11 +7606,11 @@ def offers_management():
                             elif offer['type'] == "bundle":
                                 offers[offer_id]['products'] = [product_options[p] for p in selected_products]
                                 offers[offer_id]['bundle_price'] = bundle_price
-                            elif offer['type'] == "special_price":
+                            elif offer['type'].replace(' ', '_') == "special_price":
                                 offers[offer_id]['product'] = product_options[selected_product]
                                 offers[offer_id]['special_price'] = special_price
                             
-                            save_data(offers, OFFERS_FILE)
+                            update_records(OFFERS_FILE, {offer_id: offers[offer_id]})
                             st.success("Offer updated successfully")
     
     with tab3:
@@ -4721,7 +7649,7 @@ def offers_management():
                 st.dataframe(df)
                 
                 if st.button("Import Offers"):
-                    offers = load_data(OFFERS_FILE)
+                    new_offers = {}
                     products = load_data(PRODUCTS_FILE)
                     imported = 0
                     updated = 0
@@ -4806,18 +7734,205 @@ def offers_management():
                                     continue
                                 offer_data['product'] = product_id
                             
-                            offers[offer_id] = offer_data
+                            new_offers[offer_id] = offer_data
                             imported += 1
                         
                         except Exception as e:
                             errors += 1
                             continue
                     
-                    save_data(offers, OFFERS_FILE)
+                    update_records(OFFERS_FILE, new_offers)
                     st.success(f"Import completed: {imported} new offers, {errors} errors")
             except Exception as e:
                 st.error(f"Error reading CSV file: {str(e)}")
+    
+    with tab4:
+        st.header("What-If Simulator")
+        st.info("Replay past sales with a candidate set of offers and discounts to estimate revenue and margin impact")
+        
+        offers = load_data(OFFERS_FILE)
+        discounts = load_data(DISCOUNTS_FILE)
+        offer_options = {f"{o['name']} ({'Active' if o.get('active') else 'Inactive'})": k for k, o in offers.items()}
+        discount_options = {f"{d['name']} ({'Active' if d.get('active') else 'Inactive'})": k for k, d in discounts.items()}
+        
+        with st.form("simulation_form"):
+            selected_offers = st.multiselect("Offers in scenario", list(offer_options.keys()),
+                                             default=[k for k, v in offer_options.items() if offers[v].get('active')])
+            selected_discounts = st.multiselect("Discounts in scenario", list(discount_options.keys()),
+                                                default=[k for k, v in discount_options.items() if discounts[v].get('active')])
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                sim_start = st.date_input("History From", value=datetime.date.today() - datetime.timedelta(days=365))
+            with col2:
+                sim_end = st.date_input("History To", value=datetime.date.today())
+            
+            ignore_windows = st.checkbox("Treat selected rules as valid on every day", value=True)
+            
+            if st.form_submit_button("Run Simulation"):
+                if sim_start > sim_end:
+                    st.error("Start date must be before end date")
+                else:
+                    get_job_runner().submit(
+                        "Promotion simulation", run_promotion_simulation_job,
+                        [discount_options[d] for d in selected_discounts],
+                        [offer_options[o] for o in selected_offers],
+                        sim_start, sim_end, ignore_windows,
+                        owner=st.session_state.user_info['username'],
+                        file_name=f"promotion_simulation_{sim_start}_to_{sim_end}.csv"
+                    )
+                    st.success("Simulation started")
+        
+        simulations = [j for j in get_job_runner().list_jobs(st.session_state.user_info['username'])
+                       if j.name == "Promotion simulation"]
+        if simulations:
+            latest = simulations[0]
+            if latest.status in ['queued', 'running']:
+                st.progress(latest.progress, text=latest.message or latest.status.title())
+                if st.button("Refresh", key="simulation_refresh"):
+                    st.rerun()
+            elif latest.status == 'failed':
+                st.error(f"Simulation failed: {latest.error}")
+            elif latest.status == 'completed' and latest.result_path and os.path.exists(latest.result_path):
+                result_df = pd.read_csv(latest.result_path, dtype={'barcode': str})
+                st.subheader(f"Results ({latest.created_at})")
                 
+                col1, col2, col3 = st.columns(3)
+                col1.metric("Revenue Delta", format_currency(result_df['revenue_delta'].sum()))
+                col2.metric("Margin Delta", format_currency(result_df['margin_delta'].sum()))
+                col3.metric("Products Affected", int((result_df['revenue_delta'].abs() >= 0.01).sum()))
+                
+                st.subheader("By Category")
+                category_df = result_df.groupby('category')[['actual_revenue', 'simulated_revenue', 'revenue_delta',
+                                                             'actual_margin', 'simulated_margin', 'margin_delta']].sum()
+                st.dataframe(category_df.sort_values('margin_delta'))
+                
+                st.subheader("By Product")
+                st.dataframe(result_df.set_index('barcode'))
+                
+# Loyalty tiers and bulk import
+# Tiers are assigned by searching each customer's points in the sorted array of tier
+# thresholds, so re-tiering the whole membership is one np.searchsorted call.
+# Customers below the lowest threshold have no tier ("").
+def tier_thresholds(tiers):
+    ordered = sorted(tiers.items(), key=lambda item: item[1].get('min_points', 0))
+    names = np.array([""] + [name for name, _ in ordered], dtype=object)
+    minimums = np.array([tier.get('min_points', 0) for _, tier in ordered], dtype=np.int64)
+    return names, minimums
+
+def assign_tiers(points, tiers):
+    names, minimums = tier_thresholds(tiers)
+    return names[np.searchsorted(minimums, np.asarray(points, dtype=np.int64), side='right')]
+
+def recalculate_tiers(progress=None):
+    # Under the file lock, so loyalty edits made while the job runs are not lost
+    with get_file_lock(LOYALTY_FILE):
+        loyalty = load_data(LOYALTY_FILE)
+        customers = loyalty.get('customers', {})
+        tiers = loyalty.get('tiers', {})
+        if not customers or not tiers:
+            return []
+        
+        ids = list(customers.keys())
+        points = np.fromiter((int(c.get('points', 0) or 0) for c in customers.values()), dtype=np.int64, count=len(ids))
+        current = np.array([c.get('tier', "") for c in customers.values()], dtype=object)
+        assigned = assign_tiers(points, tiers)
+        if progress:
+            progress(0.5)
+        
+        now = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+        changes = []
+        for i in np.flatnonzero(current != assigned):
+            customer = customers[ids[i]]
+            changes.append((ids[i], customer.get('name', ''), current[i], assigned[i]))
+            customer['tier'] = assigned[i]
+            customer['last_updated'] = now
+        if changes:
+            save_data(loyalty, LOYALTY_FILE)
+        return changes
+
+def run_tier_recalculation_job(job):
+    job.update(0.0, "Assigning tiers")
+    started = time.time()
+    changes = recalculate_tiers(progress=lambda done: job.update(done * 0.9, "Saving customers"))
+    output_path = job.output_path()
+    pd.DataFrame(changes, columns=['customer_id', 'name', 'previous_tier', 'new_tier']).to_csv(output_path, index=False)
+    job.message = f"Re-tiered {len(changes)} customers in {time.time() - started:.1f}s"
+    return output_path
+
+def submit_tier_recalculation_job():
+    runner = get_job_runner()
+    if not runner.find_active("Loyalty tier recalculation", ()):
+        runner.submit("Loyalty tier recalculation", run_tier_recalculation_job,
+                      owner=st.session_state.user_info['username'],
+                      file_name=f"tier_changes_{datetime.date.today()}.csv", params=())
+
+def import_loyalty_customers(source):
+    # Rows matching an existing customer's phone number update that customer;
+    # blank cells leave the customer's field alone. Blank tiers are assigned
+    # from points (for a matched customer only when the points change); a
+    # named tier must exist.
+    df = pd.read_csv(source, dtype=str, keep_default_na=False)
+    df = df.rename(columns=lambda c: str(c).strip().lower())
+    df = df.reindex(columns=['name', 'phone', 'email', 'points', 'tier'], fill_value="")
+    df = df.apply(lambda col: col.str.strip())
+    df.index = pd.RangeIndex(2, len(df) + 2, name='row')
+    
+    with get_file_lock(LOYALTY_FILE):
+        return _import_loyalty_rows(df, load_data(LOYALTY_FILE))
+
+def _import_loyalty_rows(df, loyalty):
+    customers = loyalty.setdefault('customers', {})
+    tiers = loyalty.get('tiers', {})
+    
+    points = pd.to_numeric(df['points'].replace("", 0), errors='coerce')
+    errors = pd.Series(np.nan, index=df.index, dtype=object)
+    _flag_rows(errors, df['name'] == "", "Missing customer name")
+    _flag_rows(errors, ~np.isfinite(points) | (points < 0), "Points must be a non-negative number")
+    _flag_rows(errors, points > LOYALTY_POINTS_LIMIT, f"Points cannot exceed {LOYALTY_POINTS_LIMIT:,}")
+    _flag_rows(errors, points % 1 > 0, "Points must be a whole number")
+    _flag_rows(errors, (df['tier'] != "") & ~df['tier'].isin(tiers.keys()), "Unknown tier '" + df['tier'] + "'")
+    
+    valid = errors.isna()
+    rows = df[valid].copy()
+    filled = rows != ""
+    rows['points'] = points[valid].astype(np.int64)
+    if tiers:
+        rows['tier'] = rows['tier'].where(rows['tier'] != "", pd.Series(assign_tiers(rows['points'], tiers), index=rows.index))
+    
+    phone_keys = rows['phone'].str.replace(r"\D", "", regex=True)
+    existing = {_normalize_phone(c.get('phone')): cid for cid, c in customers.items() if c.get('phone')}
+    matched = phone_keys.map(existing).where(phone_keys != "")
+    # Later rows win when a phone number is repeated in the file
+    repeated = phone_keys.duplicated(keep='last') & (phone_keys != "")
+    
+    now = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+    imported = updated = 0
+    kept = ~repeated.to_numpy()
+    for record, given, customer_id in zip(rows[kept].to_dict('records'), filled[kept].to_dict('records'),
+                                          matched[~repeated].tolist()):
+        record['last_updated'] = now
+        if isinstance(customer_id, str):
+            customer = customers[customer_id]
+            changes = {field: value for field, value in record.items() if given.get(field, True)}
+            if tiers and given['points'] and record['points'] != customer.get('points'):
+                changes.setdefault('tier', record['tier'])
+            customer.update(changes)
+            updated += 1
+        else:
+            customer_id = str(uuid.uuid4())
+            customers[customer_id] = {'id': customer_id, **record}
+            imported += 1
+    
+    save_data(loyalty, LOYALTY_FILE)
+    failed = errors.notna()
+    return {
+        'imported': imported,
+        'updated': updated,
+        'duplicates': int(repeated.sum()),
+        'errors': list(zip(errors[failed].index.tolist(), errors[failed].tolist()))
+    }
+
 # Loyalty Program Management
 def loyalty_management():
     if not is_manager():
@@ -4854,26 +7969,42 @@ def loyalty_management():
                 if not tier_name:
                     st.error("Tier name is required")
                 else:
-                    tiers[tier_name] = {
-                        'min_points': min_points,
-                        'discount': discount / 100  # Store as decimal
-                    }
-                    loyalty['tiers'] = tiers
-                    save_data(loyalty, LOYALTY_FILE)
-                    st.success("Tier saved successfully")
+                    with get_file_lock(LOYALTY_FILE):
+                        loyalty = load_data(LOYALTY_FILE)
+                        loyalty.setdefault('tiers', {})[tier_name] = {
+                            'min_points': min_points,
+                            'discount': discount / 100  # Store as decimal
+                        }
+                        save_data(loyalty, LOYALTY_FILE)
+                    submit_tier_recalculation_job()
+                    st.success("Tier saved successfully. Customer tiers are being recalculated in the background.")
+        
+        if tiers and st.button("Recalculate All Customer Tiers", key="recalc_tiers"):
+            submit_tier_recalculation_job()
+            st.success("Recalculation started. Download the list of changes from Reports & Analytics > Background Jobs when ready.")
     
     with tab2:
         st.header("Customer Points")
         
         loyalty = load_data(LOYALTY_FILE)
-        customers = loyalty.get('customers', {})
         
         st.subheader("Customer List")
-        if not customers:
+        customer_index, query, customer_matches = customer_search_box("loyalty_customer_search")
+        if not len(customer_index):
             st.info("No customers in loyalty program")
+        elif query and not customer_matches:
+            st.info("No customers match your search")
         else:
-            customer_df = pd.DataFrame.from_dict(customers, orient='index')
-            st.dataframe(customer_df[['name', 'phone', 'email', 'points', 'tier']])
+            if not query:
+                page_size = 50
+                pages = max(1, (len(customer_index) + page_size - 1) // page_size)
+                page = st.number_input("Page", min_value=1, max_value=pages, value=1, step=1,
+                                       key="loyalty_customer_page")
+                customer_matches = customer_index.page((page - 1) * page_size, page_size)
+                st.caption(f"{len(customer_index)} customers, page {page} of {pages}")
+            customer_df = pd.DataFrame([customer_index.customers[k] for k in customer_matches],
+                                       index=customer_matches)
+            st.dataframe(customer_df.reindex(columns=['name', 'phone', 'email', 'points', 'tier']))
         
         st.subheader("Add/Edit Customer")
         with st.form("customer_form"):
@@ -4884,10 +8015,7 @@ def loyalty_management():
             
             tiers = loyalty.get('tiers', {})
             if tiers:
-                current_tier = None
-                for tier_name, tier_data in tiers.items():
-                    if points >= tier_data['min_points']:
-                        current_tier = tier_name
+                current_tier = assign_tiers([points], tiers)[0]
                 
                 tier_options = list(tiers.keys())
                 tier = st.selectbox("Tier", tier_options, index=tier_options.index(current_tier) if current_tier else 0)
@@ -4896,17 +8024,18 @@ def loyalty_management():
             
             if st.form_submit_button("Save Customer"):
                 customer_id = str(uuid.uuid4())
-                customers[customer_id] = {
-                    'id': customer_id,
-                    'name': name,
-                    'phone': phone,
-                    'email': email,
-                    'points': points,
-                    'tier': tier,
-                    'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                }
-                loyalty['customers'] = customers
-                save_data(loyalty, LOYALTY_FILE)
+                with get_file_lock(LOYALTY_FILE):
+                    loyalty = load_data(LOYALTY_FILE)
+                    loyalty.setdefault('customers', {})[customer_id] = {
+                        'id': customer_id,
+                        'name': name,
+                        'phone': phone,
+                        'email': email,
+                        'points': points,
+                        'tier': tier,
+                        'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                    }
+                    save_data(loyalty, LOYALTY_FILE)
                 st.success("Customer saved successfully")
     
     with tab3:
@@ -4936,15 +8065,16 @@ def loyalty_management():
                     st.error("Reward name is required")
                 else:
                     reward_id = str(uuid.uuid4())
-                    rewards[reward_id] = {
-                        'name': name,
-                        'points': points_required,
-                        'description': description,
-                        'active': active,
-                        'created_at': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                    loyalty['rewards'] = rewards
-                    save_data(loyalty, LOYALTY_FILE)
+                    with get_file_lock(LOYALTY_FILE):
+                        loyalty = load_data(LOYALTY_FILE)
+                        loyalty.setdefault('rewards', {})[reward_id] = {
+                            'name': name,
+                            'points': points_required,
+                            'description': description,
+                            'active': active,
+                            'created_at': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+                        }
+                        save_data(loyalty, LOYALTY_FILE)
                     st.success("Reward saved successfully")
     
     with tab4:
@@ -4973,50 +8103,18 @@ def loyalty_management():
         
         if uploaded_file:
             try:
-                df = pd.read_csv(uploaded_file)
+                df = pd.read_csv(uploaded_file, nrows=5)
                 st.dataframe(df)
                 
                 if st.button("Import Customers"):
-                    loyalty = load_data(LOYALTY_FILE)
-                    customers = loyalty.get('customers', {})
-                    tiers = loyalty.get('tiers', {})
-                    imported = 0
-                    updated = 0
-                    errors = 0
-                    
-                    for _, row in df.iterrows():
-                        try:
-                            if pd.isna(row['name']) or str(row['name']).strip() == "":
-                                errors += 1
-                                continue
-                            
-                            customer_id = str(uuid.uuid4())
-                            
-                            customer_data = {
-                                'id': customer_id,
-                                'name': str(row['name']).strip(),
-                                'phone': str(row['phone']).strip() if not pd.isna(row['phone']) else "",
-                                'email': str(row['email']).strip() if not pd.isna(row['email']) else "",
-                                'points': int(row['points']) if not pd.isna(row['points']) else 0,
-                                'tier': str(row['tier']).strip() if not pd.isna(row['tier']) else "",
-                                'last_updated': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
-                            }
-                            
-                            # Validate tier
-                            if customer_data['tier'] and customer_data['tier'] not in tiers:
-                                errors += 1
-                                continue
-                            
-                            customers[customer_id] = customer_data
-                            imported += 1
-                        
-                        except Exception as e:
-                            errors += 1
-                            continue
-                    
-                    loyalty['customers'] = customers
-                    save_data(loyalty, LOYALTY_FILE)
-                    st.success(f"Import completed: {imported} new customers, {errors} errors")
+                    uploaded_file.seek(0)
+                    results = import_loyalty_customers(uploaded_file)
+                    st.success(f"Import completed: {results['imported']} new customers, {results['updated']} updated, "
+                               f"{len(results['errors'])} errors")
+                    if results['duplicates']:
+                        st.info(f"{results['duplicates']} rows repeated a phone number later in the file and were skipped")
+                    if results['errors']:
+                        st.dataframe(pd.DataFrame(results['errors'], columns=['Row', 'Error']), hide_index=True)
             except Exception as e:
                 st.error(f"Error reading CSV file: {str(e)}")
 
@@ -5139,6 +8237,7 @@ def suppliers_management():
             address = st.text_area("Address")
             products_supplied = st.text_area("Products Supplied (comma separated)")
             payment_terms = st.text_input("Payment Terms")
+            lead_time_days = st.number_input("Lead Time (days)", min_value=0, value=DEFAULT_LEAD_TIME_DAYS, step=1)
             
             submit_button = st.form_submit_button("Add Supplier")
             
@@ -5158,6 +8257,7 @@ def suppliers_management():
                         'address': address,
                         'products_supplied': [p.strip() for p in products_supplied.split(',')] if products_supplied else [],
                         'payment_terms': payment_terms,
+                        'lead_time_days': int(lead_time_days),
                         'date_added': get_current_datetime().strftime("%Y-%m-%d %H:%M:%S"),
                         'added_by': st.session_state.user_info['username']
                     }
@@ -5192,6 +8292,8 @@ def suppliers_management():
                         products_supplied = st.text_area("Products Supplied", 
                                                         value=", ".join(supplier.get('products_supplied', [])))
                         payment_terms = st.text_input("Payment Terms", value=supplier.get('payment_terms', ''))
+                        lead_time_days = st.number_input("Lead Time (days)", min_value=0, step=1,
+                                                         value=int(supplier.get('lead_time_days', DEFAULT_LEAD_TIME_DAYS)))
                         
                         if st.form_submit_button("Update Supplier"):
                             suppliers[supplier_id]['name'] = name
@@ -5201,6 +8303,7 @@ def suppliers_management():
                             suppliers[supplier_id]['address'] = address
                             suppliers[supplier_id]['products_supplied'] = [p.strip() for p in products_supplied.split(',')] if products_supplied else []
                             suppliers[supplier_id]['payment_terms'] = payment_terms
+                            suppliers[supplier_id]['lead_time_days'] = int(lead_time_days)
                             suppliers[supplier_id]['last_updated'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
                             suppliers[supplier_id]['updated_by'] = st.session_state.user_info['username']
                             
@@ -5231,6 +8334,450 @@ def suppliers_management():
                     st.success("Supplier deleted successfully")
 
 # Reports & Analytics
+# Report computations are pure functions of the data files, so their results are
+# cached by cached_report() and only recomputed when a dependent file changes.
+SALES_REPORT_DEPS = {
+    "Product Sales": (TRANSACTIONS_FILE, SALES_CUBE_FILE, PRODUCTS_FILE),
+    "Category Sales": (TRANSACTIONS_FILE, SALES_CUBE_FILE, PRODUCTS_FILE, CATEGORIES_FILE)
+}
+
+def sales_items_frame(trans_list):
+    barcodes = []
+    quantities = []
+    prices = []
+    for t in trans_list:
+        for barcode, item in t.get('items', {}).items():
+            # Malformed lines are skipped, as malformed transactions are
+            try:
+                quantity = int(item.get('quantity', 0))
+                price_cents = cents_of(item, 'price')
+            except (ValueError, TypeError, AttributeError, ArithmeticError):
+                continue
+            barcodes.append(barcode)
+            quantities.append(quantity)
+            prices.append(price_cents)
+    
+    items_df = pd.DataFrame({
+        'barcode': barcodes,
+        'quantity': np.asarray(quantities, dtype=np.int64),
+        'price_cents': np.asarray(prices, dtype=np.int64)
+    })
+    items_df['revenue_cents'] = items_df['quantity'].to_numpy() * items_df['price_cents'].to_numpy()
+    return items_df
+
+def compute_sales_report(report_type, start_date, end_date):
+    # Closed date ranges come from the sales cube when it covers them
+    from_cube = compute_sales_report_from_cube(get_sales_cube(), report_type, start_date, end_date)
+    if from_cube is not None:
+        return from_cube
+    transactions = load_data(TRANSACTIONS_FILE)
+    
+    # Convert transactions to DataFrame with error handling
+    trans_list = []
+    for t in transactions.values():
+        try:
+            trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
+            if start_date <= trans_date <= end_date:
+                trans_list.append({
+                    'date': t['date'],
+                    'transaction_id': t.get('transaction_id', 'N/A'),
+                    'total': t.get('total', 0),
+                    'total_cents': cents_of(t, 'total'),
+                    'cashier': t.get('cashier', 'N/A'),
+                    'payment_method': t.get('payment_method', 'N/A'),
+                    'items': t.get('items', {})
+                })
+        except (ValueError, KeyError, AttributeError, ArithmeticError):
+            continue
+    
+    if not trans_list:
+        return {'transactions': 0, 'report_df': None}
+    
+    trans_df = pd.DataFrame(trans_list)
+    trans_df['date'] = pd.to_datetime(trans_df['date'])
+    trans_df['total_cents'] = trans_df['total_cents'].astype(np.int64)
+    report_df = None
+    
+    if report_type in ["Daily Sales", "Weekly Sales", "Monthly Sales", "Hourly Sales"]:
+        if report_type == "Daily Sales":
+            group_key = trans_df['date'].dt.date.rename('date_group')
+        elif report_type == "Weekly Sales":
+            group_key = trans_df['date'].dt.strftime('%Y-%U').rename('week')
+        elif report_type == "Monthly Sales":
+            group_key = trans_df['date'].dt.strftime('%Y-%m').rename('month')
+        else:
+            group_key = trans_df['date'].dt.hour.rename('hour')
+        
+        report_df = trans_df.groupby(group_key).agg(
+            total_cents=('total_cents', 'sum'),
+            transactions=('transaction_id', 'count')
+        )
+        report_df.insert(0, 'total', report_df.pop('total_cents') / MONEY_SCALE)
+    
+    elif report_type == "Product Sales":
+        products = load_data(PRODUCTS_FILE)
+        items_df = sales_items_frame(trans_list)
+        
+        if not items_df.empty:
+            report_df = items_df.groupby('barcode').agg(
+                quantity=('quantity', 'sum'),
+                revenue_cents=('revenue_cents', 'sum')
+            )
+            report_df.insert(0, 'name', [products.get(barcode, {}).get('name', 'Unknown') for barcode in report_df.index])
+            report_df['revenue'] = report_df.pop('revenue_cents') / MONEY_SCALE
+            report_df = report_df.sort_values('revenue', ascending=False)
+    
+    elif report_type == "Category Sales":
+        products = load_data(PRODUCTS_FILE)
+        categories = load_data(CATEGORIES_FILE).get('categories', [])
+        items_df = sales_items_frame(trans_list)
+        items_df['category'] = [products.get(barcode, {}).get('category', 'Unknown') for barcode in items_df['barcode']]
+        
+        category_sales = items_df.groupby('category').agg(
+            revenue_cents=('revenue_cents', 'sum'),
+            quantity=('quantity', 'sum')
+        )
+        # Categories without sales still appear, with zero totals
+        all_categories = list(dict.fromkeys(list(categories) + list(category_sales.index)))
+        if all_categories:
+            report_df = category_sales.reindex(all_categories, fill_value=0)
+            report_df.insert(0, 'revenue', report_df.pop('revenue_cents') / MONEY_SCALE)
+            report_df = report_df.sort_values('revenue', ascending=False)
+    
+    elif report_type == "Cashier Performance":
+        report_df = trans_df.groupby('cashier').agg(
+            transactions=('transaction_id', 'count'),
+            total_cents=('total_cents', 'sum')
+        )
+        report_df['total_sales'] = report_df.pop('total_cents') / MONEY_SCALE
+        report_df['avg_sale'] = report_df['total_sales'] / report_df['transactions']
+        report_df = report_df.sort_values('total_sales', ascending=False)
+    
+    return {'transactions': len(trans_df), 'report_df': report_df}
+
+def compute_payment_analysis(start_date, end_date):
+    transactions = load_data(TRANSACTIONS_FILE)
+    
+    payment_methods = {}
+    payment_trends = {}
+    
+    for t in transactions.values():
+        try:
+            trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
+            if start_date <= trans_date <= end_date:
+                method = t.get('payment_method', 'Unknown')
+                total_cents = cents_of(t, 'total')
+                if method not in payment_methods:
+                    payment_methods[method] = {'count': 0, 'total': 0}
+                
+                payment_methods[method]['count'] += 1
+                payment_methods[method]['total'] += total_cents
+                
+                # Payment method trends over time
+                date_key = trans_date.strftime("%Y-%m-%d")
+                if date_key not in payment_trends:
+                    payment_trends[date_key] = {}
+                payment_trends[date_key][method] = payment_trends[date_key].get(method, 0) + total_cents
+        except (ValueError, KeyError, AttributeError):
+            continue
+    
+    if not payment_methods:
+        return None, None
+    
+    payment_df = pd.DataFrame.from_dict(payment_methods, orient='index')
+    payment_df['total'] = payment_df['total'].astype(np.int64) / MONEY_SCALE
+    payment_df = payment_df.sort_values('total', ascending=False)
+    trend_df = pd.DataFrame.from_dict(payment_trends, orient='index').fillna(0) / MONEY_SCALE if payment_trends else None
+    return payment_df, trend_df
+
+def run_sales_report_job(job, report_type, start_date, end_date):
+    job.update(0.1, "Aggregating transactions")
+    sales_report = cached_report(
+        report_type, (start_date, end_date),
+        SALES_REPORT_DEPS.get(report_type, (TRANSACTIONS_FILE, SALES_CUBE_FILE)),
+        lambda: compute_sales_report(report_type, start_date, end_date)
+    )
+    
+    job.update(0.9, "Saving report")
+    output_path = job.output_path()
+    report_df = sales_report['report_df']
+    (report_df if report_df is not None else pd.DataFrame()).to_csv(output_path)
+    return output_path
+
+SALES_EXPORT_HEADER = ['date', 'transaction_id', 'total', 'cashier', 'payment_method', 'items']
+INVENTORY_AUDIT_HEADER = ['Product', 'Barcode', 'System Quantity', 'Physical Count', 'Variance', 'Notes']
+
+def iter_sales_export_rows(transactions, start_date, end_date, progress=None):
+    total_rows = max(len(transactions), 1)
+    for index, t in enumerate(transactions.values()):
+        if progress and index % EXPORT_CHUNK_ROWS == 0:
+            progress(index, total_rows)
+        try:
+            trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
+        except (ValueError, TypeError):
+            continue
+        if start_date <= trans_date <= end_date:
+            yield [t['date'], t.get('transaction_id', 'N/A'), t.get('total', 0),
+                   t.get('cashier', 'N/A'), t.get('payment_method', 'N/A'),
+                   json.dumps(t.get('items', {}))]
+
+def iter_inventory_audit_rows(inventory, products, progress=None):
+    total_rows = max(len(inventory), 1)
+    for index, (barcode, inv_data) in enumerate(inventory.items()):
+        if progress and index % EXPORT_CHUNK_ROWS == 0:
+            progress(index, total_rows)
+        product = products.get(barcode, {'name': 'Unknown'})
+        yield [product['name'], barcode, inv_data.get('quantity', 0), "", "", ""]
+
+def run_sales_export_job(job, start_date, end_date, export_format="CSV"):
+    job.update(0.0, "Loading transactions")
+    transactions = load_data(TRANSACTIONS_FILE)
+    rows = iter_sales_export_rows(
+        transactions, start_date, end_date,
+        progress=lambda index, total: job.update(index / total, f"Exported {index} of {total} transactions")
+    )
+    
+    output_path = job.output_path()
+    with open(output_path, 'wb') as f:
+        write_export(f, SALES_EXPORT_HEADER, rows, export_format)
+    return output_path
+
+def run_inventory_audit_job(job):
+    job.update(0.0, "Loading inventory")
+    inventory = load_data(INVENTORY_FILE)
+    products = load_data(PRODUCTS_FILE)
+    rows = iter_inventory_audit_rows(
+        inventory, products,
+        progress=lambda index, total: job.update(index / total, f"Written {index} of {total} items")
+    )
+    
+    output_path = job.output_path()
+    with open(output_path, 'wb') as f:
+        write_export(f, INVENTORY_AUDIT_HEADER, rows)
+    return output_path
+
+# Sales cube
+# Pre-aggregated totals over the whole transaction history, rebuilt from scratch
+# one month per partition so the rebuild scales with the number of cores.
+# Money totals are kept in integer cents. The rebuild runs in the background on
+# the first run of each day, and sales reports whose range ends before the day
+# the cube was built are answered from it without reading the transactions.
+SALES_CUBE_DAILY_SECTIONS = ['product_daily', 'cashier_daily', 'hourly_daily']
+
+def new_sales_aggregate():
+    return {
+        'daily': {},
+        'hourly': {},
+        'products': {},
+        'categories': {},
+        'cashiers': {},
+        'payments': {},
+        'product_daily': {},
+        'cashier_daily': {},
+        'hourly_daily': {}
+    }
+
+def _add_to_bucket(bucket, key, *values):
+    totals = bucket.get(key)
+    if totals is None:
+        bucket[key] = list(values)
+    else:
+        for i, value in enumerate(values):
+            totals[i] += value
+
+def partition_transactions_by_month(transactions):
+    partitions = {}
+    for t in transactions.values():
+        month = str(t.get('date', ''))[:7] or 'unknown'
+        partitions.setdefault(month, []).append(t)
+    return partitions
+
+def aggregate_sales_partition(month, transactions, product_categories):
+    aggregate = new_sales_aggregate()
+    
+    for t in transactions:
+        try:
+            trans_dt = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S")
+            total = cents_of(t, 'total')
+        except (ValueError, TypeError, ArithmeticError):
+            continue
+        
+        date_key = trans_dt.strftime("%Y-%m-%d")
+        _add_to_bucket(aggregate['daily'], date_key, total, 1)
+        _add_to_bucket(aggregate['hourly'], str(trans_dt.hour), total, 1)
+        _add_to_bucket(aggregate['cashiers'], t.get('cashier', 'Unknown'), total, 1)
+        _add_to_bucket(aggregate['payments'], t.get('payment_method', 'Unknown'), total, 1)
+        _add_to_bucket(aggregate['cashier_daily'].setdefault(t.get('cashier', 'N/A'), {}), date_key, total, 1)
+        _add_to_bucket(aggregate['hourly_daily'].setdefault(str(trans_dt.hour), {}), date_key, total, 1)
+        
+        for barcode, item in t.get('items', {}).items():
+            try:
+                quantity = int(item.get('quantity', 0))
+                revenue = cents_of(item, 'price') * quantity
+            except (ValueError, TypeError, AttributeError, ArithmeticError):
+                continue
+            _add_to_bucket(aggregate['products'], barcode, quantity, revenue)
+            _add_to_bucket(aggregate['categories'], product_categories.get(barcode, 'Unknown'), quantity, revenue)
+            _add_to_bucket(aggregate['product_daily'].setdefault(barcode, {}), date_key, quantity, revenue)
+    
+    return aggregate
+
+def merge_sales_aggregates(partials):
+    merged = new_sales_aggregate()
+    for partial in partials:
+        for section in ['daily', 'hourly', 'products', 'categories', 'cashiers', 'payments']:
+            for key, values in partial[section].items():
+                _add_to_bucket(merged[section], key, *values)
+        for section in SALES_CUBE_DAILY_SECTIONS:
+            for key, days in partial[section].items():
+                key_days = merged[section].setdefault(key, {})
+                for date_key, values in days.items():
+                    _add_to_bucket(key_days, date_key, *values)
+    return merged
+
+def rebuild_sales_cube(parallel=True, workers=None, progress=None):
+    transactions = load_data(TRANSACTIONS_FILE)
+    products = load_data(PRODUCTS_FILE)
+    product_categories = {barcode: p.get('category', 'Unknown') for barcode, p in products.items()}
+    
+    partitions = partition_transactions_by_month(transactions)
+    partials = parallel_map_partitions(
+        lambda month, chunk: aggregate_sales_partition(month, chunk, product_categories),
+        partitions,
+        workers=(workers or PARALLEL_WORKERS) if parallel else 1,
+        progress=progress
+    )
+    
+    cube = merge_sales_aggregates(partials)
+    cube['built_at'] = get_current_datetime().strftime("%Y-%m-%d %H:%M:%S")
+    cube['transaction_count'] = len(transactions)
+    cube['partitions'] = len(partitions)
+    cube['money_scale'] = MONEY_SCALE
+    save_data(cube, SALES_CUBE_FILE)
+    return cube
+
+def run_sales_cube_job(job, parallel, workers):
+    job.update(0.0, "Partitioning transaction history")
+    started = time.time()
+    cube = rebuild_sales_cube(
+        parallel=parallel,
+        workers=workers,
+        progress=lambda done: job.update(done * 0.95, f"Aggregated {done:.0%} of partitions")
+    )
+    
+    job.update(0.95, "Writing summary")
+    output_path = job.output_path()
+    summary = pd.DataFrame.from_dict(
+        {day: {'total': from_cents(values[0]), 'transactions': values[1]} for day, values in cube['daily'].items()},
+        orient='index'
+    ).sort_index()
+    summary.index.name = 'date'
+    summary.to_csv(output_path)
+    job.message = f"Rebuilt {cube['partitions']} partitions in {time.time() - started:.1f}s"
+    return output_path
+
+def submit_sales_cube_job(owner="system", parallel=False, workers=None):
+    runner = get_job_runner()
+    if runner.find_active("Sales cube rebuild", ()):
+        return None
+    return runner.submit("Sales cube rebuild", run_sales_cube_job, parallel, workers or PARALLEL_WORKERS,
+                         owner=owner, file_name=f"sales_cube_daily_{datetime.date.today()}.csv", params=())
+
+def get_sales_cube():
+    return cached_report("Sales Cube", (), (SALES_CUBE_FILE,), lambda: load_data(SALES_CUBE_FILE))
+
+def refresh_sales_cube():
+    # The first run of each day rebuilds the cube in the background, serially:
+    # forking from a job thread of the multithreaded server can deadlock the child
+    built_at = cached_report("Sales Cube Date", (), (SALES_CUBE_FILE,),
+                             lambda: load_data(SALES_CUBE_FILE).get('built_at'))
+    if not built_at or built_at[:10] != get_current_datetime().strftime("%Y-%m-%d"):
+        submit_sales_cube_job()
+
+def _cube_days(days, start, end):
+    # Sums [total, count]-style buckets over the days in range
+    totals = None
+    for day, values in days.items():
+        if start <= day <= end:
+            totals = list(values) if totals is None else [a + b for a, b in zip(totals, values)]
+    return totals
+
+def compute_sales_report_from_cube(cube, report_type, start_date, end_date):
+    # None when the cube cannot answer: not built, from an older layout, or the
+    # range reaches the day it was built (that day's sales may be incomplete)
+    if not cube.get('built_at') or any(section not in cube for section in SALES_CUBE_DAILY_SECTIONS):
+        return None
+    if end_date.strftime("%Y-%m-%d") >= cube['built_at'][:10]:
+        return None
+    start, end = start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    
+    daily = {day: values for day, values in cube['daily'].items() if start <= day <= end}
+    if not daily:
+        return {'transactions': 0, 'report_df': None}
+    daily_df = pd.DataFrame.from_dict(daily, orient='index', columns=['total_cents', 'transactions']).sort_index()
+    daily_df.index = pd.to_datetime(daily_df.index)
+    report_df = None
+    
+    if report_type in ["Daily Sales", "Weekly Sales", "Monthly Sales"]:
+        if report_type == "Daily Sales":
+            group_key = daily_df.index.date
+            name = 'date_group'
+        elif report_type == "Weekly Sales":
+            group_key = daily_df.index.strftime('%Y-%U')
+            name = 'week'
+        else:
+            group_key = daily_df.index.strftime('%Y-%m')
+            name = 'month'
+        report_df = daily_df.groupby(pd.Index(group_key, name=name)).sum()
+        report_df.insert(0, 'total', report_df.pop('total_cents') / MONEY_SCALE)
+    
+    elif report_type == "Hourly Sales":
+        hours = {int(hour): totals for hour, days in cube['hourly_daily'].items()
+                 for totals in [_cube_days(days, start, end)] if totals}
+        report_df = pd.DataFrame.from_dict(hours, orient='index', columns=['total_cents', 'transactions']).sort_index()
+        report_df.index.name = 'hour'
+        report_df.insert(0, 'total', report_df.pop('total_cents') / MONEY_SCALE)
+    
+    elif report_type in ["Product Sales", "Category Sales"]:
+        products = load_data(PRODUCTS_FILE)
+        sold = {barcode: totals for barcode, days in cube['product_daily'].items()
+                for totals in [_cube_days(days, start, end)] if totals}
+        items_df = pd.DataFrame.from_dict(sold, orient='index', columns=['quantity', 'revenue_cents'])
+        if report_type == "Product Sales":
+            if not items_df.empty:
+                report_df = items_df.rename_axis('barcode')
+                report_df.insert(0, 'name', [products.get(barcode, {}).get('name', 'Unknown') for barcode in report_df.index])
+                report_df['revenue'] = report_df.pop('revenue_cents') / MONEY_SCALE
+                report_df = report_df.sort_values('revenue', ascending=False)
+        else:
+            categories = load_data(CATEGORIES_FILE).get('categories', [])
+            items_df['category'] = [products.get(barcode, {}).get('category', 'Unknown') for barcode in items_df.index]
+            category_sales = items_df.groupby('category')[['revenue_cents', 'quantity']].sum()
+            all_categories = list(dict.fromkeys(list(categories) + list(category_sales.index)))
+            if all_categories:
+                report_df = category_sales.reindex(all_categories, fill_value=0)
+                report_df.insert(0, 'revenue', report_df.pop('revenue_cents') / MONEY_SCALE)
+                report_df = report_df.sort_values('revenue', ascending=False)
+    
+    elif report_type == "Cashier Performance":
+        cashiers = {cashier: totals for cashier, days in cube['cashier_daily'].items()
+                    for totals in [_cube_days(days, start, end)] if totals}
+        report_df = pd.DataFrame.from_dict(cashiers, orient='index', columns=['total_cents', 'transactions'])
+        report_df.index.name = 'cashier'
+        report_df = report_df[['transactions', 'total_cents']]
+        report_df['total_sales'] = report_df.pop('total_cents') / MONEY_SCALE
+        report_df['avg_sale'] = report_df['total_sales'] / report_df['transactions']
+        report_df = report_df.sort_values('total_sales', ascending=False)
+    
+    return {'transactions': int(daily_df['transactions'].sum()), 'report_df': report_df}
+
+def submit_inventory_audit_job():
+    runner = get_job_runner()
+    if not runner.find_active("Inventory audit sheet", ()):
+        runner.submit("Inventory audit sheet", run_inventory_audit_job,
+                      owner=st.session_state.user_info['username'],
+                      file_name=f"inventory_audit_{datetime.date.today()}.csv", params=())
+
 def reports_analytics():
     if not is_manager():
         st.warning("You don't have permission to access this page")
@@ -5238,21 +8785,23 @@ def reports_analytics():
     
     st.title("Reports & Analytics")
     
-    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs([
         "Sales Reports", 
         "Inventory Reports", 
         "Customer Reports", 
         "Payment Analysis",
         "Brand Reports",
         "Return Analysis",
-        "Custom Reports"
+        "Custom Reports",
+        "Background Jobs"
     ])
     
     with tab1:
         st.header("Sales Reports")
         
-        transactions = load_data(TRANSACTIONS_FILE)
-        if not transactions:
+        transaction_count = cached_report("Transaction Count", (), (TRANSACTIONS_FILE,),
+                                          lambda: len(load_data(TRANSACTIONS_FILE)))
+        if not transaction_count:
             st.info("No sales data available")
         else:
             report_type = st.selectbox("Sales Report Type", [
@@ -5272,36 +8821,35 @@ def reports_analytics():
             with col2:
                 end_date = st.date_input("End Date", value=datetime.date.today())
             
-            # Convert transactions to DataFrame with error handling
-            trans_list = []
-            for t in transactions.values():
-                try:
-                    trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                    if start_date <= trans_date <= end_date:
-                        trans_list.append({
-                            'date': t['date'],
-                            'transaction_id': t.get('transaction_id', 'N/A'),
-                            'total': t.get('total', 0),
-                            'cashier': t.get('cashier', 'N/A'),
-                            'payment_method': t.get('payment_method', 'N/A'),
-                            'items': t.get('items', {})
-                        })
-                except (ValueError, KeyError, AttributeError):
-                    continue
+            run_in_background = st.checkbox("Run in background", key="sales_report_background",
+                                            help="Prepare the report on a background worker and keep the page responsive")
+            
+            report_deps = SALES_REPORT_DEPS.get(report_type, (TRANSACTIONS_FILE, SALES_CUBE_FILE))
+            sales_report = peek_cached_report(report_type, (start_date, end_date), report_deps)
+            if sales_report is _CACHE_MISS:
+                if run_in_background:
+                    runner = get_job_runner()
+                    job_name = f"{report_type} report"
+                    job_params = (report_type, start_date, end_date)
+                    if not runner.find_active(job_name, job_params):
+                        runner.submit(job_name, run_sales_report_job, report_type, start_date, end_date,
+                                      owner=st.session_state.user_info['username'],
+                                      file_name=f"{report_type.lower().replace(' ', '_')}_{start_date}_to_{end_date}.csv",
+                                      params=job_params)
+                    st.info("The report is being prepared in the background. Track it in the Background Jobs tab.")
+                    sales_report = None
+                else:
+                    sales_report = cached_report(report_type, (start_date, end_date), report_deps,
+                                                 lambda: compute_sales_report(report_type, start_date, end_date))
             
-            if not trans_list:
+            if sales_report is None:
+                pass
+            elif not sales_report['transactions']:
                 st.info("No transactions in selected date range")
             else:
-                trans_df = pd.DataFrame(trans_list)
-                trans_df['date'] = pd.to_datetime(trans_df['date'])
+                report_df = sales_report['report_df']
                 
                 if report_type == "Daily Sales":
-                    trans_df['date_group'] = trans_df['date'].dt.date
-                    report_df = trans_df.groupby('date_group').agg({
-                        'total': 'sum',
-                        'transaction_id': 'count'
-                    }).rename(columns={'transaction_id': 'transactions'})
-                    
                     st.subheader("Daily Sales Summary")
                     st.dataframe(report_df)
                     
@@ -5319,12 +8867,6 @@ def reports_analytics():
                     col3.metric("Average Transaction", format_currency(avg_transaction))
                 
                 elif report_type == "Weekly Sales":
-                    trans_df['week'] = trans_df['date'].dt.strftime('%Y-%U')
-                    report_df = trans_df.groupby('week').agg({
-                        'total': 'sum',
-                        'transaction_id': 'count'
-                    }).rename(columns={'transaction_id': 'transactions'})
-                    
                     st.subheader("Weekly Sales Summary")
                     st.dataframe(report_df)
                     
@@ -5332,12 +8874,6 @@ def reports_analytics():
                     st.bar_chart(report_df['total'])
                 
                 elif report_type == "Monthly Sales":
-                    trans_df['month'] = trans_df['date'].dt.strftime('%Y-%m')
-                    report_df = trans_df.groupby('month').agg({
-                        'total': 'sum',
-                        'transaction_id': 'count'
-                    }).rename(columns={'transaction_id': 'transactions'})
-                    
                     st.subheader("Monthly Sales Summary")
                     st.dataframe(report_df)
                     
@@ -5345,117 +8881,66 @@ def reports_analytics():
                     st.area_chart(report_df['total'])
                 
                 elif report_type == "Product Sales":
-                    products = load_data(PRODUCTS_FILE)
-                    product_sales = {}
-                    
-                    for t in trans_list:
-                        for barcode, item in t.get('items', {}).items():
-                            if barcode not in product_sales:
-                                product_sales[barcode] = {
-                                    'name': products.get(barcode, {}).get('name', 'Unknown'),
-                                    'quantity': 0,
-                                    'revenue': 0.0
-                                }
-                            
-                            product_sales[barcode]['quantity'] += item.get('quantity', 0)
-                            product_sales[barcode]['revenue'] += item.get('price', 0) * item.get('quantity', 0)
-                    
-                    if not product_sales:
+                    if report_df is None:
                         st.info("No product sales in selected date range")
                     else:
-                        sales_df = pd.DataFrame.from_dict(product_sales, orient='index')
-                        sales_df = sales_df.sort_values('revenue', ascending=False)
-                        
                         st.subheader("Product Sales Summary")
-                        st.dataframe(sales_df)
+                        st.dataframe(report_df)
                         
                         st.subheader("Top Selling Products")
                         top_n = st.slider("Show Top", 1, 20, 5)
-                        st.bar_chart(sales_df.head(top_n)['revenue'])
+                        st.bar_chart(report_df.head(top_n)['revenue'])
                 
                 elif report_type == "Category Sales":
-                    products = load_data(PRODUCTS_FILE)
-                    categories = load_data(CATEGORIES_FILE).get('categories', [])
-                    category_sales = {}
-                    
-                    for cat in categories:
-                        category_sales[cat] = {'revenue': 0.0, 'quantity': 0}
-                    
-                    for t in trans_list:
-                        for barcode, item in t.get('items', {}).items():
-                            product = products.get(barcode, {})
-                            category = product.get('category', 'Unknown')
-                            
-                            if category not in category_sales:
-                                category_sales[category] = {'revenue': 0.0, 'quantity': 0}
-                            
-                            category_sales[category]['quantity'] += item.get('quantity', 0)
-                            category_sales[category]['revenue'] += item.get('price', 0) * item.get('quantity', 0)
-                    
-                    if not category_sales:
+                    if report_df is None:
                         st.info("No category sales in selected date range")
                     else:
-                        sales_df = pd.DataFrame.from_dict(category_sales, orient='index')
-                        sales_df = sales_df.sort_values('revenue', ascending=False)
-                        
                         st.subheader("Category Sales Summary")
-                        st.dataframe(sales_df)
+                        st.dataframe(report_df)
                         
                         st.subheader("Sales by Category")
-                        st.bar_chart(sales_df['revenue'])
+                        st.bar_chart(report_df['revenue'])
                 
                 elif report_type == "Cashier Performance":
-                    cashier_performance = {}
-                    
-                    for t in trans_list:
-                        cashier = t.get('cashier', 'Unknown')
-                        if cashier not in cashier_performance:
-                            cashier_performance[cashier] = {
-                                'transactions': 0,
-                                'total_sales': 0.0,
-                                'avg_sale': 0.0
-                            }
-                        
-                        cashier_performance[cashier]['transactions'] += 1
-                        cashier_performance[cashier]['total_sales'] += t.get('total', 0)
-                    
-                    for cashier, data in cashier_performance.items():
-                        if data['transactions'] > 0:
-                            data['avg_sale'] = data['total_sales'] / data['transactions']
-                    
-                    if not cashier_performance:
+                    if report_df is None:
                         st.info("No cashier data in selected date range")
                     else:
-                        performance_df = pd.DataFrame.from_dict(cashier_performance, orient='index')
-                        performance_df = performance_df.sort_values('total_sales', ascending=False)
-                        
                         st.subheader("Cashier Performance Summary")
-                        st.dataframe(performance_df)
+                        st.dataframe(report_df)
                         
                         st.subheader("Sales by Cashier")
-                        st.bar_chart(performance_df['total_sales'])
+                        st.bar_chart(report_df['total_sales'])
                 
                 elif report_type == "Hourly Sales":
-                    trans_df['hour'] = trans_df['date'].dt.hour
-                    hourly_sales = trans_df.groupby('hour').agg({
-                        'total': 'sum',
-                        'transaction_id': 'count'
-                    }).rename(columns={'transaction_id': 'transactions'})
-                    
                     st.subheader("Hourly Sales Pattern")
-                    st.bar_chart(hourly_sales['total'])
+                    st.bar_chart(report_df['total'])
                     
                     st.subheader("Hourly Transaction Count")
-                    st.bar_chart(hourly_sales['transactions'])
+                    st.bar_chart(report_df['transactions'])
                 
                 # Export option
-                csv = trans_df.to_csv(index=False)
-                st.download_button(
-                    label="Export Sales Data",
-                    data=csv,
-                    file_name=f"sales_report_{start_date}_to_{end_date}.csv",
-                    mime="text/csv"
-                )
+                export_format = st.selectbox("Export Format", available_export_formats(), key="sales_export_format")
+                export_name = f"sales_report_{start_date}_to_{end_date}"
+                col1, col2 = st.columns(2)
+                with col1:
+                    if st.button("Export Sales Data",
+                                 help="Builds the file and offers it for download on this page. "
+                                      "Use Export in Background for large date ranges"):
+                        file_download_button(
+                            "Download Sales Data",
+                            SALES_EXPORT_HEADER,
+                            iter_sales_export_rows(load_data(TRANSACTIONS_FILE), start_date, end_date),
+                            export_name,
+                            export_format=export_format,
+                            key="sales_export_download"
+                        )
+                with col2:
+                    if st.button("Export in Background"):
+                        get_job_runner().submit("Sales export", run_sales_export_job, start_date, end_date, export_format,
+                                                owner=st.session_state.user_info['username'],
+                                                file_name=export_file_name(export_name, export_format),
+                                                mime=EXPORT_FORMATS[export_format][1])
+                        st.success("Export started. Download it from the Background Jobs tab when ready.")
     
     with tab2:
         st.header("Inventory Reports")
@@ -5476,6 +8961,7 @@ def reports_analytics():
             ])
             
             if report_type == "Stock Levels":
+                low_stock = get_low_stock_tracker().low_stock()
                 inventory_list = []
                 for barcode, inv_data in inventory.items():
                     product = products.get(barcode, {'name': 'Unknown'})
@@ -5484,7 +8970,7 @@ def reports_analytics():
                         'barcode': barcode,
                         'quantity': inv_data.get('quantity', 0),
                         'reorder_point': inv_data.get('reorder_point', 10),
-                        'status': 'Low Stock' if inv_data.get('quantity', 0) < inv_data.get('reorder_point', 10) else 'OK'
+                        'status': 'Low Stock' if barcode in low_stock else 'OK'
                     })
                 
                 inv_df = pd.DataFrame(inventory_list)
@@ -5507,95 +8993,89 @@ def reports_analytics():
                 col3.metric("Out of Stock", out_of_stock_items)
             
             elif report_type == "Stock Value":
-                value_list = []
-                for barcode, inv_data in inventory.items():
-                    product = products.get(barcode, {'name': 'Unknown', 'cost': 0})
-                    value_list.append({
-                        'product': product['name'],
-                        'barcode': barcode,
-                        'quantity': inv_data.get('quantity', 0),
-                        'unit_cost': product.get('cost', 0),
-                        'total_value': inv_data.get('quantity', 0) * product.get('cost', 0)
-                    })
-                
-                value_df = pd.DataFrame(value_list)
-                total_value = value_df['total_value'].sum()
-                
-                st.write(f"**Total Inventory Value:** {format_currency(total_value)}")
-                st.dataframe(value_df.sort_values('total_value', ascending=False))
+                method = stock_value_summary("report_value")
+                value_df = stock_value_frame(products, method)
+                st.dataframe(value_df)
                 
                 # Value by category
-                category_value = {}
-                for barcode, inv_data in inventory.items():
-                    product = products.get(barcode, {})
-                    category = product.get('category', 'Unknown')
-                    cost = product.get('cost', 0)
-                    quantity = inv_data.get('quantity', 0)
-                    
-                    category_value[category] = category_value.get(category, 0) + (cost * quantity)
-                
-                if category_value:
-                    cat_df = pd.DataFrame({
-                        'Category': list(category_value.keys()),
-                        'Value': list(category_value.values())
-                    }).sort_values('Value', ascending=False)
+                if not value_df.empty:
+                    cat_df = value_df.groupby('category')['total_value'].sum().sort_values(ascending=False)
+                    cat_df = cat_df.rename_axis('Category').to_frame('Value')
                     
                     st.subheader("Inventory Value by Category")
-                    st.bar_chart(cat_df.set_index('Category'))
+                    st.bar_chart(cat_df)
             
             elif report_type == "Stock Movement":
-                st.info("Stock movement analysis would show inventory changes over time")
-                # This would require tracking inventory changes history
+                product_options = {f"{v['name']} ({k})": k for k, v in products.items()}
+                selected_product = st.selectbox(
+                    "Select Product",
+                    [""] + list(product_options.keys()),
+                    key="report_movement_product"
+                )
+                
+                if selected_product:
+                    barcode = product_options[selected_product]
+                    
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        movement_start = st.date_input("From", value=datetime.date.today() - timedelta(days=90),
+                                                       key="report_movement_start")
+                    with col2:
+                        movement_end = st.date_input("To", value=datetime.date.today(), key="report_movement_end")
+                    
+                    movements = get_stock_ledger().history(barcode, movement_start.strftime("%Y-%m-%d"),
+                                                           movement_end.strftime("%Y-%m-%d"))
+                    if movements:
+                        movement_df = pd.DataFrame(movements).drop(columns='barcode')
+                        change = movement_df['change']
+                        
+                        col1, col2, col3 = st.columns(3)
+                        col1.metric("Units In", int(change[change > 0].sum()))
+                        col2.metric("Units Out", int(-change[change < 0].sum()))
+                        col3.metric("Net Change", int(change.sum()))
+                        
+                        st.subheader("Net Change by Movement Type")
+                        st.bar_chart(movement_df.groupby('type')['change'].sum())
+                        
+                        st.subheader("Stock Level Over Time")
+                        st.line_chart(movement_df.assign(date=pd.to_datetime(movement_df['date'])).set_index('date')['new_qty'])
+                        
+                        st.dataframe(movement_df.iloc[::-1], hide_index=True)
+                    else:
+                        st.info("No stock movements for this product in the selected period")
                 
             elif report_type == "Inventory Audit":
                 st.info("Generate audit sheets for physical inventory counting")
                 if st.button("Generate Audit Sheet"):
-                    audit_data = []
-                    for barcode, inv_data in inventory.items():
-                        product = products.get(barcode, {'name': 'Unknown'})
-                        audit_data.append({
-                            'Product': product['name'],
-                            'Barcode': barcode,
-                            'System Quantity': inv_data.get('quantity', 0),
-                            'Physical Count': "",
-                            'Variance': "",
-                            'Notes': ""
-                        })
-                    
-                    audit_df = pd.DataFrame(audit_data)
-                    st.dataframe(audit_df)
-                    
-                    csv = audit_df.to_csv(index=False)
-                    st.download_button(
-                        label="Download Audit Sheet",
-                        data=csv,
-                        file_name=f"inventory_audit_{datetime.date.today()}.csv",
-                        mime="text/csv"
-                    )
+                    submit_inventory_audit_job()
+                    st.success("Audit sheet is being generated. Download it from the Background Jobs tab when ready.")
             
             elif report_type == "Low Stock Alert":
-                low_stock_items = []
-                for barcode, inv_data in inventory.items():
-                    if inv_data.get('quantity', 0) < inv_data.get('reorder_point', 10):
-                        product = products.get(barcode, {'name': 'Unknown', 'cost': 0})
-                        low_stock_items.append({
-                            'Product': product['name'],
-                            'Barcode': barcode,
-                            'Current Stock': inv_data.get('quantity', 0),
-                            'Reorder Point': inv_data.get('reorder_point', 10),
-                            'Needed': max(0, inv_data.get('reorder_point', 10) - inv_data.get('quantity', 0)),
-                            'Cost': product.get('cost', 0),
-                            'Value Needed': max(0, inv_data.get('reorder_point', 10) - inv_data.get('quantity', 0)) * product.get('cost', 0)
-                        })
+                low_df = low_stock_frame(products)
                 
-                if not low_stock_items:
+                if low_df.empty:
                     st.success("No low stock items! All inventory levels are adequate.")
                 else:
-                    low_df = pd.DataFrame(low_stock_items)
-                    st.dataframe(low_df.sort_values('Needed', ascending=False))
+                    low_df['Value Needed'] = low_df['needed'] * low_df['cost']
+                    low_df = low_df.rename(columns={
+                        'name': 'Product', 'barcode': 'Barcode', 'quantity': 'Current Stock',
+                        'reorder_point': 'Reorder Point', 'needed': 'Needed', 'cost': 'Cost', 'since': 'Low Since'
+                    })
+                    st.dataframe(low_df[['Product', 'Barcode', 'Current Stock', 'Reorder Point', 'Needed',
+                                         'Cost', 'Value Needed', 'Low Since']], hide_index=True)
                     
                     total_value_needed = low_df['Value Needed'].sum()
                     st.metric("Total Value Needed to Reorder", format_currency(total_value_needed))
+                
+                with st.expander("Recent Stock Alerts"):
+                    alerts = get_low_stock_tracker().alerts_since(0, kinds=('below', 'restocked'))
+                    if not alerts:
+                        st.info("No stock alerts yet")
+                    else:
+                        alerts_df = pd.DataFrame(alerts[::-1])
+                        alerts_df['product'] = alerts_df['barcode'].map(lambda b: products.get(b, {}).get('name', 'Unknown'))
+                        st.dataframe(alerts_df[['date', 'type', 'product', 'barcode', 'quantity', 'reorder_point']],
+                                     hide_index=True)
             
             elif report_type == "Slow Moving Items":
                 # This would analyze products with low sales velocity
@@ -5688,8 +9168,9 @@ def reports_analytics():
     with tab4:
         st.header("Payment Analysis")
         
-        transactions = load_data(TRANSACTIONS_FILE)
-        if not transactions:
+        transaction_count = cached_report("Transaction Count", (), (TRANSACTIONS_FILE,),
+                                          lambda: len(load_data(TRANSACTIONS_FILE)))
+        if not transaction_count:
             st.info("No transaction data available")
         else:
             col1, col2 = st.columns(2)
@@ -5698,51 +9179,21 @@ def reports_analytics():
             with col2:
                 end_date = st.date_input("End Date", value=datetime.date.today(), key="pay_end_date")
             
-            payment_methods = {}
-            
-            for t in transactions.values():
-                try:
-                    trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                    if start_date <= trans_date <= end_date:
-                        method = t.get('payment_method', 'Unknown')
-                        if method not in payment_methods:
-                            payment_methods[method] = {'count': 0, 'total': 0.0}
-                        
-                        payment_methods[method]['count'] += 1
-                        payment_methods[method]['total'] += t.get('total', 0)
-                except (ValueError, KeyError, AttributeError):
-                    continue
+            payment_df, trend_df = cached_report(
+                "Payment Analysis", (start_date, end_date), (TRANSACTIONS_FILE,),
+                lambda: compute_payment_analysis(start_date, end_date)
+            )
             
-            if not payment_methods:
+            if payment_df is None:
                 st.info("No payment data in selected date range")
             else:
-                payment_df = pd.DataFrame.from_dict(payment_methods, orient='index')
-                payment_df = payment_df.sort_values('total', ascending=False)
-                
                 st.subheader("Payment Method Summary")
                 st.dataframe(payment_df)
                 
                 st.subheader("Payment Method Distribution")
                 st.bar_chart(payment_df['total'])
                 
-                # Payment method trends over time
-                payment_trends = {}
-                for t in transactions.values():
-                    try:
-                        trans_date = datetime.datetime.strptime(t.get('date', ''), "%Y-%m-%d %H:%M:%S").date()
-                        if start_date <= trans_date <= end_date:
-                            method = t.get('payment_method', 'Unknown')
-                            date_key = trans_date.strftime("%Y-%m-%d")
-                            
-                            if date_key not in payment_trends:
-                                payment_trends[date_key] = {}
-                            
-                            payment_trends[date_key][method] = payment_trends[date_key].get(method, 0) + t.get('total', 0)
-                    except (ValueError, KeyError, AttributeError):
-                        continue
-                
-                if payment_trends:
-                    trend_df = pd.DataFrame.from_dict(payment_trends, orient='index').fillna(0)
+                if trend_df is not None:
                     st.subheader("Payment Method Trends")
                     st.line_chart(trend_df)
     
@@ -5945,7 +9396,7 @@ def reports_analytics():
             else:
                 # Calculate analytics
                 total_returns = len(filtered_returns)
-                total_refund_amount = sum(r['total_refund'] for r in filtered_returns)
+                total_refund_amount = from_cents(sum(cents_of(r, 'total_refund') for r in filtered_returns))
                 avg_refund = total_refund_amount / total_returns if total_returns > 0 else 0
                 
                 # Return rate calculation (would need total sales data)
@@ -6019,6 +9470,34 @@ def reports_analytics():
             
             if st.form_submit_button("Generate Custom Report"):
                 st.success(f"Custom report '{report_name}' would be generated for {start_date} to {end_date}")
+    
+    with tab8:
+        st.header("Background Jobs")
+        
+        st.info("Long-running reports, exports and audits run here without blocking the page")
+        
+        st.subheader("Historical Rebuilds")
+        cube = load_data(SALES_CUBE_FILE)
+        if cube.get('built_at'):
+            st.caption(f"Sales cube built {cube['built_at']} from {cube.get('transaction_count', 0)} transactions "
+                       f"in {cube.get('partitions', 0)} monthly partitions")
+        else:
+            st.caption("Sales cube has not been built yet")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            parallel_rebuild = st.checkbox("Parallel aggregation", value=get_fork_context() is not None,
+                                           disabled=get_fork_context() is None, key="cube_parallel")
+        with col2:
+            rebuild_workers = st.number_input("Worker processes", min_value=1, max_value=max(PARALLEL_WORKERS, 1),
+                                              value=PARALLEL_WORKERS, key="cube_workers")
+        
+        if st.button("Rebuild Sales Cube"):
+            if submit_sales_cube_job(st.session_state.user_info['username'], parallel_rebuild, int(rebuild_workers)):
+                st.rerun()
+            else:
+                st.info("A sales cube rebuild is already running")
+        render_jobs_panel(st.session_state.user_info['username'], key_prefix="report_jobs")
 
 # Shifts Management
 def shifts_management():
@@ -6392,6 +9871,17 @@ def main():
         initial_sidebar_state="expanded"
     )
     
+    # Backfill integer-cent amounts on records written before they existed
+    migrate_money_fields()
+    # Move stock adjustment history out of the inventory file into the ledger
+    migrate_stock_adjustments()
+    
+    # Apply promotion and price boundaries that have passed since the last run
+    get_promotion_scheduler().run_due()
+    # Refit the stockout forecast and rebuild the sales cube once a day
+    refresh_stock_forecast()
+    refresh_sales_cube()
+    
     # Apply theme from settings
     settings = load_data(SETTINGS_FILE)
     if settings.get('theme') == 'Dark':